@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Compares the /debts summary before and after the single-query aggregate.
+
+The "before" numbers come from a copy of the old get_all_debts, which ran two SELECT DISTINCT queries
+and then one users lookup and two transaction scans per counterparty. "after" computes the summary from scratch
+every time, "cached" is what repeated /debts calls cost while the user's balances don't change.
+"""
+import os
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from debtbot import DebtBot  # noqa: E402
+from synthetic import generate_ledger  # noqa: E402
+
+
+def legacy_get_debt(bot, uid1, uid2):
+    debt = 0
+    for t in bot.db.query('SELECT * FROM transactions WHERE creditor = :creditor AND debitor = :debitor',
+                          creditor=uid1, debitor=uid2):
+        debt += t['amount']
+    for t in bot.db.query('SELECT * FROM transactions WHERE creditor = :creditor AND debitor = :debitor',
+                          creditor=uid2, debitor=uid1):
+        debt -= t['amount']
+    return debt
+
+
+def legacy_get_all_debts(bot, uid):
+    all_others = []
+    for r in bot.db.query('SELECT DISTINCT debitor FROM transactions WHERE creditor = :creditor', creditor=uid):
+        all_others.append(r['debitor'])
+    for r in bot.db.query('SELECT DISTINCT creditor FROM transactions WHERE debitor = :debitor', debitor=uid):
+        if r['creditor'] not in all_others:
+            all_others.append(r['creditor'])
+
+    summary = ""
+    for other in all_others:
+        user = bot.db.query('SELECT * FROM users WHERE user_id = :user_id', user_id=other).fetchone()
+        string = bot.format_debt(legacy_get_debt(bot, uid, other), bot.format_name(user))
+        if 'even' not in string:
+            summary += string
+            summary += "\n"
+    return summary
+
+
+class QueryCounter:
+    def __init__(self, db):
+        self.count = 0
+        db.listeners.append(self.on_execute)
+
+    def on_execute(self, seconds, queries=1):
+        self.count += queries
+
+
+def measure(name, func, counter, repeat):
+    func()  # warm up SQLite's page cache
+    counter.count = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print("{:<8} {:>10.2f} ms {:>10d} queries".format(name, elapsed * 1000, counter.count // repeat))
+    return result
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--users', type='int', default=2000)
+    parser.add_option('--transactions', type='int', default=50000)
+    parser.add_option('--repeat', type='int', default=5)
+    (opts, args) = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'ledger.db')
+        generate_ledger(path, users=opts.users, transactions=opts.transactions)
+
+        bot = DebtBot()
+        bot.connect({'db': path})
+        counter = QueryCounter(bot.db)
+
+        uid = 1  # the heaviest user of the power-law ledger
+        counterparties = len(bot.get_all_debts(uid).splitlines())
+        print("/debts for user {} with {} uneven counterparties ({} users, {} transactions)".format(
+            uid, counterparties, opts.users, opts.transactions))
+
+        before = measure("before", lambda: legacy_get_all_debts(bot, uid), counter, opts.repeat)
+        after = measure("after", lambda: (bot.debt_summaries.clear(), bot.get_all_debts(uid))[1], counter,
+                        opts.repeat)
+        measure("cached", lambda: bot.get_all_debts(uid), counter, opts.repeat)
+        if sorted(before.splitlines()) != sorted(after.splitlines()):
+            print("Summaries differ!")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
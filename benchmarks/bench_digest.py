@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Measures a digest run on a large synthetic ledger: the single pass over the balances that send_digests makes, against
+asking for every subscriber's /debts summary one after another.
+
+A --subscribers share of the users, chosen at random, opts in to the digest. Reports how long each way takes, how
+many database queries it needs and how many messages it produces, and checks that both produce the same texts.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from debtbot import DebtBot  # noqa: E402
+from bench_suite import QueryCounter  # noqa: E402
+from synthetic import generate_ledger  # noqa: E402
+
+
+class CountingBot:
+    """Stands in for telegram.Bot and only counts the messages."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+
+def per_user(bot, subscribers):
+    """What a digest would cost if it asked for the /debts summary of every subscriber."""
+    texts = {}
+    for uid in subscribers:
+        bot.debt_summaries.clear()
+        debts = bot.get_debt_summary(uid)['debts']
+        if debts:
+            texts[uid] = "\n".join(bot.format_debt(debt, name) for user_id, name, debt in debts)
+    return texts
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--users', type='int', default=20000)
+    parser.add_option('--transactions', type='int', default=1000000)
+    parser.add_option('--subscribers', type='float', default=0.5, help="Share of the users who get the digest")
+    (opts, args) = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'ledger.db')
+        generate_ledger(path, users=opts.users, transactions=opts.transactions)
+
+        bot = DebtBot()
+        bot.connect({'db': path})
+        subscribers = sorted(random.Random(0).sample(range(1, opts.users + 1),
+                                                     int(opts.users * opts.subscribers)))
+        with bot.db as tx:
+            tx.executemany('UPDATE users SET digest = 1 WHERE user_id = ?', [(uid,) for uid in subscribers])
+        counter = QueryCounter(bot.db)
+        print("{} users, {} transactions, {} get the digest".format(opts.users, opts.transactions, len(subscribers)))
+        print("{:<14} {:>9} {:>9} {:>9}".format('', 'seconds', 'queries', 'messages'))
+
+        counter.count = 0
+        start = time.perf_counter()
+        expected = per_user(bot, subscribers)
+        print("{:<14} {:>9.2f} {:>9} {:>9}".format('per user', time.perf_counter() - start, counter.count,
+                                                   len(expected)))
+
+        counter.count = 0
+        context = SimpleNamespace(bot=CountingBot())
+        bot.send_digests(context)
+        queries = counter.count
+        texts = {uid: text.split("\n\n", 1)[1] for uid, text in bot.get_digests()}
+        print("{:<14} {:>9.2f} {:>9} {:>9}".format('one pass', bot.digest_seconds, queries, len(texts)))
+        print("{} messages after splitting long digests".format(context.bot.sent))
+
+        if texts != expected:
+            print("MISMATCH: {} of {} digests differ".format(
+                sum(texts.get(uid) != text for uid, text in expected.items()) + len(set(texts) - set(expected)),
+                len(expected)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
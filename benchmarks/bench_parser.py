@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Checks that transaction_parser.parse_transaction_exact gives the same results as the old regular expressions,
+then measures its throughput and worst-case time on adversarial input. The old parser returned amounts as floats,
+already divided by the N of "amount/N", so both parsers' amounts are compared in cents.
+
+Parity is checked against the golden corpus in parser_corpus.jsonl, whose expected results were recorded
+from the old parser, and against the old parser itself on randomly assembled messages.
+Exits with status 1 if any result differs.
+
+Use --record to regenerate the golden corpus from the old parser.
+"""
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import legacy_parser  # noqa: E402
+from money import to_minor  # noqa: E402
+from transaction_parser import parse_transaction_exact  # noqa: E402
+
+CORPUS = os.path.join(HERE, 'parser_corpus.jsonl')
+
+FUZZ_WORDS = ['i', 'I', 'gave', 'give', 'got', 'get', 'owe', 'owes', 'owed', 'GAVE', 'me', 'Me', 'to', 'from',
+              'for', 'because', 'of', 'because of', 'in', 'by', 'with', 'via', 'through', 'and', '@', '@bob', 'bob',
+              'alice smith', '5', '-5', '12.5', '3.', '/2', '5/2', 'x', 'tom', 'meat', 'format', 'into', '1.2.3',
+              'a1b2', 'ı', 'İ', 'ſ', '٣', '-', '.', 'igave', 'ioweme', ' ', '\t', '\n', ' \n ']
+FUZZ_SEPARATORS = ['', ' ', ' ', ' ', '  ', '\n', ' \n']
+
+ADVERSARIAL = {
+    'long name, no amount': 'I gave ' + 'bob ' * 1000,
+    'long shorthand name': 'a' * 4000 + ' 5',
+    'repeated verbs': 'gave ' * 800,
+    'repeated x gave': 'bob gave ' * 450,
+    'leading whitespace': ' ' * 4000 + 'bob 5',
+    'whitespace after amount': 'I gave 5' + ' ' * 4000 + 'bob\nx',
+    'digits': '1' * 4000,
+    'numbers and line breaks': 'I gave bob ' + '1 x\n' * 1000,
+    'repeated keywords': 'I gave 5 bob ' + 'for ' * 1000 + '\nx',
+    'repeated me': 'bob gave me ' + 'me ' * 1300,
+}
+
+
+def in_cents(result):
+    """Turns the old parser's result, or a recorded one, into one whose amount is in cents."""
+    if isinstance(result, str) or result[0] is None:
+        return result
+    return [to_minor(result[0], 2)] + result[1:]
+
+
+def exact_result(message):
+    """Gives the result of parse_transaction_exact in the old parser's form, with the amount in cents."""
+    parsed = parse_transaction_exact(message)
+    if not parsed:
+        return [None, None, None]
+    amount, divisor, recipient, reason = parsed
+    if divisor is not None:
+        if divisor == 0:
+            raise ZeroDivisionError("float division by zero")
+        amount = amount / divisor
+    return [to_minor(amount, 2), recipient, reason]
+
+
+def results_equal(message, expected):
+    try:
+        actual = exact_result(message)
+    except ArithmeticError as e:
+        actual = type(e).__name__
+    expected = in_cents(expected)
+    return actual == expected, actual
+
+
+def legacy_result(message):
+    try:
+        return list(legacy_parser.parse_message(message))
+    except ArithmeticError as e:
+        return type(e).__name__
+
+
+def fuzz_messages(count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        length = rng.randint(1, 8)
+        message = ''.join(rng.choice(FUZZ_WORDS) + rng.choice(FUZZ_SEPARATORS) for _ in range(length))
+        yield message.strip(' ') if rng.random() < 0.3 else message
+
+
+def check_parity(fuzz_count):
+    failures = 0
+    with open(CORPUS) as corpus:
+        cases = [json.loads(line) for line in corpus]
+    for case in cases:
+        equal, actual = results_equal(case['message'], case['expected'])
+        if not equal:
+            failures += 1
+            print("Corpus mismatch for {!r}: expected {}, got {}".format(case['message'], in_cents(case['expected']),
+                                                                          actual))
+
+    for message in fuzz_messages(fuzz_count, seed=0):
+        equal, actual = results_equal(message, legacy_result(message))
+        if not equal:
+            failures += 1
+            print("Fuzz mismatch for {!r}: expected {}, got {}".format(message, in_cents(legacy_result(message)),
+                                                                        actual))
+
+    print("Parity: {} corpus messages and {} random messages, {} mismatches".format(
+        len(cases), fuzz_count, failures))
+    return failures == 0
+
+
+def throughput(parse, messages, seconds=1.0):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for message in messages:
+            parse(message)
+        count += len(messages)
+    return count / (time.perf_counter() - start)
+
+
+def worst_case(parse, message, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            parse(message)
+        except ArithmeticError:
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def legacy_worst_case(message, queue):
+    queue.put(worst_case(legacy_parser.parse_message, message, repeat=1))
+
+
+def format_worst_case(parse, message, timeout):
+    """Times a parse in a child process, since the old regexes backtrack for minutes on some inputs."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=parse, args=(message, queue))
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.terminate()
+        return "> {:.0f} s".format(timeout)
+    return "{:.3f} ms".format(queue.get() * 1000)
+
+
+def record():
+    messages = []
+    with open(CORPUS) as corpus:
+        messages = [json.loads(line)['message'] for line in corpus]
+    with open(CORPUS, 'w') as corpus:
+        for message in messages:
+            corpus.write(json.dumps({'message': message, 'expected': legacy_result(message)},
+                                    ensure_ascii=False) + '\n')
+    print("Recorded {} messages".format(len(messages)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--fuzz', type='int', default=20000, help="Number of random messages to compare")
+    parser.add_option('--timeout', type='float', default=10.0,
+                      help="Seconds after which the old parser is given up on for an adversarial input")
+    parser.add_option('--record', action='store_true', default=False,
+                      help="Rewrite the expected results of the corpus with the old parser's")
+    (opts, args) = parser.parse_args()
+
+    if opts.record:
+        record()
+        return
+
+    ok = check_parity(opts.fuzz)
+
+    with open(CORPUS) as corpus:
+        messages = [json.loads(line)['message'] for line in corpus]
+    messages = [m for m in messages if legacy_result(m) != 'ZeroDivisionError']
+    print()
+    print("{:<34} {:>14} {:>14}".format("", "regex", "tokenizer"))
+    print("{:<34} {:>14,.0f} {:>14,.0f}".format(
+        "corpus parses/s",
+        throughput(legacy_parser.parse_message, messages),
+        throughput(parse_transaction_exact, messages)))
+    for name, message in ADVERSARIAL.items():
+        print("{:<34} {:>14} {:>11.3f} ms".format(
+            name + " ({} B)".format(len(message.encode())),
+            format_worst_case(legacy_worst_case, message, opts.timeout),
+            worst_case(parse_transaction_exact, message) * 1000))
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
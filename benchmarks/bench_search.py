@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Measures /search on a large synthetic ledger: how long building the full-text index over the reasons takes and how
+big it gets, and the latency of searches by the heaviest user, a typical one and a light one, alone, narrowed down to
+a counterparty and limited to recent transactions.
+
+The synthetic ledger only has a handful of reasons, so --vocabulary random words are appended to them first, which
+gives both very common words and rare ones to look for.
+"""
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import schema  # noqa: E402
+from storage import Database, LedgerStore  # noqa: E402
+from synthetic import generate_ledger  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def add_words(path, vocabulary, seed=0):
+    rng = random.Random(seed)
+    words = ['word{}'.format(i) for i in range(vocabulary)]
+    db = sqlite3.connect(path)
+    db.create_function('add_word', 1, lambda reason: '{} {}'.format(reason, rng.choice(words)) if reason else reason)
+    db.execute('UPDATE transactions SET reason = add_word(reason)')
+    db.commit()
+    db.close()
+
+
+def index_size(db):
+    try:
+        return db.query("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE 'transactions_fts%'").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--users', type='int', default=20000)
+    parser.add_option('--transactions', type='int', default=1000000)
+    parser.add_option('--vocabulary', type='int', default=2000, help="Random words added to the reasons")
+    parser.add_option('--repeat', type='int', default=50, help="Searches per kind")
+    (opts, args) = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'ledger.db')
+        generate_ledger(path, users=opts.users, transactions=opts.transactions)
+        add_words(path, opts.vocabulary)
+
+        db = Database(path)
+        # Everything but the index first, so that its migration can be timed by itself
+        schema.LATEST_VERSION -= 1
+        schema.migrate(db)
+        schema.LATEST_VERSION += 1
+        start = time.perf_counter()
+        schema.migrate(db)
+        built = time.perf_counter() - start
+        size = index_size(db)
+        print("{} users, {} transactions".format(opts.users, opts.transactions))
+        print("index built in {:.1f} s{}".format(built, ", {:.1f} MB".format(size / 1e6) if size else ""))
+
+        ledger = LedgerStore(db)
+        rng = random.Random(1)
+        # User 1 is the heaviest user of the power-law ledger
+        users = [('heavy', 1), ('typical', opts.users // 100), ('light', opts.users // 2)]
+        since = datetime.datetime(2022, 6, 1)
+        print("\n{:<10} {:<22} {:>9} {:>9} {:>9}".format('user', 'search', 'p50 ms', 'p90 ms', 'p99 ms'))
+        for label, uid in users:
+            others = [row[0] for row in db.query('SELECT creditor FROM transactions WHERE debitor = :uid LIMIT 100',
+                                                 uid=uid)] or [None]
+            kinds = [
+                ('common word', lambda i: ledger.search(uid, 'pizza', limit=11)),
+                ('rare word', lambda i: ledger.search(uid, 'word{}'.format(rng.randrange(opts.vocabulary)),
+                                                      limit=11)),
+                ('prefix', lambda i: ledger.search(uid, 'gro', limit=11)),
+                ('two words', lambda i: ledger.search(uid, 'cinema word{}'.format(rng.randrange(opts.vocabulary)),
+                                                      limit=11)),
+                ('with someone', lambda i: ledger.search(uid, 'pizza', other=others[i % len(others)], limit=11)),
+                ('since a date', lambda i: ledger.search(uid, 'pizza', since=since, limit=11)),
+                ('page 5', lambda i: ledger.search(uid, 'pizza', limit=11, offset=40)),
+            ]
+            for name, func in kinds:
+                func(0)
+                timings = []
+                for i in range(opts.repeat):
+                    start = time.perf_counter()
+                    func(i)
+                    timings.append(time.perf_counter() - start)
+                print("{:<10} {:<22} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                    label, name, percentile(timings, 50) * 1000, percentile(timings, 90) * 1000,
+                    percentile(timings, 99) * 1000))
+
+        timings = []
+        for i in range(opts.repeat * 10):
+            creditor, debitor = rng.sample(range(1, opts.users + 1), 2)
+            start = time.perf_counter()
+            ledger.add_transaction(creditor, debitor, 100, 'for pizza at the station')
+            timings.append(time.perf_counter() - start)
+        print("\nadd_transaction with the index: p50 {:.2f} ms".format(percentile(timings, 50) * 1000))
+
+
+if __name__ == '__main__':
+    main()
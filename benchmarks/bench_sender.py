@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Pushes a burst of messages through the send queue against a fake bot, without reaching Telegram.
+
+The fake bot takes `--latency` seconds per call and enforces flood limits like Telegram's, raising RetryAfter when
+they are exceeded. The same burst is sent once straight to the bot, the way handlers used to, and once through the
+SendQueue. Reports how long the "handlers" were blocked, how long delivery took, how often the flood limits were hit
+and whether every chat got its messages in order.
+"""
+import math
+import os
+import random
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from telegram.error import RetryAfter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sender import SendQueue, TokenBucket  # noqa: E402
+
+
+class FakeBot:
+    """Records messages instead of sending them. Any object with these methods can be given to a SendQueue."""
+
+    def __init__(self, latency=0.05, global_rate=30, chat_rate=1, chat_burst=3):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(global_rate, global_rate, time.monotonic())
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.received = {}
+        self.flood_errors = 0
+
+    def _call(self, chat_id, text):
+        time.sleep(self.latency)
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst, now))
+            wait = max(bucket.wait_time(now), self.global_bucket.wait_time(now))
+            if wait:
+                self.flood_errors += 1
+                raise RetryAfter(math.ceil(wait))
+            bucket.take()
+            self.global_bucket.take()
+            self.received.setdefault(chat_id, []).append(text)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._call(chat_id, text)
+
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self._call(chat_id, text)
+
+
+def make_burst(chats, messages, seed):
+    rng = random.Random(seed)
+    # A few busy chats and many quiet ones, like a group chat next to private ones
+    weights = [1 / (i + 1) for i in range(chats)]
+    burst = []
+    for i in range(messages):
+        chat_id = rng.choices(range(chats), weights)[0]
+        burst.append((chat_id, "message {} to chat {}".format(i, chat_id)))
+    return burst
+
+
+def expected_texts(burst):
+    expected = {}
+    for chat_id, text in burst:
+        expected.setdefault(chat_id, []).append(text)
+    return expected
+
+
+def in_order(bot, burst):
+    """Whether every chat received all of its texts in order, possibly merged into fewer messages."""
+    for chat_id, texts in expected_texts(burst).items():
+        if "\n\n".join(bot.received.get(chat_id, [])) != "\n\n".join(texts):
+            return False
+    return True
+
+
+def run_direct(burst, latency):
+    bot = FakeBot(latency)
+    dropped = 0
+    start = time.perf_counter()
+    for chat_id, text in burst:
+        try:
+            bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter:
+            dropped += 1
+    elapsed = time.perf_counter() - start
+    print("{:<8} blocked {:>8.2f} s  delivered after {:>6.2f} s  {:>5d} flood errors  {:>5d} dropped".format(
+        "direct", elapsed, elapsed, bot.flood_errors, dropped))
+
+
+def run_queue(burst, latency, threads):
+    bot = FakeBot(latency)
+    queue = SendQueue(bot, threads=threads)
+    start = time.perf_counter()
+    for chat_id, text in burst:
+        queue.send_message(chat_id=chat_id, text=text)
+    blocked = time.perf_counter() - start
+    queue.stop(timeout=600)
+    elapsed = time.perf_counter() - start
+    print("{:<8} blocked {:>8.2f} s  delivered after {:>6.2f} s  {:>5d} flood errors  {:>5d} coalesced  "
+          "in order: {}".format("queue", blocked, elapsed, bot.flood_errors, queue.coalesced, in_order(bot, burst)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--chats', type='int', default=200)
+    parser.add_option('--messages', type='int', default=1000)
+    parser.add_option('--latency', type='float', default=0.05, help="Seconds per fake API call")
+    parser.add_option('--threads', type='int', default=4, help="Sender threads")
+    parser.add_option('--seed', type='int', default=1)
+    (opts, args) = parser.parse_args()
+
+    burst = make_burst(opts.chats, opts.messages, opts.seed)
+    print("{} messages to {} chats, {:.0f} ms per API call".format(opts.messages, opts.chats, opts.latency * 1000))
+    run_direct(burst, opts.latency)
+    run_queue(burst, opts.latency, opts.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Compares the sqlite3 storage layer with the dataset/SQLAlchemy path the bot used before.
+
+Measures how long a fresh interpreter takes to import each of them, and the cost of the bot's most frequent
+lookups on a synthetic ledger: a user by id, a user by username, an alias, and the balance of a pair. The dataset
+numbers are only reported if dataset is installed.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+
+import schema  # noqa: E402
+from storage import Database, UserStore, AliasStore, LedgerStore, pair_key  # noqa: E402
+from synthetic import generate_ledger  # noqa: E402
+
+try:
+    import dataset
+except ImportError:
+    dataset = None
+
+
+def import_time(module, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import {}'.format(module)], cwd=ROOT, check=True)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def per_call(func, keys):
+    func(keys[0])
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return (time.perf_counter() - start) / len(keys)
+
+
+def dataset_balance(db, uid1, uid2):
+    user_low, user_high, sign = pair_key(uid1, uid2)
+    row = db['balances'].find_one(user_low=user_low, user_high=user_high)
+    return sign * row['balance'] if row else 0
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--users', type='int', default=2000)
+    parser.add_option('--transactions', type='int', default=50000)
+    parser.add_option('--lookups', type='int', default=20000)
+    parser.add_option('--imports', type='int', default=5, help="Interpreter starts per module")
+    (opts, args) = parser.parse_args()
+
+    print("Import time in a fresh interpreter (median of {}):".format(opts.imports))
+    print("  {:<12} {:>8.0f} ms".format('python', import_time('sys', opts.imports) * 1000))
+    print("  {:<12} {:>8.0f} ms".format('storage', import_time('storage', opts.imports) * 1000))
+    if dataset:
+        print("  {:<12} {:>8.0f} ms".format('dataset', import_time('dataset', opts.imports) * 1000))
+    print("  {:<12} {:>8.0f} ms".format('debtbot', import_time('debtbot', opts.imports) * 1000))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'ledger.db')
+        generate_ledger(path, users=opts.users, transactions=opts.transactions)
+        db = Database(path)
+        schema.migrate(db)
+        users, aliases, ledger = UserStore(db), AliasStore(db), LedgerStore(db)
+
+        ids = [1 + i * 7919 % opts.users for i in range(opts.lookups)]
+        names = ['user{}'.format(uid) for uid in ids]
+        pairs = [(uid, 1 + uid * 31 % opts.users) for uid in ids]
+
+        lookups = [
+            ('user by id', ids, users.get, None),
+            ('user by name', names, users.get_by_username, None),
+            ('alias', ids, lambda uid: aliases.get(uid, 'alias0'), None),
+            ('balance', pairs, lambda pair: ledger.get_balance(*pair), None),
+        ]
+        if dataset:
+            old = dataset.connect('sqlite:///{}'.format(path))
+            lookups = [
+                (name, keys, func, old_func) for (name, keys, func, _), old_func in zip(lookups, [
+                    lambda uid: old['users'].find_one(user_id=uid),
+                    lambda name: old['users'].find_one(username_lower=name),
+                    lambda uid: old['aliases'].find_one(owner_id=uid, alias='alias0'),
+                    lambda pair: dataset_balance(old, *pair),
+                ])
+            ]
+
+        print("\nMicroseconds per lookup ({} users, {} transactions):".format(opts.users, opts.transactions))
+        print("  {:<14} {:>10} {:>10}".format('', 'storage', 'dataset' if dataset else ''))
+        for name, keys, func, old_func in lookups:
+            line = "  {:<14} {:>10.1f}".format(name, per_call(func, keys) * 1e6)
+            if old_func:
+                line += " {:>10.1f}".format(per_call(old_func, keys) * 1e6)
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
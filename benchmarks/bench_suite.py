@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Runs the bot's main operations against a synthetic ledger and compares them with saved baselines.
+
+Every operation is called --repeat times, directly or through a handler with stub Update, Context and Bot objects,
+and its latency percentiles and database queries per call are reported. With a baseline file from an earlier run
+with the same ledger size and --repeat, operations whose median got more than --tolerance slower, or which now need
+more queries, are marked as regressions and the script exits with status 1. Use --save to write the current numbers
+as the new baseline. Timings depend on the machine, so only compare against baselines recorded on the same one; the
+query counts don't.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from debtbot import DebtBot, DEBT_CMD, HISTORY_CMD  # noqa: E402
+from synthetic import generate_ledger  # noqa: E402
+
+BASELINES = os.path.join(HERE, 'baselines.json')
+
+MESSAGES = [
+    "I gave 15 to {name} for pizza",
+    "{name} owes me 40 for groceries",
+    "{name} gave me 12.30 for the cinema ticket",
+    "I owe {name} 7.5",
+    "{name} 10/3 cake",
+]
+
+
+class StubBot:
+    """Stands in for telegram.Bot and only counts what would have been sent."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.sent += 1
+
+    def send_document(self, chat_id, document, **kwargs):
+        self.sent += 1
+
+
+def stub_update(user, text, update_id=1):
+    from_user = SimpleNamespace(id=user['user_id'], first_name=user['first_name'], last_name=user['last_name'],
+                                username=user['username'])
+    chat = SimpleNamespace(id=user['user_id'], type='private')
+    message = SimpleNamespace(message_id=update_id, text=text, from_user=from_user, chat=chat)
+    return SimpleNamespace(update_id=update_id, message=message, effective_message=message, effective_chat=chat,
+                           effective_user=from_user, callback_query=None)
+
+
+class QueryCounter:
+    def __init__(self, db):
+        self.count = 0
+        db.listeners.append(self.on_execute)
+
+    def on_execute(self, seconds, queries=1):
+        self.count += queries
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(func, counter, repeat):
+    func(0)  # warm up SQLite's page cache and the bot's caches
+    timings = []
+    counter.count = 0
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        timings.append(time.perf_counter() - start)
+    return {
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p90_ms': round(percentile(timings, 90) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'queries': round(counter.count / repeat, 2),
+    }
+
+
+def operations(bot, context):
+    """Returns (name, function of the iteration number) for everything the suite measures."""
+    uid = 1  # the heaviest user of the power-law ledger
+    me = bot.get_user(uid)
+    # Counterparties of the heavy user who have a username, busiest first
+    others = [bot.get_user(row['other']) for row in bot.db.query(
+        'SELECT CASE WHEN user_low = :uid THEN user_high ELSE user_low END AS other FROM balances '
+        'JOIN users ON users.user_id = CASE WHEN user_low = :uid THEN user_high ELSE user_low END '
+        'WHERE (user_low = :uid OR user_high = :uid) AND users.username IS NOT NULL '
+        'ORDER BY users.user_id LIMIT 50', uid=uid)]
+
+    def other(i):
+        return others[i % len(others)]
+
+    def message(i):
+        return MESSAGES[i % len(MESSAGES)].format(name=other(i)['username'])
+
+    return [
+        ('parse_message', lambda i: bot.parse_message(message(i))),
+        ('get_debt', lambda i: bot.get_debt(uid, other(i)['user_id'])),
+        ('get_all_debts', lambda i: bot.get_all_debts(uid)),
+        ('get_all_debts_uncached', lambda i: (bot.debts_changed(uid), bot.get_all_debts(uid))),
+        ('get_debt_history_string',
+         lambda i: bot.get_debt_history_string(uid, other(i)['user_id'], bot.format_name(other(i)))),
+        ('dispatch_debt_by_username',
+         lambda i: bot.dispatch_command_for_user(DEBT_CMD, uid, other(i)['username'])),
+        ('dispatch_history_by_alias', lambda i: bot.dispatch_command_for_user(HISTORY_CMD, uid, 'alias0')),
+        ('dispatch_unknown_name', lambda i: bot.dispatch_command_for_user(DEBT_CMD, uid, 'alice smith')),
+        ('transaction_command', lambda i: bot.transaction_command(uid, other(i), 1250, 'for pizza')),
+        ('handle_message', lambda i: bot.handle_message(stub_update(me, message(i)), context)),
+        ('handle_debts', lambda i: bot.handle_debts(stub_update(me, '/debts'), context)),
+        ('handle_history',
+         lambda i: bot.handle_history(stub_update(me, '/history {}'.format(other(i)['username'])), context)),
+    ]
+
+
+def compare(results, baseline, tolerance, min_delta):
+    regressions = []
+    print("{:<28} {:>9} {:>9} {:>9} {:>8}  {}".format('operation', 'p50 ms', 'p90 ms', 'p99 ms', 'queries',
+                                                     'vs. baseline'))
+    for name, result in results.items():
+        note = ''
+        before = baseline.get(name)
+        if before:
+            change = (result['p50_ms'] - before['p50_ms']) / before['p50_ms'] if before['p50_ms'] else 0
+            note = '{:+.0%} p50, {:+g} queries'.format(change, round(result['queries'] - before['queries'], 2))
+            # Query counts are averages over the calls, which the caches make slightly uneven
+            slower = change > tolerance and result['p50_ms'] - before['p50_ms'] > min_delta
+            if slower or result['queries'] > before['queries'] + 0.1:
+                note += '  REGRESSION'
+                regressions.append(name)
+        print("{:<28} {:>9.3f} {:>9.3f} {:>9.3f} {:>8g}  {}".format(
+            name, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['queries'], note))
+    return regressions
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--users', type='int', default=2000)
+    parser.add_option('--transactions', type='int', default=50000)
+    parser.add_option('--repeat', type='int', default=200, help="Calls per operation")
+    parser.add_option('--baseline', default=BASELINES, help="JSON file with the baselines to compare against")
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help="How much slower the median may get before it counts as a regression")
+    parser.add_option('--min-delta', type='float', default=0.2,
+                      help="Milliseconds by which the median must get slower to count, so that noise in very fast "
+                           "operations doesn't")
+    parser.add_option('--save', action='store_true', help="Save the results as the new baselines")
+    (opts, args) = parser.parse_args()
+
+    ledger = {'users': opts.users, 'transactions': opts.transactions}
+    # The caches make the average query count depend on the number of calls, too
+    setup = dict(ledger, repeat=opts.repeat)
+    baselines = {}
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baselines = json.load(f)
+    baseline = baselines.get('operations', {})
+    if baseline and baselines.get('setup') != setup:
+        print("The baselines were recorded with {}, not comparing".format(baselines.get('setup')))
+        baseline = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'ledger.db')
+        generate_ledger(path, **ledger)
+
+        bot = DebtBot()
+        bot.connect({'db': path})
+        counter = QueryCounter(bot.db)
+        context = SimpleNamespace(bot=StubBot())
+
+        print("{} users, {} transactions, {} calls per operation".format(
+            opts.users, opts.transactions, opts.repeat))
+        results = {name: measure(func, counter, opts.repeat) for name, func in operations(bot, context)}
+
+    regressions = compare(results, baseline, opts.tolerance, opts.min_delta)
+
+    if opts.save:
+        with open(opts.baseline, 'w') as f:
+            json.dump({'setup': setup, 'operations': results}, f, indent=2)
+            f.write('\n')
+        print("Saved baselines to {}".format(opts.baseline))
+    elif regressions:
+        print("{} regressions: {}".format(len(regressions), ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Measures webhook ingestion without reaching Telegram.
+
+Starts the webhook listener and the bot's handlers on a synthetic ledger, then POSTs the recorded updates from
+webhook_updates.jsonl (or --updates) to it from a number of client threads. Everything the bot would send to
+Telegram is answered locally. Reports how quickly the listener acknowledges requests and how long it takes until
+the handlers are done with each update.
+"""
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+from queue import Queue
+
+from telegram import Bot
+from telegram.ext import Dispatcher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from debtbot import DebtBot  # noqa: E402
+from executor import KeyedExecutor  # noqa: E402
+from webhook import WebhookServer, SECRET_HEADER  # noqa: E402
+from synthetic import generate_ledger  # noqa: E402
+
+SECRET = 'benchmark-secret'
+PATH = '/telegram'
+
+
+class FakeRequest:
+    """Stands in for telegram.utils.request.Request and answers every API call locally."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def post(self, url, data=None, timeout=None):
+        with self.lock:
+            self.calls += 1
+        method = url.rsplit('/', 1)[-1]
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Debt Bot', 'username': 'debt_bot'}
+        if method in ('sendMessage', 'editMessageText'):
+            return {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': (data or {}).get('chat_id', 0), 'type': 'private'},
+                'text': (data or {}).get('text', ''),
+            }
+        return True
+
+    def stop(self):
+        pass
+
+
+class TimedDebtBot(DebtBot):
+    """Records when the handlers are done with an update."""
+
+    def __init__(self):
+        super().__init__()
+        self.done = {}
+
+    def ordered(self, handler):
+        def timed(update, context):
+            try:
+                handler(update, context)
+            finally:
+                self.done[update.update_id] = time.perf_counter()
+
+        return super().ordered(timed)
+
+
+def load_updates(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def post_all(port, bodies, sent, acks, wrong_secret=False):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json', SECRET_HEADER: 'nope' if wrong_secret else SECRET}
+    for update_id, body in bodies:
+        sent[update_id] = time.perf_counter()
+        conn.request('POST', PATH, body, headers)
+        response = conn.getresponse()
+        response.read()
+        acks.append((time.perf_counter() - sent[update_id], response.status))
+    conn.close()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--updates', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        'webhook_updates.jsonl'),
+                      help="JSONL file of recorded Update objects")
+    parser.add_option('--count', type='int', default=2000, help="Number of updates to POST")
+    parser.add_option('--clients', type='int', default=4, help="Number of concurrent HTTP clients")
+    parser.add_option('--workers', type='int', default=1, help="Bot worker threads, as in config.yml")
+    parser.add_option('--users', type='int', default=500)
+    parser.add_option('--transactions', type='int', default=20000)
+    (opts, args) = parser.parse_args()
+
+    recorded = load_updates(opts.updates)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'ledger.db')
+        generate_ledger(path, users=opts.users, transactions=opts.transactions)
+
+        bot = TimedDebtBot()
+        bot.connect({'db': path})
+        if opts.workers > 1:
+            bot.executor = KeyedExecutor(opts.workers)
+
+        dispatcher = Dispatcher(Bot('123456:benchmark', request=FakeRequest()), Queue(), workers=1,
+                                use_context=True)
+        bot.add_handlers(dispatcher)
+        dispatcher_thread = threading.Thread(target=dispatcher.start)
+        dispatcher_thread.start()
+
+        server = WebhookServer(('127.0.0.1', 0), PATH, SECRET, dispatcher)
+        port = server.server_address[1]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        # Replay the recording over and over, giving every copy a fresh update_id
+        bodies = []
+        for i in range(opts.count):
+            update = dict(recorded[i % len(recorded)], update_id=i + 1)
+            bodies.append((i + 1, json.dumps(update)))
+
+        rejected = []
+        post_all(port, bodies[:1], {}, rejected, wrong_secret=True)
+        print("wrong secret token answered with HTTP {}".format(rejected[0][1]))
+
+        sent = {}
+        acks = []
+        start = time.perf_counter()
+        clients = [threading.Thread(target=post_all, args=(port, bodies[i::opts.clients], sent, acks))
+                   for i in range(opts.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        posted = time.perf_counter()
+
+        while len(bot.done) < opts.count and time.perf_counter() - posted < 60:
+            time.sleep(0.01)
+        finished = time.perf_counter()
+
+        server.shutdown()
+        server.server_close()
+        dispatcher.stop()
+        dispatcher_thread.join()
+        if bot.executor:
+            bot.executor.shutdown()
+
+    ack_times = [a for a, status in acks]
+    handled = [bot.done[i] - sent[i] for i in bot.done if i in sent]
+    print("{} updates, {} clients, {} workers".format(opts.count, opts.clients, opts.workers))
+    print("HTTP status codes:  {}".format(sorted({status for a, status in acks})))
+    print("acknowledged:       {:>8.0f} updates/s  p50 {:.2f} ms  p99 {:.2f} ms".format(
+        opts.count / (posted - start), percentile(ack_times, 50) * 1000, percentile(ack_times, 99) * 1000))
+    print("handled:            {:>8.0f} updates/s  p50 {:.2f} ms  p99 {:.2f} ms".format(
+        len(handled) / (finished - start), percentile(handled, 50) * 1000, percentile(handled, 99) * 1000))
+    if len(handled) < opts.count:
+        print("only {} of {} updates were handled".format(len(handled), opts.count))
+
+
+if __name__ == '__main__':
+    main()
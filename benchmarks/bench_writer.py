@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Measures how many transactions per second the ledger takes from concurrent threads, with every thread committing
+its own writes and with the group-commit writer committing them in batches.
+
+Each of --threads threads records --transactions transactions between random pairs of a synthetic ledger, the way
+transaction_command does, and reads the balance afterwards. Reports the throughput and latency percentiles of the
+writes, and how many commits the writer needed.
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import schema  # noqa: E402
+from storage import Database, LedgerStore  # noqa: E402
+from synthetic import generate_ledger  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(path, opts, writer):
+    db = Database(path)
+    schema.migrate(db)
+    ledger = LedgerStore(db)
+    if writer:
+        db.start_writer(max_delay=opts.max_delay_ms / 1000)
+    timings = []
+
+    def work(seed):
+        rng = random.Random(seed)
+        for _ in range(opts.transactions):
+            creditor, debitor = rng.sample(range(1, opts.users + 1), 2)
+            start = time.perf_counter()
+            ledger.add_transaction(creditor, debitor, rng.randint(1, 10000), 'for pizza')
+            ledger.get_balance(creditor, debitor)
+            timings.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(opts.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    commits = ''
+    if writer:
+        commits = '{} commits'.format(db.writer.batches)
+        db.stop_writer()
+    drift = ledger.rebuild_balances(fix=False)
+    print("{:<14} {:>8.0f}/s {:>9.2f} {:>9.2f} {:>9.2f}  {}{}".format(
+        'group commit' if writer else 'per write', len(timings) / elapsed,
+        percentile(timings, 50) * 1000, percentile(timings, 90) * 1000, percentile(timings, 99) * 1000,
+        commits, '  DRIFT' if drift else ''))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--users', type='int', default=2000)
+    parser.add_option('--ledger', type='int', default=50000, help="Transactions in the synthetic ledger")
+    parser.add_option('--threads', type='int', default=8)
+    parser.add_option('--transactions', type='int', default=250, help="Transactions per thread")
+    parser.add_option('--max-delay-ms', type='float', default=0)
+    (opts, args) = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print("{} threads writing {} transactions each".format(opts.threads, opts.transactions))
+        print("{:<14} {:>10} {:>9} {:>9} {:>9}".format('', 'writes', 'p50 ms', 'p90 ms', 'p99 ms'))
+        for writer in (False, True):
+            path = os.path.join(tmp, 'ledger-{}.db'.format(writer))
+            generate_ledger(path, users=opts.users, transactions=opts.ledger)
+            run(path, opts, writer)
+
+
+if __name__ == '__main__':
+    main()
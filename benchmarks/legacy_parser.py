@@ -0,0 +1,79 @@
+"""
+The regular expression parser that transaction_parser.py replaced, kept verbatim as the reference
+for the parity checks in bench_parser.py.
+"""
+import re
+
+# Match this first, because the X_TO_ME regex will capture stuff that should be parsed by this one.
+I_TO_X_PATTERN = re.compile(
+    '^i?\\s*(g[ia]ve|g[eo]t|owe[sd]?)\\s+(-?\\d+\\.?\\d*)(/\\d+)?\\s+(?:to|from)?\\s*@?(.+?)(?:\\s+((?:because(?:\\s+of)?|for|in|by|with|via|through|to|from|and)\\s+.*))?$',
+    flags=re.I
+)
+I_GIVE_X_PATTERN = re.compile(
+    '^i?\\s*(g[ia]ve|owe[sd]?)\\s+@?(.+?)\\s+(-?\\d+\\.?\\d*)(/\\d+)?\\s*((?:because(?:\\s+of)?|for|in|by|with|via|through|to|from|and)\\s*.*)?$',
+    flags=re.I
+)
+# This will falsely match the "I gave X to Y" pattern as well, so match the other one before this
+X_TO_ME_PATTERN = re.compile(
+    '^\\s*@?(.+?)\\s+(g[ia]ve|g[eo]t|owe[sd]?)\\s+(?:me)?\\s*(-?\\d+\\.?\\d*)(/\\d+)?(?:\\s+(?:to|from)?\\s*me\\s*)?\\s*((?:because(?:\\s+of)?|for|in|by|with|via|through|to|from|and)?\\s*.*)$',
+    flags=re.I
+)
+
+# Match this one last
+SHORTHAND_PATTERN = re.compile(
+    '^@?(.+?)\\s*(-?\\d+\\.?\\d*)(/\\d+)?\\s*(.+)?$',
+    flags=re.I
+)
+
+RECEIVE_PATTERN = re.compile('g[eo]t|owe[sd]?', re.I)
+
+
+def parse_message(message):
+    match = I_TO_X_PATTERN.match(message)
+    if match:
+        groups = match.groups()
+        direction = groups[0]
+        amount_str = groups[1]
+        divisor_str = groups[2]
+        recipient = groups[3]
+        reason = groups[4]
+        amount = float(amount_str)
+    else:
+        match = X_TO_ME_PATTERN.match(message)
+        if match:
+            groups = match.groups()
+            direction = groups[1]
+            amount_str = groups[2]
+            divisor_str = groups[3]
+            recipient = groups[0]
+            reason = groups[4]
+            amount = float(amount_str) * -1  # direction in the regex is reversed, so unreverse here for uniformity
+        else:
+            match = I_GIVE_X_PATTERN.match(message)
+            if match:
+                groups = match.groups()
+                direction = groups[0]
+                amount_str = groups[2]
+                divisor_str = groups[3]
+                recipient = groups[1]
+                reason = groups[4]
+                amount = float(amount_str)
+            else:
+                match = SHORTHAND_PATTERN.match(message)
+                if not match:
+                    return None, None, None
+                groups = match.groups()
+                direction = 'give'
+                amount_str = groups[1]
+                divisor_str = groups[2]
+                recipient = groups[0]
+                reason = 'for ' + groups[3] if groups[3] else None
+                amount = float(amount_str)
+
+    if RECEIVE_PATTERN.match(direction):
+        amount *= -1
+    if divisor_str:
+        divisor = int(divisor_str.strip('/'))
+        amount = amount / divisor
+
+    return str(amount), recipient, reason or ""
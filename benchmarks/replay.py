@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Replays updates recorded with the bot's `record` option against a scratch copy of a database, to see how a change to
+the storage layer or the parser holds up under real traffic before it is deployed.
+
+The updates go through the bot's own handlers, paced as they were recorded and sped up --speed times; --speed 0
+replays them as fast as possible. Telegram is answered locally, and every reply is kept. Reports the throughput, the
+latency percentiles of handling an update, and how far the replay fell behind the recording. With --save, the replies
+are written to a file; with --compare, they are checked against such a file from an earlier replay of the same
+recording, e.g. with the code before a change, and the script exits with status 1 if any update got a different
+reply. Dates and affirmations are masked, since they change from run to run anyway.
+
+The recording has anonymous user ids, so a copy of the production database only matches it if its ids are
+anonymized with the same key, which --key does. Without --db, the replay starts from an empty database.
+
+Inline keyboard buttons carry tokens that are only valid in the run which created them. A recorded button press is
+therefore pointed at the button in the same place of the newest keyboard the replay sent to that chat, preferring one
+with the same text.
+"""
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+from queue import Queue
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from telegram import Bot, Update  # noqa: E402
+from telegram.ext import Dispatcher  # noqa: E402
+
+from debtbot import DebtBot, AFFIRMATIONS  # noqa: E402
+from executor import KeyedExecutor  # noqa: E402
+from recorder import anonymize_id  # noqa: E402
+
+# Parts of replies which differ between runs even if nothing changed
+VOLATILE = [
+    (re.compile(r'\d{4}-\d{2}-\d{2}'), '<date>'),
+    (re.compile(r'\b(?:{})\b'.format('|'.join(map(re.escape, AFFIRMATIONS)))), '<affirmation>'),
+]
+
+# Columns holding user ids, which --key anonymizes. Balances and checkpoints are rebuilt from the ledger afterwards.
+USER_ID_COLUMNS = [
+    ('users', 'user_id'),
+    ('aliases', 'owner_id'),
+    ('aliases', 'target_id'),
+    ('transactions', 'creditor'),
+    ('transactions', 'debitor'),
+    ('transactions_archive', 'creditor'),
+    ('transactions_archive', 'debitor'),
+]
+
+
+def normalize(text):
+    for pattern, replacement in VOLATILE:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class ReplayRequest:
+    """Stands in for telegram.utils.request.Request, answers every API call locally and keeps what was sent."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.replies = {}
+        self.keyboards = {}
+        self.message_id = 0
+
+    def add_reply(self, update_id, reply):
+        with self.lock:
+            self.replies.setdefault(update_id, []).append(reply)
+
+    def post(self, url, data=None, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        data = data or {}
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Debt Bot', 'username': 'debt_bot'}
+
+        reply = {'method': method}
+        if 'chat_id' in data:
+            reply['chat_id'] = data['chat_id']
+        if data.get('text'):
+            reply['text'] = normalize(data['text'])
+        keyboard = None
+        if data.get('reply_markup'):
+            markup = data['reply_markup']
+            keyboard = (json.loads(markup) if isinstance(markup, str) else markup).get('inline_keyboard')
+            reply['buttons'] = [[button['text'] for button in row] for row in keyboard or []]
+        if 'document' in data:
+            reply['filename'] = getattr(data['document'], 'filename', None)
+        self.add_reply(getattr(self.local, 'update_id', None), reply)
+
+        if method not in ('sendMessage', 'editMessageText'):
+            return True
+        with self.lock:
+            if method == 'sendMessage':
+                self.message_id += 1
+                message_id = self.message_id
+            else:
+                message_id = data['message_id']
+            chat = self.keyboards.setdefault(data['chat_id'], {})
+            chat.pop(message_id, None)
+            if keyboard:
+                chat[message_id] = (normalize(data['text']), keyboard)
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': data['chat_id'], 'type': 'private'},
+            'text': data['text'],
+        }
+
+    def point_button(self, query):
+        """
+        Points a recorded button press at the matching button the replay sent, and returns whether there was one.
+        """
+        message = query.message
+        recorded = message.reply_markup.inline_keyboard if message.reply_markup else []
+        position = next(((r, c) for r, row in enumerate(recorded) for c, button in enumerate(row)
+                         if button.callback_data == query.data), None)
+        if position is None:
+            return False
+        row, column = position
+        with self.lock:
+            keyboards = list(self.keyboards.get(message.chat.id, {}).items())
+        # Newest first, preferring a keyboard that came with the same text
+        text = normalize(message.text or '')
+        keyboards.sort(key=lambda item: (item[1][0] == text, item[0]), reverse=True)
+        for message_id, (_, keyboard) in keyboards:
+            if row < len(keyboard) and column < len(keyboard[row]):
+                query.data = keyboard[row][column]['callback_data']
+                message.message_id = message_id
+                return True
+        return False
+
+
+class ReplayBot(DebtBot):
+    """Notes which update every reply belongs to, and when the handlers are done with an update."""
+
+    def __init__(self, request):
+        super().__init__()
+        self.request = request
+        self.done = {}
+        self.unmatched = 0
+
+    def ordered(self, handler):
+        def replayed(update, context):
+            self.request.local.update_id = update.update_id
+            if update.callback_query and not self.request.point_button(update.callback_query):
+                self.unmatched += 1
+            try:
+                handler(update, context)
+            finally:
+                self.request.local.update_id = None
+                self.done[update.update_id] = time.perf_counter()
+
+        return super().ordered(replayed)
+
+    def handle_error(self, update, context):
+        super().handle_error(update, context)
+        self.request.add_reply(getattr(update, 'update_id', None),
+                               {'method': 'error', 'text': type(context.error).__name__})
+
+
+def load_recording(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def scratch_copy(source, path):
+    """Copies a database, including what is still in its write-ahead log."""
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(path)
+    src.backup(dst)
+    dst.close()
+    src.close()
+
+
+def anonymize_database(bot, key):
+    """Replaces all user ids in the bot's database the way recorder.UpdateRecorder does with the same key."""
+    bot.db.connection.create_function('anonymize_id', 1, lambda id: anonymize_id(key, id), deterministic=True)
+    with bot.db as tx:
+        for table, column in USER_ID_COLUMNS:
+            tx.query('UPDATE {table} SET {column} = anonymize_id({column})'.format(table=table, column=column))
+        tx.query('DELETE FROM pending_actions')
+        bot.ledger.rebuild_balances(fix=True)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def compare(replies, path, show):
+    """Prints the updates whose replies differ from those saved in a file, and returns how many there are."""
+    with open(path) as f:
+        expected = {entry['update']: entry['replies'] for entry in map(json.loads, filter(str.strip, f))}
+    diverged = [update_id for update_id in sorted(set(expected) | set(replies))
+                if expected.get(update_id, []) != replies.get(update_id, [])]
+    for update_id in diverged[:show]:
+        print("update {}:".format(update_id))
+        print("  before: {}".format(json.dumps(expected.get(update_id, []), ensure_ascii=False)))
+        print("  now:    {}".format(json.dumps(replies.get(update_id, []), ensure_ascii=False)))
+    return len(diverged)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] RECORDING")
+    parser.add_option('--db', help="Database to start from, which is copied and left alone")
+    parser.add_option('--key', help="Anonymize the user ids of the copy with this key, as the recording was")
+    parser.add_option('--speed', type='float', default=1, help="Replay this many times faster than recorded, or as "
+                                                               "fast as possible with 0")
+    parser.add_option('--workers', type='int', default=1, help="Bot worker threads, as in config.yml")
+    parser.add_option('--decimals', type='int', help="Decimals of amounts, as in config.yml")
+    parser.add_option('--seed', type='int', default=0, help="Seed for the bot's random affirmations")
+    parser.add_option('--save', help="Write the replies to this file")
+    parser.add_option('--compare', help="Compare the replies with this file from an earlier replay")
+    parser.add_option('--show', type='int', default=5, help="How many differing updates to print")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Which recording should be replayed?")
+
+    recording = load_recording(args[0])
+    random.seed(opts.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'replay.db')
+        if opts.db:
+            scratch_copy(opts.db, path)
+
+        request = ReplayRequest()
+        bot = ReplayBot(request)
+        config = {'db': path}
+        if opts.decimals is not None:
+            config['decimals'] = opts.decimals
+        bot.connect(config)
+        if opts.key:
+            anonymize_database(bot, opts.key.encode())
+        if opts.workers > 1:
+            bot.executor = KeyedExecutor(opts.workers)
+
+        dispatcher = Dispatcher(Bot('123456:replay', request=request), Queue(), workers=1, use_context=True)
+        bot.add_handlers(dispatcher)
+
+        first = recording[0]['time'] if recording else 0
+        submitted = {}
+        lag = 0
+        start = time.perf_counter()
+        # Every update gets a new id, in case the recording spans restarts of the bot
+        for update_id, entry in enumerate(recording, 1):
+            if opts.speed:
+                due = start + (entry['time'] - first) / opts.speed
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                lag = max(lag, time.perf_counter() - due)
+            update = Update.de_json(dict(entry['update'], update_id=update_id), dispatcher.bot)
+            submitted[update_id] = time.perf_counter()
+            dispatcher.process_update(update)
+        if bot.executor:
+            bot.executor.shutdown()
+        finished = time.perf_counter()
+        bot.db.stop_writer()
+
+    latencies = [bot.done[i] - submitted[i] for i in bot.done]
+    print("{} updates recorded over {:.1f} s, replayed in {:.1f} s with {} workers".format(
+        len(recording), recording[-1]['time'] - first if recording else 0, finished - start, opts.workers))
+    if latencies:
+        print("handled:   {:>8.0f} updates/s  p50 {:.2f} ms  p90 {:.2f} ms  p99 {:.2f} ms  max {:.2f} ms".format(
+            len(latencies) / (finished - start), percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000, max(latencies) * 1000))
+    if opts.speed:
+        print("fell behind the recording by up to {:.1f} ms".format(lag * 1000))
+    if len(bot.done) < len(recording):
+        print("{} updates weren't handled by any handler".format(len(recording) - len(bot.done)))
+    if bot.unmatched:
+        print("{} button presses had no matching button in the replay".format(bot.unmatched))
+
+    replies = {update_id: replies for update_id, replies in request.replies.items() if update_id is not None}
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            for update_id in range(1, len(recording) + 1):
+                f.write(json.dumps({'update': update_id, 'replies': replies.get(update_id, [])},
+                                   ensure_ascii=False) + '\n')
+        print("Saved the replies to {}".format(opts.save))
+    if opts.compare:
+        diverged = compare(replies, opts.compare, opts.show)
+        print("{} of {} updates got different replies than in {}".format(diverged, len(recording), opts.compare))
+        if diverged:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Generates synthetic debt bot ledgers for benchmarking.
+
+The tables have the same shape as the ones the bot creates, so a generated file can be
+used as the `db` of a config file or opened directly with DebtBot.connect().
+"""
+import datetime
+import itertools
+import random
+import sqlite3
+
+FIRST_NAMES = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank", "Grace", "Heidi", "Ivan", "Judy",
+               "Mallory", "Niaj", "Olivia", "Peggy", "Rupert", "Sybil", "Trent", "Victor", "Walter", "Zoe"]
+LAST_NAMES = ["Smith", "Meier", "Rossi", "Novak", "Garcia", "Kim", "Nguyen", "Silva", "Jensen", "Dubois", None]
+REASONS = ["for pizza", "for groceries", "for the cinema ticket", "in cash", "for rent", "via bank transfer",
+           "because of the bet", "for drinks", None]
+
+
+def power_law_weights(count, alpha):
+    return list(itertools.accumulate(1.0 / (rank ** alpha) for rank in range(1, count + 1)))
+
+
+def generate_ledger(path, users=1000, transactions=100000, aliases=2, alpha=1.2, seed=0):
+    """
+    Writes a ledger with the given number of users and transactions to the SQLite file at path.
+    Both sides of a transaction are drawn from a power-law distribution over the users, so a few heavy
+    users trade with hundreds of counterparties while most users only have a handful.
+    User ids are 1..users, with user 1 being the heaviest. Every user gets `aliases` aliases.
+    """
+    rng = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.executescript(
+        'DROP TABLE IF EXISTS users;'
+        'DROP TABLE IF EXISTS transactions;'
+        'DROP TABLE IF EXISTS aliases;'
+        'DROP TABLE IF EXISTS balances;'
+        'CREATE TABLE users (id INTEGER PRIMARY KEY, user_id INTEGER, first_name TEXT, last_name TEXT, '
+        'username TEXT, username_lower TEXT);'
+        'CREATE TABLE transactions (id INTEGER PRIMARY KEY, creditor INTEGER, debitor INTEGER, amount FLOAT, '
+        'reason TEXT, timestamp DATETIME);'
+        'CREATE TABLE aliases (id INTEGER PRIMARY KEY, owner_id INTEGER, target_id INTEGER, alias TEXT);'
+    )
+
+    user_rows = []
+    for uid in range(1, users + 1):
+        username = "user{}".format(uid) if rng.random() < 0.8 else None
+        user_rows.append((uid, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), username,
+                          username.lower() if username else None))
+    db.executemany('INSERT INTO users (user_id, first_name, last_name, username, username_lower) '
+                   'VALUES (?, ?, ?, ?, ?)', user_rows)
+
+    weights = power_law_weights(users, alpha)
+    start = datetime.datetime(2018, 1, 1)
+    step = datetime.timedelta(days=365 * 5) / max(transactions, 1)
+
+    def transaction_rows():
+        for i in range(transactions):
+            creditor, debitor = rng.choices(range(1, users + 1), cum_weights=weights, k=2)
+            if creditor == debitor:
+                debitor = creditor % users + 1
+            yield (creditor, debitor, round(rng.uniform(0.5, 120), 2), rng.choice(REASONS),
+                   str(start + step * i))
+
+    db.executemany('INSERT INTO transactions (creditor, debitor, amount, reason, timestamp) '
+                   'VALUES (?, ?, ?, ?, ?)', transaction_rows())
+
+    alias_rows = []
+    for owner in range(1, users + 1):
+        for n in range(aliases):
+            target = rng.choices(range(1, users + 1), cum_weights=weights)[0]
+            alias_rows.append((owner, target, "alias{}".format(n)))
+    db.executemany('INSERT INTO aliases (owner_id, target_id, alias) VALUES (?, ?, ?)', alias_rows)
+
+    db.commit()
+    db.close()
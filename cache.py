@@ -0,0 +1,71 @@
+"""Small in-process caches for data that is read far more often than it changes."""
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """
+    A thread-safe, bounded mapping that evicts the least recently used entry once it is full.
+    None is a valid value, so negative lookups can be cached as well; get() returns MISSING for keys
+    that are not in the cache.
+
+    A value that took a while to compute may be outdated by the time it is put into the cache. Passing the
+    version() from before it was computed to put() drops it if anything was invalidated in the meantime.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def version(self):
+        return self._version
+
+    def put(self, key, value, version=None):
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
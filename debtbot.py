@@ -4,43 +4,47 @@ import random
 import re
 import yaml
 import logging
-import dataset
 import datetime
-from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+import io
+import itertools
+import sys
+import tempfile
+import time
+import hashlib
+import signal
+import threading
+import schema
+from executor import KeyedExecutor
+from webhook import WebhookServer
+from metrics import Metrics, MetricsServer
+from sender import SendQueue
+from recorder import UpdateRecorder
+from cache import LRUCache, MISSING
+from names import normalize_name
+from storage import Database, UserStore, AliasStore, LedgerStore, PendingActionStore, WRITE_BATCH_SIZE
+from pending import PendingActions, DEFAULT_TTL, MAX_ENTRIES
+from settle import plan_settlement
+from transaction_parser import parse_transaction_exact, parse_split
+from money import DEFAULT_DECIMALS, to_minor, format_amount, split_amount, split_weighted
+from ledger_io import LedgerImportError, MAX_IMPORT_ERRORS, guess_format, parse_record, read_records, write_records
+from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler
+from telegram import Update, Chat, InlineKeyboardMarkup, InlineKeyboardButton
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
-# Match this first, because the X_TO_ME regex will capture stuff that should be parsed by this one.
-I_TO_X_PATTERN = re.compile(
-    '^i?\\s*(g[ia]ve|g[eo]t|owe[sd]?)\\s+(-?\\d+\\.?\\d*)(/\\d+)?\\s+(?:to|from)?\\s*@?(.+?)(?:\\s+((?:because(?:\\s+of)?|for|in|by|with|via|through|to|from|and)\\s+.*))?$',
-    flags=re.I
-)
-I_GIVE_X_PATTERN = re.compile(
-    '^i?\\s*(g[ia]ve|owe[sd]?)\\s+@?(.+?)\\s+(-?\\d+\\.?\\d*)(/\\d+)?\\s*((?:because(?:\\s+of)?|for|in|by|with|via|through|to|from|and)\\s*.*)?$',
-    flags=re.I
-)
-# This will falsely match the "I gave X to Y" pattern as well, so match the other one before this
-X_TO_ME_PATTERN = re.compile(
-    '^\\s*@?(.+?)\\s+(g[ia]ve|g[eo]t|owe[sd]?)\\s+(?:me)?\\s*(-?\\d+\\.?\\d*)(/\\d+)?(?:\\s+(?:to|from)?\\s*me\\s*)?\\s*((?:because(?:\\s+of)?|for|in|by|with|via|through|to|from|and)?\\s*.*)$',
-    flags=re.I
-)
-
-# Match this one last
-SHORTHAND_PATTERN = re.compile(
-    '^@?(.+?)\\s*(-?\\d+\\.?\\d*)(/\\d+)?\\s*(.+)?$',
-    flags=re.I
-)
-
 ALIAS_PATTERN = re.compile(
     '^/alias\\s+(.+?)\\s*=\\s*@?(.+?)\\s*$',
     flags=re.I
 )
 
-RECEIVE_PATTERN = re.compile('g[eo]t|owe[sd]?', re.I)
+# What to look for, then optionally @someone, then optionally "since" a date
+SEARCH_PATTERN = re.compile(
+    '^(.*?)\\s*(?:@(\\S+))?\\s*(?:\\bsince\\s+(\\S+))?\\s*$',
+    flags=re.I
+)
 
 AFFIRMATIONS = [
     "Cool",
@@ -58,233 +62,559 @@ HISTORY_CMD = "h"
 DEBT_CMD = "d"
 TRANSACTION_CMD = "g"
 ALIAS_CMD = "a"
+BALANCE_CMD = "b"
+EXPORT_CMD = "e"
+SETTLE_CMD = "s"
+SEARCH_CMD = "f"
+
+# Choice of the "None of these people" button
+CANCEL_CHOICE = "x"
+
+HISTORY_OLDER = "o"
+HISTORY_NEWER = "n"
+HISTORY_ARCHIVE = "a"
+HISTORY_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE = 10
+MAX_REASON_LENGTH = 150
 
 MAX_MESSAGE_LENGTH = 4000
 
+USER_CACHE_SIZE = 10000
+ALIAS_CACHE_SIZE = 10000
+# Summaries of heavy users can run into tens of kilobytes, so fewer of them are kept
+DEBT_SUMMARY_CACHE_SIZE = 2000
+# How often the cached summaries are checked against bulk changes made by other processes, in seconds
+LEDGER_CHECK_INTERVAL = 1
+
+MAX_SETTLE_LINES = 50
+SETTLE_REASON = "settled up with /settle"
+
+# Telegram doesn't let bots send bigger files
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+MAX_NAME_CANDIDATES = 8
+
+MAX_SPLIT_PEOPLE = 50
+
+DIGEST_TIME = "18:00"
+
 
 def wrap_message(message):
     return [message[i:i + MAX_MESSAGE_LENGTH] for i in range(0, len(message), MAX_MESSAGE_LENGTH)]
 
 
+def plural(n, one, many):
+    return "{} {}".format(n, one if n == 1 else many)
+
+
 class DebtBot:
     def __init__(self):
         self.db = None
+        self.user_store = None
+        self.alias_store = None
+        self.ledger = None
+        self.decimals = DEFAULT_DECIMALS
+        self.executor = None
+        self.sender = None
+        self.recorder = None
+        self.metrics = Metrics()
+        self.slow_update_ms = None
+        self.users_by_id = LRUCache(USER_CACHE_SIZE)
+        self.users_by_name = LRUCache(USER_CACHE_SIZE)
+        self.aliases = LRUCache(ALIAS_CACHE_SIZE)
+        self.debt_summaries = LRUCache(DEBT_SUMMARY_CACHE_SIZE)
+        self.ledger_version = None
+        self.ledger_checked = 0.0
+        self.pending = PendingActions()
+        self.digest_schedule = None
+        self.digests_sent = 0
+        self.digest_seconds = 0.0
 
     def register_user(self, user, force=False):
-        users = self.db['users']
         id = user.id
-        stored = users.find_one(user_id=id)
+        stored = self.get_user(id)
         if not stored or force:
             new_user = {
                 'user_id': id,
                 'first_name': user.first_name,
                 'last_name': user.last_name,
                 'username': user.username,
-                'username_lower': user.username.lower() if user.username else None
+                'username_lower': user.username.lower() if user.username else None,
+                'full_name': normalize_name(user.first_name, user.last_name),
             }
-            print(new_user)
-            users.upsert(new_user, ['user_id'])
+            logger.debug("Registering user %s", new_user)
+            self.user_store.put(new_user)
+            self.users_by_id.invalidate(id)
+            self.users_by_name.invalidate(new_user['username_lower'])
+            if stored:
+                self.users_by_name.invalidate(stored['username_lower'])
+                if (stored['first_name'], stored['last_name']) != (user.first_name, user.last_name):
+                    # Everyone who has debts with them sees their name in /debts
+                    self.debts_changed(*self.ledger.get_counterparties(id))
         if not stored:
             return True
         return False
 
+    def cache_stats(self):
+        return {
+            'users_by_id': self.users_by_id.stats(),
+            'users_by_name': self.users_by_name.stats(),
+            'aliases': self.aliases.stats(),
+            'debt_summaries': self.debt_summaries.stats(),
+        }
+
+    def debts_changed(self, *uids):
+        """Forgets the /debts summaries of users whose balances, or the names of whose counterparties, changed."""
+        for uid in uids:
+            self.debt_summaries.invalidate(int(uid))
+
+    def check_ledger_version(self):
+        """
+        Forgets all /debts summaries if the ledger was changed in bulk since the last look, e.g. by an import or
+        archive run from the command line while the bot is running. Looks at most every LEDGER_CHECK_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if now - self.ledger_checked < LEDGER_CHECK_INTERVAL:
+            return
+        self.ledger_checked = now
+        version = self.ledger.get_version()
+        if version != self.ledger_version:
+            self.ledger_version = version
+            self.debt_summaries.clear()
+
     @staticmethod
     def get_affirmation():
         return random.choice(AFFIRMATIONS)
 
-    @staticmethod
-    def parse_message(message):
-        match = I_TO_X_PATTERN.match(message)
-        if match:
-            groups = match.groups()
-            direction = groups[0]
-            amount_str = groups[1]
-            divisor_str = groups[2]
-            recipient = groups[3]
-            reason = groups[4]
-            amount = float(amount_str)
-        else:
-            match = X_TO_ME_PATTERN.match(message)
-            if match:
-                groups = match.groups()
-                direction = groups[1]
-                amount_str = groups[2]
-                divisor_str = groups[3]
-                recipient = groups[0]
-                reason = groups[4]
-                amount = float(amount_str) * -1  # direction in the regex is reversed, so unreverse here for uniformity
-            else:
-                match = I_GIVE_X_PATTERN.match(message)
-                if match:
-                    groups = match.groups()
-                    direction = groups[0]
-                    amount_str = groups[2]
-                    divisor_str = groups[3]
-                    recipient = groups[1]
-                    reason = groups[4]
-                    amount = float(amount_str)
-                else:
-                    match = SHORTHAND_PATTERN.match(message)
-                    if not match:
-                        return None, None, None
-                    groups = match.groups()
-                    direction = 'give'
-                    amount_str = groups[1]
-                    divisor_str = groups[2]
-                    recipient = groups[0]
-                    reason = 'for ' + groups[3] if groups[3] else None
-                    amount = float(amount_str)
-
-        if RECEIVE_PATTERN.match(direction):
-            amount *= -1
-        if divisor_str:
-            divisor = int(divisor_str.strip('/'))
-            amount = amount / divisor
-
-        return str(amount), recipient, reason or ""
+    def parse_message(self, message):
+        """
+        Parses a transaction message into (amount, recipient, reason), with the amount in minor units. An amount
+        written as "amount/N" is split N ways and the recipient's share is returned. Returns (None, None, None) if
+        the message isn't understood.
+        """
+        parsed = parse_transaction_exact(message)
+        if not parsed:
+            return None, None, None
+        amount, divisor, recipient, reason = parsed
+        amount = to_minor(amount, self.decimals)
+        if divisor is not None:
+            if divisor == 0:
+                return None, None, None
+            # The first share is rounded up, so whoever ends up owing covers the extra cent of an uneven split
+            amount = split_amount(amount, divisor)[0]
+        return amount, recipient, reason
+
+    def parse_split(self, message):
+        """
+        Parses a message that splits an amount between the sender and others into (amount, reason, mentions), see
+        transaction_parser.parse_split, with the amount in minor units. Returns None if the message isn't a split.
+        """
+        parsed = parse_split(message)
+        if not parsed:
+            return None
+        amount, reason, mentions = parsed
+        return to_minor(amount, self.decimals), reason, mentions
+
+    def format_amount(self, amount):
+        return format_amount(amount, self.decimals)
+
+    def outbox(self, bot):
+        """Where to send messages: the send queue if the bot runs with one, otherwise straight to Telegram."""
+        return self.sender or bot
+
+    def reply(self, update, context, text, **kwargs):
+        if update.effective_chat.type != Chat.PRIVATE:
+            kwargs['reply_to_message_id'] = update.effective_message.message_id
+        self.outbox(context.bot).send_message(chat_id=update.effective_chat.id, text=text, **kwargs)
 
     def send_message(self, bot, message, recipient=None):
         if not recipient:
             if (not isinstance(message, dict)) or 'chat_id' not in message:
                 raise ValueError("Unknown recipient")
 
+        outbox = self.outbox(bot)
         if isinstance(message, dict):
             message_parts = wrap_message(message.get('message'))
             for part in message_parts:
-                bot.send_message(
+                outbox.send_message(
                     chat_id=recipient or message['chat_id'],
                     text=part,
                     reply_markup=message.get('markup'),
                 )
+            if 'document' in message:
+                self.send_document(bot, recipient or message['chat_id'], message['document'], message['filename'])
             if 'other_message' in message:
                 self.send_message(bot, message['other_message'])
+            for other_message in message.get('other_messages', []):
+                self.send_message(bot, other_message)
         else:
             message_parts = wrap_message(message)
             for part in message_parts:
-                bot.send_message(
+                outbox.send_message(
                     chat_id=recipient,
                     text=part,
                 )
 
-    def get_debt(self, uid1, uid2):
-        transactions = self.db['transactions']
-        debt = 0.0
-
-        given = transactions.find(creditor=uid1, debitor=uid2)
-        for t in given:
-            debt += t['amount']
+    def send_document(self, bot, chat_id, document, filename):
+        if self.sender:
+            self.sender.send_document(chat_id=chat_id, document=document, filename=filename)
+            return
+        with document:
+            bot.send_document(chat_id=chat_id, document=document, filename=filename)
 
-        gotten = transactions.find(creditor=uid2, debitor=uid1)
-        for t in gotten:
-            debt -= t['amount']
+    def get_debt(self, uid1, uid2):
+        return self.ledger.get_balance(uid1, uid2)
 
-        return debt
+    def get_balance_before(self, uid1, uid2, timestamp, txn_id=0):
+        return self.ledger.get_balance_before(uid1, uid2, timestamp, txn_id)
 
     def get_debt_string(self, uid1, uid2, name, word=""):
+        return self.format_debt(self.get_debt(uid1, uid2), name, word)
+
+    def format_debt(self, debt, name, word=""):
         if word:
             word += " "
-        debt = self.get_debt(uid1, uid2)
-        if abs(debt) <= 0.001:
+        if debt == 0:
             return "You and {} are {}even.".format(name, word)
-        return self.bidir_format("{} " + word + "owes you {:.2f}.",
-                                 "You " + word + "owe {} {:.2f}.",
+        return self.bidir_format("{} " + word + "owes you {}.",
+                                 "You " + word + "owe {} {}.",
                                  name,
                                  debt)
 
-    def get_debt_history(self, uid1, uid2):
-        results = self.db.query('SELECT * FROM transactions '
-                                'WHERE (creditor = :uid1 AND debitor = :uid2) '
-                                'OR (creditor = :uid2 AND debitor = :uid1) '
-                                'ORDER BY timestamp ASC',
-                                uid1=uid1,
-                                uid2=uid2)
+    def get_debt_history(self, uid1, uid2, before=None, after=None, limit=HISTORY_PAGE_SIZE, archive=False):
+        """
+        Returns one page of the transactions between two users in chronological order, along with
+        whether there are older and newer transactions than the ones on the page.
+        Pages are addressed by a (timestamp, id) keyset cursor: pass the id of the first transaction of a page
+        as `before` to get the page before it, or the id of the last one as `after` to get the page after it.
+        Without a cursor, the most recent page is returned. With `archive`, the pages come from the archived
+        transactions, which the ledger only has carry-forward transactions for.
+        """
+        page = self.ledger.get_history(uid1, uid2, before=before, after=after, limit=limit, archive=archive)
+        more = len(page) > limit
+        page = page[:limit]
+        if after is not None:
+            return page, True, more
+        page.reverse()
+        return page, more, before is not None
+
+    def export_transactions(self, file, uid, other=None, format='csv'):
+        """Writes the transactions of a user, or between two users, to a file. Returns how many there were."""
+        return write_records(file, self.ledger.iter_transactions(uid, other), format, self.decimals)
+
+    def import_transactions(self, records):
+        """
+        Imports (line number, record) pairs as read by ledger_io.read_records in a single DB transaction, and
+        updates the balances to match. Every creditor and debitor must be a registered user. If any record is
+        invalid, nothing is imported and a LedgerImportError lists the problems.
+        Returns the number of imported transactions.
+        """
+        errors = []
+
+        def rows():
+            for line, record in records:
+                try:
+                    row = parse_record(record, self.decimals)
+                except ValueError as e:
+                    if len(errors) < MAX_IMPORT_ERRORS:
+                        errors.append((line, str(e)))
+                    continue
+                yield line, row['creditor'], row['debitor'], row['amount'], row['reason'], row['timestamp']
+
+        count = self.ledger.import_transactions(rows(), errors, MAX_IMPORT_ERRORS)
+        self.debt_summaries.clear()
+        if errors:
+            errors.sort()
+            raise LedgerImportError(["line {}: {}".format(line, error) for line, error in errors[:MAX_IMPORT_ERRORS]])
+        return count
+
+    def format_history(self, history, uid1, name, balance=None):
+        """
+        Formats transactions, oldest first. If the balance before the first one is given, every line also shows the
+        running balance after it, positive when the other person owes uid1.
+        """
+        for item in history:
+            amount = item['amount'] if item['creditor'] == uid1 else -item['amount']
+            line = item['timestamp'].split()[0] if item.get('timestamp') else ""
+            if item.get('carried'):
+                line += ":  Balance of {}".format(
+                    plural(item['carried'], "archived transaction", "archived transactions"))
+            else:
+                line += self.bidir_format(":  You gave {} {}",
+                                          ":  {} gave you {}",
+                                          name,
+                                          amount)
+            if item.get('reason'):
+                reason = item['reason']
+                if len(reason) > MAX_REASON_LENGTH:
+                    reason = reason[:MAX_REASON_LENGTH - 1] + "…"
+                line += " {}".format(reason)
+            line += "."
+            if balance is not None:
+                balance += amount
+                line += " ({}{})".format("+" if balance > 0 else "", self.format_amount(balance))
+            yield line
+
+    def get_debt_history_string(self, uid1, uid2, name, before=None, after=None, archive=False):
+        """
+        Returns one page of the transaction history, along with the buttons to get to its neighbours. The oldest page
+        of the ledger leads on to the archive, if the two users have archived transactions.
+        """
+        history, has_older, has_newer = self.get_debt_history(uid1, uid2, before=before, after=after,
+                                                              archive=archive)
+        # Only looked up once someone has paged all the way back
+        to_archive = not archive and not has_older and self.ledger.has_archive(uid1, uid2)
+        where = [HISTORY_ARCHIVE] if archive else []
+
+        buttons = []
+        if has_older:
+            buttons.append(self.action_button("« Older", HISTORY_CMD, uid1, self.get_user(uid2),
+                                              [HISTORY_OLDER, history[0]['id']] + where))
+        elif to_archive:
+            buttons.append(self.action_button("« Archived", HISTORY_CMD, uid1, self.get_user(uid2),
+                                              [HISTORY_OLDER, None, HISTORY_ARCHIVE]))
+        if has_newer:
+            buttons.append(self.action_button("Newer »", HISTORY_CMD, uid1, self.get_user(uid2),
+                                              [HISTORY_NEWER, history[-1]['id']] + where))
+        elif archive:
+            buttons.append(self.action_button("Recent »", HISTORY_CMD, uid1, self.get_user(uid2), []))
+
+        if not history:
+            if to_archive:
+                return ("All transactions between you and {} are archived.\n".format(name),
+                        InlineKeyboardMarkup([buttons]))
+            return "You and {} don't have any transactions so far.\n".format(name), None
+
+        balance = self.get_balance_before(uid1, uid2, history[0]['timestamp'], history[0]['id'])
+        string = "Running balance in brackets, positive when {} owes you.\n\n".format(name)
+        string += "\n".join(self.format_history(history, uid1, name, balance)) + "\n"
+        return string, InlineKeyboardMarkup([buttons]) if buttons else None
+
+    def get_debt_summary(self, uid):
+        """
+        Returns what everyone uid has an uneven balance with owes them, as (user_id, name, debt) tuples, and as the
+        text /debts replies with. Summaries are cached until one of the balances or names in them changes, or the
+        ledger is changed in bulk.
+        """
+        uid = int(uid)
+        self.check_ledger_version()
+        summary = self.debt_summaries.get(uid)
+        if summary is not MISSING:
+            return summary
+
+        version = self.debt_summaries.version()
+        debts = [(r['user_id'], self.format_name(r), r['debt']) for r in self.ledger.get_all_debts(uid)]
+        text = "\n".join(self.format_debt(debt, name) for user_id, name, debt in debts)
+        summary = {
+            'debts': debts,
+            'text': text + "\n" if text else "Congratulations! You currently don't have any debts.",
+        }
+        self.debt_summaries.put(uid, summary, version)
+        return summary
+
+    def get_all_debts(self, uid):
+        return self.get_debt_summary(uid)['text']
 
-        return list(results)
+    def get_settlement_group(self, uid):
+        return self.ledger.get_settlement_group(uid)
 
-    def get_debt_history_string(self, uid1, uid2, name):
-        history = self.get_debt_history(uid1, uid2)
+    @staticmethod
+    def settlement_digest(group):
+        """Identifies the state of a group's balances, so a settlement plan can't be applied once they've changed."""
+        state = ','.join('{}={}'.format(r['user_id'], r['net']) for r in group)
+        return hashlib.sha1(state.encode()).hexdigest()[:16]
+
+    def get_settlement_plan(self, uid):
+        group = self.get_settlement_group(uid)
+        payments = plan_settlement({r['user_id']: r['net'] for r in group})
+        return group, payments
+
+    def settle_command(self, uid, args=None):
+        group, payments = self.get_settlement_plan(uid)
+        digest = self.settlement_digest(group)
+
+        if args:
+            if args[0] != digest:
+                return {
+                    'message': "Some debts in your group have changed since. Please run /settle again.",
+                    'answer': "Balances have changed",
+                }
+            return self.apply_settlement(uid, group, payments)
+
+        if not payments:
+            return "You and everyone you're in debt with are all square. There's nothing to settle!"
+
+        names = {r['user_id']: self.format_name(r) for r in group}
+        # Show the payments the user is part of first
+        payments.sort(key=lambda p: uid not in p[:2])
+        lines = []
+        for payer, payee, amount in payments[:MAX_SETTLE_LINES]:
+            lines.append("{} {} {} {}".format(
+                "You" if payer == uid else names[payer],
+                "pay" if payer == uid else "pays",
+                "you" if payee == uid else names[payee],
+                self.format_amount(amount),
+            ))
+        if len(payments) > MAX_SETTLE_LINES:
+            lines.append("... and {} more".format(plural(len(payments) - MAX_SETTLE_LINES, "payment", "payments")))
+
+        msg = "Your group of {} people can settle all their debts with {}:\n\n{}\n\n" \
+              "Once the money has changed hands, record it here and everyone's debts in the group are cleared." \
+              .format(len(group), plural(len(payments), "payment", "payments"), "\n".join(lines))
+        markup = InlineKeyboardMarkup([[
+            self.action_button("Record these payments", SETTLE_CMD, uid, self.get_user(uid), [digest])
+        ]])
+        return {
+            'message': msg,
+            'markup': markup,
+        }
 
-        string = ""
+    def apply_settlement(self, uid, group, payments):
+        """
+        Records a settlement plan. Every pair with an outstanding balance in the group gets one transaction that
+        brings their balance to zero. Since payments don't necessarily go between people who owe each other, this
+        also moves debts around, but nobody ends up with more or less money than the plan says.
+        """
+        members = [r['user_id'] for r in group]
+        pairs = self.ledger.settle_group(members, SETTLE_REASON)
+        self.debts_changed(*members)
+        # Everyone whose debts were cleared hears about it, even if theirs cancelled out and they pay nothing
+        changed = {pair['user_low'] for pair in pairs} | {pair['user_high'] for pair in pairs}
+
+        initiator = self.get_user(uid)
+        names = {r['user_id']: self.format_name(r) for r in group}
+        other_messages = []
+        for member in members:
+            if member == uid or member not in changed:
+                continue
+            own = ["You pay {} {}".format(names[payee], self.format_amount(amount)) if payer == member else
+                   "{} pays you {}".format(names[payer], self.format_amount(amount))
+                   for payer, payee, amount in payments if member in (payer, payee)]
+            if not own:
+                own = ["What you owed and what you were owed in the group cancel out, so you don't pay anything."]
+            other_messages.append({
+                'chat_id': member,
+                'message': "{} settled up your group's debts:\n\n{}\n\n"
+                           "You don't owe anyone in the group anything anymore, and nobody owes you."
+                           .format(self.format_name(initiator), "\n".join(own)),
+            })
 
-        for item in history:
-            if 'timestamp' in item and item['timestamp']:
-                string += item['timestamp'].split()[0]
-            string += self.bidir_format(":  You gave {} {:.2f}",
-                                        ":  {} gave you {:.2f}",
-                                        name,
-                                        item['amount'] if item['creditor'] == uid1 else -item['amount'])
-            if 'reason' in item and item['reason']:
-                string += " {}".format(item['reason'])
-            string += ".\n"
-
-        if not string:
-            return "You and {} don't have any transactions so far.".format(name)
-        return string
+        return {
+            'message': "Done! {} between {} people are settled.".format(plural(len(pairs), "debt", "debts"),
+                                                                          len(group)),
+            'answer': self.get_affirmation(),
+            'other_messages': other_messages,
+        }
 
-    def get_all_debts(self, uid):
-        all_others = []
-
-        results = self.db.query('SELECT DISTINCT debitor FROM transactions WHERE creditor = :creditor', creditor=uid)
-        for r in results:
-            all_others.append(r['debitor'])
-
-        results = self.db.query('SELECT DISTINCT creditor FROM transactions WHERE debitor = :debitor', debitor=uid)
-        for r in results:
-            if r['creditor'] not in all_others:
-                all_others.append(r['creditor'])
-
-        users = self.db['users']
-        summary = ""
-        for other in all_others:
-            user = users.find_one(user_id=other)
-            str = self.get_debt_string(uid, other, self.format_name(user))
-            if 'even' not in str:
-                summary += str
-                summary += "\n"
-        if not summary:
-            return "Congratulations! You currently don't have any debts."
-        return summary
+    def digest_command(self, uid, args=None):
+        user = self.get_user(uid)
+        if not user:
+            return "You need to /register first."
+        if args in ("on", "off"):
+            self.user_store.set_digest(uid, args == "on")
+            self.users_by_id.invalidate(int(uid))
+            self.users_by_name.invalidate(user['username_lower'])
+            enabled = args == "on"
+        elif args:
+            return "Use /digest on or /digest off."
+        else:
+            enabled = bool(user['digest'])
+
+        if not enabled:
+            return "You don't get a digest of your debts. Use /digest on to get one {}.".format(
+                self.digest_schedule or "once the bot sends them")
+        if not self.digest_schedule:
+            return "You'll get a digest of your debts once the bot sends them. Use /digest off to stop it."
+        return "You get a digest of your debts {}, if you have any. Use /digest off to stop it.".format(
+            self.digest_schedule)
+
+    def get_digests(self):
+        """Yields (user_id, text) for everyone who gets the digest and has open debts."""
+        for uid, rows in itertools.groupby(self.ledger.get_digests(), key=lambda row: row['uid']):
+            yield uid, "Here's who you still have debts with:\n\n" + "\n".join(
+                self.format_debt(row['debt'], self.format_name(row)) for row in rows)
+
+    def send_digests(self, context):
+        start = time.perf_counter()
+        sent = 0
+        for uid, text in self.get_digests():
+            self.send_message(context.bot, text, uid)
+            sent += 1
+        seconds = time.perf_counter() - start
+        self.digests_sent += sent
+        self.digest_seconds = seconds
+        logger.info("Sent %d digests in %.2f s", sent, seconds)
 
     def bidir_format(self, str1, str2, name, amount):
         if amount > 0:
-            return str1.format(name, abs(amount))
+            return str1.format(name, self.format_amount(abs(amount)))
         else:
-            return str2.format(name, abs(amount))
+            return str2.format(name, self.format_amount(abs(amount)))
 
     def get_user_by_name(self, username):
-        users = self.db['users']
-        recipient = users.find_one(username_lower=username.lower())
+        username = username.lower()
+        recipient = self.users_by_name.get(username)
+        if recipient is MISSING:
+            recipient = self.user_store.get_by_username(username)
+            self.users_by_name.put(username, recipient)
         return recipient
 
     def get_user(self, user_id):
-        users = self.db['users']
-        recipient = users.find_one(user_id=user_id)
+        user_id = int(user_id)
+        recipient = self.users_by_id.get(user_id)
+        if recipient is MISSING:
+            recipient = self.user_store.get(user_id)
+            self.users_by_id.put(user_id, recipient)
         return recipient
 
+    def find_users_by_name(self, name, limit=MAX_NAME_CANDIDATES):
+        """
+        Returns up to `limit` users whose first and last names contain words starting with every word of `name`,
+        best matches first.
+        """
+        return self.user_store.find_by_name(name, limit)
+
     def get_alias(self, owner_id, alias):
-        aliases = self.db['aliases']
-        return aliases.find_one(owner_id=owner_id, alias=alias)
+        key = (owner_id, alias)
+        stored = self.aliases.get(key)
+        if stored is MISSING:
+            stored = self.alias_store.get(owner_id, alias)
+            self.aliases.put(key, stored)
+        return stored
 
     def delete_alias(self, owner_id, alias):
-        aliases = self.db['aliases']
-        aliases.delete(owner_id=owner_id, alias=alias)
+        self.alias_store.delete(owner_id, alias)
+        self.aliases.invalidate((owner_id, alias))
 
     def get_all_aliases(self, owner_id):
-        aliases = self.db['aliases']
-        users = self.db['users']
-        all_aliases = aliases.find(owner_id=owner_id)
+        all_aliases = self.alias_store.list(owner_id)
 
         str_aliases = []
         for alias in all_aliases:
-            target_user = users.find_one(user_id=alias['target_id'])
             str_aliases.append("{} points to {} {}".format(
                 alias['alias'],
-                target_user['first_name'] or "",
-                target_user['last_name'] or "",
+                alias['first_name'] or "",
+                alias['last_name'] or "",
             ))
 
         return str_aliases
 
+    def add_action(self, command, initiator_id, targets, args):
+        """
+        Stores a command that waits for a button to be pressed, along with the users the buttons stand for.
+        Returns the token to put into the buttons' callback data, followed by the index of their user.
+        """
+        return self.pending.put({
+            'command': command,
+            'initiator': initiator_id,
+            'targets': [dict(target) for target in targets],
+            'args': list(args),
+        })
+
+    def action_button(self, text, command, initiator_id, target_user, args):
+        token = self.add_action(command, initiator_id, [target_user], args)
+        return InlineKeyboardButton(text, callback_data="{}:0".format(token))
+
     # Commands
     def dispatch_command_for_user(self, command, initiator_id, username_str, other_args=None, use_alias=True):
         if not other_args:
@@ -295,59 +625,33 @@ class DebtBot:
         if use_alias:
             alias = self.get_alias(initiator_id, username_str)
 
-        users = self.db['users']
         if alias:
-            target_user = users.find_one(user_id=alias['target_id'])
+            target_user = self.get_user(alias['target_id'])
         else:
-            target_user = users.find_one(username_lower=username_str)
+            target_user = self.get_user_by_name(username_str)
 
         if target_user:
             return self.dispatch_command(command, initiator_id, target_user, other_args)
 
         else:
-            callback_data = command + ":{}:" + ':'.join(other_args)
-
-            recipient_parts = username_str.split()
-            recipient_str = " ".join(recipient_parts)
-
-            potential_recipients = None
-            if len(recipient_parts) >= 2:
-                first = recipient_parts[0]
-                last = recipient_parts[-1]
-                potential_recipients = self.db.query(
-                    "SELECT * FROM users "
-                    "WHERE (first_name LIKE '{}%' "
-                    "AND last_name LIKE '%{}%') "
-                    "OR first_name + ' ' + last_name LIKE '{}%'".format(
-                        first, last, recipient_str
-                    )
-                )
-                potential_recipients = list(potential_recipients)  # fuck this stupid BS
-
-            if not potential_recipients:
-                potential_recipients = self.db.query(
-                    "SELECT * FROM users "
-                    "WHERE first_name LIKE '{}%' "
-                    "OR last_name LIKE '{}%' "
-                    "OR first_name + ' ' + last_name LIKE '{}%'".format(
-                        recipient_str, recipient_str, recipient_str
-                    )
+            recipient_str = " ".join(username_str.split())
+            potential_recipients = self.find_users_by_name(recipient_str)
+
+            if len(potential_recipients) == 0:
+                return "I'm sorry, I couldn't find anyone named {}. Perhaps you need to ask them to register?".format(
+                    recipient_str
                 )
+            token = self.add_action(command, initiator_id, potential_recipients, other_args)
 
             buttons = []
-            for row in potential_recipients:
+            for i, row in enumerate(potential_recipients):
                 buttons.append([
                     InlineKeyboardButton("{} {}".format(row['first_name'] if row['first_name'] else "",
                                                         row['last_name'] if row['last_name'] else ""),
-                                         callback_data=callback_data.format(
-                                             row['user_id']
-                                         ))
+                                         callback_data="{}:{}".format(token, i))
                 ])
-            if len(buttons) == 0:
-                return "I'm sorry, I couldn't find anyone named {}. Perhaps you need to ask them to register?".format(
-                    recipient_str
-                )
-            buttons.append([InlineKeyboardButton("None of these people", callback_data=callback_data.format('0'))])
+            buttons.append([InlineKeyboardButton("None of these people",
+                                                 callback_data="{}:{}".format(token, CANCEL_CHOICE))])
             markup = InlineKeyboardMarkup(buttons)
             return {
                 "message": "{} doesn't appear to be a valid username, but I found some people that could be them. \n" \
@@ -360,17 +664,33 @@ class DebtBot:
             if len(args) < 2:
                 return "Aw no, something went wrong. Please try again."
 
-            amount = float(args[0])
+            amount = to_minor(args[0], self.decimals)
             reason = args[1] or None
 
             return self.transaction_command(initiator_id, target_user, amount, reason)
 
         if command == HISTORY_CMD:
-            return self.history_command(initiator_id, target_user)
+            return self.history_command(initiator_id, target_user, args)
+
+        if command == BALANCE_CMD:
+            return self.balance_command(initiator_id, target_user, args)
 
         if command == DEBT_CMD:
             return self.debt_command(initiator_id, target_user)
 
+        if command == EXPORT_CMD:
+            return self.export_command(initiator_id, target_user)
+
+        if command == SETTLE_CMD:
+            if initiator_id != target_user['user_id']:
+                return {'answer': "Only the person who asked for this settlement can record it."}
+            return self.settle_command(initiator_id, args)
+
+        if command == SEARCH_CMD:
+            # Buttons of searches without someone to narrow them down to stand for the initiator
+            other = target_user if target_user['user_id'] != initiator_id else None
+            return self.search_command(initiator_id, other, args)
+
         if command == ALIAS_CMD:
             if len(args) < 1:
                 return "Something is broken, sorry. Please try again."
@@ -378,19 +698,16 @@ class DebtBot:
             return self.alias_command(initiator_id, target_user, alias)
 
     def transaction_command(self, sender_id, recipient, amount, reason):
-        transaction = {
-            'creditor': sender_id if amount > 0 else recipient['user_id'],
-            'debitor': recipient['user_id'] if amount > 0 else sender_id,
-            'amount': abs(amount),
-            'reason': reason,
-            'timestamp': datetime.datetime.now(),
-        }
-
-        transactions = self.db['transactions']
-        transactions.insert(transaction)
+        self.ledger.add_transaction(
+            creditor=sender_id if amount > 0 else recipient['user_id'],
+            debitor=recipient['user_id'] if amount > 0 else sender_id,
+            amount=abs(amount),
+            reason=reason,
+        )
+        self.debts_changed(sender_id, recipient['user_id'])
 
-        msg = self.bidir_format("You gave {} {:.2f}",
-                                "{} gave you {:.2f}",
+        msg = self.bidir_format("You gave {} {}",
+                                "{} gave you {}",
                                 recipient['first_name'],
                                 amount)
         if reason:
@@ -400,8 +717,8 @@ class DebtBot:
         msg += self.get_debt_string(sender_id, recipient['user_id'], self.format_name(recipient), 'now')
         sender = self.get_user(sender_id)
 
-        other = self.bidir_format("{} got {:.2f} from you",
-                                  "{} gave you {:.2f}",
+        other = self.bidir_format("{} got {} from you",
+                                  "{} gave you {}",
                                   sender['first_name'],
                                   -amount)
         if reason:
@@ -422,17 +739,105 @@ class DebtBot:
             }
         }
 
-    def history_command(self, sender_id, recipient):
-        msg = self.get_debt_history_string(sender_id,
-                                           recipient['user_id'],
-                                           recipient['first_name'])
+    def split_command(self, sender_id, amount, reason, mentions):
+        """
+        Splits an amount the sender paid between them and the people they mentioned, by weight, and records what
+        everyone else owes them in one DB transaction. All names are looked up at once, and they must all be known.
+        """
+        names = [name for name, weight in mentions if name != 'me']
+        found = {row['mention']: row for row in self.user_store.resolve(sender_id, names)}
+        unknown = [name for name in names if name not in found]
+        if unknown:
+            return "I don't know who {} is. Please use their username, or an /alias.".format(", ".join(unknown))
+
+        # Someone mentioned twice gets both shares
+        weights = {}
+        people = {}
+        for name, weight in mentions:
+            uid = sender_id if name == 'me' else found[name]['user_id']
+            weights[uid] = weights.get(uid, 0) + weight
+            people.setdefault(uid, found.get(name))
+        weights.setdefault(sender_id, 1)
+        if len(weights) > MAX_SPLIT_PEOPLE:
+            return "Sorry, I can split an amount between at most {} people.".format(MAX_SPLIT_PEOPLE)
+        if amount <= 0 or sum(weights.values()) == 0:
+            return "Aw no, something went wrong. Please try again."
+
+        # The sender's share comes last, so the others cover any remainder, like with amount/N
+        others = [uid for uid in weights if uid != sender_id]
+        if not others:
+            return "Mention at least one other person to split with."
+        shares = dict(zip(others + [sender_id], split_weighted(amount, [weights[uid] for uid in others + [sender_id]])))
+        owed = self.ledger.add_split(sender_id, [(uid, shares[uid]) for uid in others if shares[uid]], reason)
+        self.debts_changed(sender_id, *others)
+        for uid in others:
+            if uid not in owed:
+                owed[uid] = self.get_debt(sender_id, uid)
+
+        sender = self.get_user(sender_id)
+        what = self.format_amount(amount) + (" {}".format(reason) if reason else "")
+        lines = ["{}: {}".format(self.format_name(people[uid]), self.format_amount(shares[uid])) for uid in others]
+        lines.append("You: {}".format(self.format_amount(shares[sender_id])))
+        msg = "You paid {}, split with {}.\n\n{}\n\n".format(
+            what, plural(len(others), "person", "people"), "\n".join(lines))
+        msg += "\n".join(self.format_debt(owed[uid], self.format_name(people[uid]), 'now') for uid in others)
+
+        return {
+            'answer': self.get_affirmation(),
+            'message': msg,
+            'other_messages': [{
+                'chat_id': uid,
+                'message': "{} paid {}, split with {}. Your share is {}.\n\n{}".format(
+                    sender['first_name'], what, plural(len(others), "person", "people"),
+                    self.format_amount(shares[uid]),
+                    self.format_debt(-owed[uid], self.format_name(sender), 'now')),
+            } for uid in others],
+        }
+
+    def history_command(self, sender_id, recipient, args=None):
+        before = after = None
+        if args and len(args) >= 2 and args[1]:
+            if args[0] == HISTORY_OLDER:
+                before = int(args[1])
+            elif args[0] == HISTORY_NEWER:
+                after = int(args[1])
+        archive = bool(args) and len(args) >= 3 and args[2] == HISTORY_ARCHIVE
+
+        msg, markup = self.get_debt_history_string(sender_id,
+                                                   recipient['user_id'],
+                                                   recipient['first_name'],
+                                                   before=before,
+                                                   after=after,
+                                                   archive=archive)
         msg += '\n'
         msg += self.get_debt_string(sender_id, recipient['user_id'], self.format_name(recipient))
         return {
             'message': msg,
+            'markup': markup,
             'answer': self.get_affirmation()
         }
 
+    def balance_command(self, sender_id, recipient, args):
+        try:
+            date = datetime.date.fromisoformat(args[0])
+        except (IndexError, ValueError):
+            return "Please give me a date like 2024-05-31."
+
+        # Everything up to the end of the day counts
+        debt = self.get_balance_before(sender_id, recipient['user_id'], str(date + datetime.timedelta(days=1)))
+        name = self.format_name(recipient)
+        if debt == 0:
+            msg = "At the end of {}, you and {} were even.".format(date, name)
+        else:
+            msg = self.bidir_format("At the end of " + str(date) + ", {} owed you {}.",
+                                    "At the end of " + str(date) + ", you owed {} {}.",
+                                    name,
+                                    debt)
+        return {
+            'message': msg,
+            'answer': self.get_affirmation(),
+        }
+
     def debt_command(self, sender_id, recipient):
         msg = self.get_debt_string(sender_id,
                                    recipient['user_id'],
@@ -443,8 +848,71 @@ class DebtBot:
             'answer': self.get_affirmation(),
         }
 
+    def search_command(self, sender_id, other, args):
+        """Finds transactions by their reason, see LedgerStore.search. The args are the text, the date and the offset."""
+        text, since, offset = args
+        results = self.ledger.search(sender_id, text,
+                                     other=other['user_id'] if other else None,
+                                     since=datetime.datetime.fromisoformat(since) if since else None,
+                                     limit=SEARCH_PAGE_SIZE + 1,
+                                     offset=offset)
+        more = len(results) > SEARCH_PAGE_SIZE
+        results = results[:SEARCH_PAGE_SIZE]
+
+        description = '"{}"'.format(text)
+        if other:
+            description += " with {}".format(self.format_name(other))
+        if since:
+            description += " since {}".format(since)
+        if not results:
+            msg = "I couldn't find any {}transactions matching {}.".format("more " if offset else "", description)
+        else:
+            msg = "Transactions matching {}, best matches first:\n\n".format(description)
+            msg += "\n".join(next(self.format_history([row], sender_id, self.format_name(row))) for row in results)
+
+        target = other or self.get_user(sender_id)
+        buttons = []
+        if offset:
+            buttons.append(self.action_button("« Better matches", SEARCH_CMD, sender_id, target,
+                                              [text, since, max(0, offset - SEARCH_PAGE_SIZE)]))
+        if more:
+            buttons.append(self.action_button("More »", SEARCH_CMD, sender_id, target,
+                                              [text, since, offset + SEARCH_PAGE_SIZE]))
+        return {
+            'message': msg,
+            'markup': InlineKeyboardMarkup([buttons]) if buttons else None,
+            'answer': self.get_affirmation(),
+        }
+
+    def export_command(self, sender_id, recipient=None):
+        """Writes all transactions of the sender, or only those with the recipient, to a CSV document."""
+        file = tempfile.TemporaryFile()
+        text_file = io.TextIOWrapper(file, encoding='utf-8', newline='')
+        count = self.export_transactions(text_file, sender_id, recipient['user_id'] if recipient else None)
+        text_file.detach()
+
+        if not count:
+            file.close()
+            return "There are no transactions to export."
+        if file.tell() > MAX_DOCUMENT_SIZE:
+            file.close()
+            return "Sorry, your transaction history is too big for me to send it on Telegram."
+        file.seek(0)
+
+        if recipient:
+            message = "Here are all {} transactions between you and {}.".format(count, self.format_name(recipient))
+            filename = "transactions-{}.csv".format(recipient['username'] or recipient['user_id'])
+        else:
+            message = "Here are all your {} transactions.".format(count)
+            filename = "transactions.csv"
+        return {
+            'message': message,
+            'document': file,
+            'filename': filename,
+            'answer': self.get_affirmation(),
+        }
+
     def alias_command(self, owner_id, target_user, alias):
-        aliases = self.db['aliases']
         old_alias = self.get_alias(owner_id, alias)
         new_alias = {
             'owner_id': owner_id,
@@ -452,7 +920,9 @@ class DebtBot:
             'alias': alias.strip(),
         }
 
-        aliases.upsert(new_alias, ['owner_id', 'alias'])
+        self.alias_store.put(**new_alias)
+        self.aliases.invalidate((owner_id, alias))
+        self.aliases.invalidate((owner_id, new_alias['alias']))
 
         msg = "Your alias '{}' has been {} to point to {} {}.".format(
             alias,
@@ -469,17 +939,17 @@ class DebtBot:
     # Conversation handlers:
     def handle_register(self, update, context):
         if self.register_user(update.message.from_user, force=True):
-            update.message.reply_text('Hi! Thanks for registering with Debt Bot. '
-                                      'People can now register their debts with you.')
+            self.reply(update, context, 'Hi! Thanks for registering with Debt Bot. '
+                                        'People can now register their debts with you.')
         else:
-            update.message.reply_text("Looks like you're already registered. You're good to go!")
+            self.reply(update, context, "Looks like you're already registered. You're good to go!")
 
     def handle_history(self, update, context):
         arguments = update.message.text.split(maxsplit=1)
 
         if len(arguments) < 2:
-            update.message.reply_text("Please give me the name of the person for which you want to know "
-                                      "the transaction history.")
+            self.reply(update, context, "Please give me the name of the person for which you want to know "
+                                        "the transaction history.")
             return
         username = arguments[1]
         if username.startswith('@'):
@@ -491,6 +961,25 @@ class DebtBot:
             update.message.from_user.id,
         )
 
+    def handle_balance(self, update, context):
+        arguments = update.message.text.split(maxsplit=1)
+        # The date comes last, since names can have spaces
+        arguments = arguments[1].rsplit(maxsplit=1) if len(arguments) > 1 else []
+
+        if len(arguments) < 2:
+            self.reply(update, context, "Please tell me whose balance you want to know and on which day, "
+                                        "e.g. /balance bob14 2024-05-31")
+            return
+        username, date = arguments
+        if username.startswith('@'):
+            username = username[1:]
+
+        self.send_message(
+            context.bot,
+            self.dispatch_command_for_user(BALANCE_CMD, update.message.from_user.id, username, [date]),
+            update.message.from_user.id,
+        )
+
     def handle_debts(self, update, context):
         arguments = update.message.text.split(maxsplit=1)
 
@@ -506,60 +995,123 @@ class DebtBot:
             )
 
         else:
-            update.message.reply_text(self.get_all_debts(update.message.from_user.id))
+            self.reply(update, context, self.get_all_debts(update.message.from_user.id))
+
+    def handle_export(self, update, context):
+        arguments = update.message.text.split(maxsplit=1)
+        uid = update.message.from_user.id
+
+        if len(arguments) > 1:
+            username = arguments[1]
+            if username.startswith('@'):
+                username = username[1:]
+            self.send_message(context.bot, self.dispatch_command_for_user(EXPORT_CMD, uid, username), uid)
+        else:
+            self.send_message(context.bot, self.export_command(uid), uid)
+
+    def handle_search(self, update, context):
+        uid = update.message.from_user.id
+        arguments = update.message.text.split(maxsplit=1)
+        text, username, since = SEARCH_PATTERN.match(arguments[1] if len(arguments) > 1 else "").groups()
+        if not text:
+            self.reply(update, context, "Please tell me what to look for, e.g. /search pizza @bob14 since 2024-03-01")
+            return
+        if since:
+            try:
+                since = datetime.date.fromisoformat(since).isoformat()
+            except ValueError:
+                self.reply(update, context, "Please give the date as year-month-day, e.g. 2024-03-01.")
+                return
+
+        args = [text, since, 0]
+        if username:
+            reply = self.dispatch_command_for_user(SEARCH_CMD, uid, username, args)
+        else:
+            reply = self.search_command(uid, None, args)
+        self.send_message(context.bot, reply, uid)
+
+    def handle_settle(self, update, context):
+        self.send_message(context.bot, self.settle_command(update.message.from_user.id), update.message.from_user.id)
+
+    def handle_digest(self, update, context):
+        arguments = update.message.text.split(maxsplit=1)
+        args = arguments[1].strip().lower() if len(arguments) > 1 else None
+        self.reply(update, context, self.digest_command(update.message.from_user.id, args))
 
     def handle_inline_button(self, update, context):
         query = update.callback_query
-        data = update.callback_query.data
-        data = data.split(':', 3)
-
-        cmd = data[0]
-        userid = data[1]
-        args = data[2:]
+        token, _, choice = query.data.partition(':')
 
         message_id = query.message.message_id
         chat_id = query.message.chat.id
 
-        if userid == '0':
+        # Taking the action makes sure that it's carried out once, however often the button is pressed
+        action = self.pending.take(token)
+        if action is None:
+            query.answer("This button has expired or was already used.")
+            return
+
+        if choice == CANCEL_CHOICE:
             query.answer("Action cancelled")
-            context.bot.edit_message_text(text="Looks like the person you wanted to find isn't registered :(",
-                                  message_id=message_id,
-                                  chat_id=chat_id)
+            self.outbox(context.bot).edit_message_text(
+                text="Looks like the person you wanted to find isn't registered :(",
+                message_id=message_id,
+                chat_id=chat_id,
+            )
             return
 
-        users = self.db['users']
-        recipient = users.find_one(user_id=userid)
-        if not recipient:
+        try:
+            recipient = action['targets'][int(choice)]
+        except (ValueError, IndexError):
             query.answer("Uh oh, something went pretty wrong here")
             return
 
-        reply = self.dispatch_command(cmd, query.from_user.id, recipient, args)
+        reply = self.dispatch_command(action['command'], action['initiator'], recipient, action['args'])
 
         if isinstance(reply, dict):
             if 'message' in reply:
-                context.bot.edit_message_text(text=reply['message'], message_id=message_id, chat_id=chat_id,
-                                      reply_markup=reply.get('markup'))
+                self.outbox(context.bot).edit_message_text(text=reply['message'], message_id=message_id,
+                                                           chat_id=chat_id, reply_markup=reply.get('markup'))
             if 'answer' in reply:
                 query.answer(reply['answer'])
             if 'other_message' in reply:
                 self.send_message(context.bot, reply['other_message'])
+            if 'document' in reply:
+                self.send_document(context.bot, chat_id, reply['document'], reply['filename'])
+            for other_message in reply.get('other_messages', []):
+                self.send_message(context.bot, other_message)
 
     def handle_message(self, update, context):
         if update.message.text is None:
-            update.message.reply_text(self.get_affirmation())
+            self.reply(update, context, self.get_affirmation())
             return
         self.register_user(update.message.from_user)
 
-        amount, recipient_str, reason = self.parse_message(update.message.text)
+        try:
+            split = self.parse_split(update.message.text)
+            if not split:
+                amount, recipient_str, reason = self.parse_message(update.message.text)
+        except ValueError:
+            # The only amounts the parsers let through that can't be converted are those too large to store
+            self.reply(update, context, "Sorry, that amount is too large for me.")
+            return
+
+        if split:
+            self.send_message(context.bot, self.split_command(update.message.from_user.id, *split),
+                              update.message.from_user.id)
+            return
+
         if not recipient_str:
-            update.message.reply_text("Sorry, I could not understand your message at all :(")
+            self.metrics.parse_failures.inc()
+            self.reply(update, context, "Sorry, I could not understand your message at all :(")
+            return
 
         self.send_message(
             context.bot,
             self.dispatch_command_for_user(TRANSACTION_CMD,
                                            update.message.from_user.id,
                                            recipient_str,
-                                           [amount, reason]),
+                                           [self.format_amount(amount), reason]),
             update.message.from_user.id,
         )
 
@@ -568,16 +1120,16 @@ class DebtBot:
         if message == "/alias":
             all_aliases = self.get_all_aliases(update.message.from_user.id)
             if not all_aliases:
-                update.message.reply_text("You don't seem to have any aliases. "
-                                          "You can create them by typing\n"
-                                          "/alias nickname = @username")
+                self.reply(update, context, "You don't seem to have any aliases. "
+                                            "You can create them by typing\n"
+                                            "/alias nickname = @username")
                 return
-            update.message.reply_text("Your aliases:\n\n{}".format('\n'.join(all_aliases)))
+            self.reply(update, context, "Your aliases:\n\n{}".format('\n'.join(all_aliases)))
             return
         match = ALIAS_PATTERN.match(message)
         if not match:
-            update.message.reply_text("I'm sorry, I couldn't understand that. Try the following:\n"
-                                      "/alias nickname = @username")
+            self.reply(update, context, "I'm sorry, I couldn't understand that. Try the following:\n"
+                                        "/alias nickname = @username")
             return
         groups = match.groups()
         alias = groups[0]
@@ -603,19 +1155,19 @@ class DebtBot:
         message_parts = message.split(maxsplit=1)
 
         if len(message_parts) < 2:
-            update.message.reply_text("Sorry, I don't understand which alias you want to delete.\n"
-                                      "Try: /unalias nickname")
+            self.reply(update, context, "Sorry, I don't understand which alias you want to delete.\n"
+                                        "Try: /unalias nickname")
             return
         alias = message_parts[1]
         old_alias = self.get_alias(update.message.from_user.id, alias)
 
         if not old_alias:
-            update.message.reply_text("You don't seem to have an alias named {}.".format(alias))
+            self.reply(update, context, "You don't seem to have an alias named {}.".format(alias))
             return
 
         self.delete_alias(update.message.from_user.id, alias)
         target_user = self.get_user(old_alias['target_id'])
-        update.message.reply_text("Your alias '{}' for {} {} has been deleted.".format(
+        self.reply(update, context, "Your alias '{}' for {} {} has been deleted.".format(
             alias,
             target_user['first_name'] or "",
             target_user['last_name'] or "",
@@ -632,72 +1184,392 @@ class DebtBot:
                    "I gave 15 to bob14 for pizza \n" \
                    "bob14 owes me 40 for groceries \n" \
                    "bob14 gave me 12.30 for the cinema ticket\n\n" \
+                   "To split a bill with several people, mention them at the end. Add a weight for someone " \
+                   "who had more, or me\\*0 if you didn't have any yourself: \n" \
+                   "I paid 90 for dinner @bob14 @alice @carol\\*2\n\n" \
                    "To see all your debts, use: /debts\n" \
                    "To see debts with a specific person, use: /debts _username_\n" \
                    "To see a transaction history, use: /history _username_\n" \
+                   "To see what you owed each other on a given day, use: /balance _username_ _2024-05-31_\n" \
+                   "To find transactions by their reason, use: /search _pizza_ or /search _pizza_ @_username_ " \
+                   "since _2024-03-01_\n" \
+                   "To settle up with everyone you're in debt with, use: /settle\n" \
+                   "To download your transactions as a spreadsheet, use: /export or /export _username_\n" \
+                   "To get a regular reminder of your debts, use: /digest on\n" \
                    "To create an alias, use: /alias _nickname_ = _username_\n" \
                    "To delete an alias, use: /unalias _nickname_\n" \
                    "You can use the nickname in place of the username for any other command after creating" \
                    "an alias."
 
-        update.message.reply_text(helptext, parse_mode="Markdown")
+        self.reply(update, context, helptext, parse_mode="Markdown")
 
     # Error handler
     def handle_error(self, update, context):
         """Log Errors caused by Updates."""
-        import traceback
-        traceback.print_exception(context.error)
-        logger.warning('Update "%s" caused error "%s"', update, context.error)
+        self.metrics.errors.inc()
+        logger.error('Update "%s" caused error "%s"', update, context.error, exc_info=context.error)
+
+    def connect(self, config):
+        self.db = Database(config['db'])
+        self.user_store = UserStore(self.db)
+        self.alias_store = AliasStore(self.db)
+        self.ledger = LedgerStore(self.db)
+        self.metrics.watch_database(self.db)
+
+        pending = config.get('pending_actions', {})
+        self.pending = PendingActions(
+            pending.get('ttl_hours', DEFAULT_TTL / 3600) * 3600,
+            pending.get('max_entries', MAX_ENTRIES),
+            PendingActionStore(self.db) if pending.get('spill') else None,
+        )
 
-    def run(self, opts):
-        with open(opts.config, 'r') as configfile:
-            # config = yaml.load(configfile, Loader=yaml.FullLoader)
-            config = yaml.safe_load(configfile)
+        decimals = config.get('decimals', DEFAULT_DECIMALS)
+        schema.migrate(self.db, {'decimals': decimals})
+        # Amounts are stored in the minor unit chosen when the database was migrated, which can't change later
+        self.decimals = int(schema.get_setting(self.db, 'decimals', decimals))
+        if self.decimals != decimals:
+            raise RuntimeError("The database stores amounts with {} decimals, but the config asks for {}".format(
+                self.decimals, decimals))
+
+    def migrate_only(self, opts):
+        """Apply all pending schema migrations without starting the bot."""
+        config = load_config(opts.config)
+        self.connect(config)
+        print("Database schema is at version {}.".format(schema.schema_version(self.db)))
+
+    def check_balances(self, opts):
+        """Recompute the balances table from the ledger and report any drift."""
+        config = load_config(opts.config)
+        self.connect(config)
+
+        drift = self.ledger.rebuild_balances(fix=opts.rebuild_balances)
+        for user_low, user_high, stored, expected in drift:
+            print("Balance between {} and {} drifted: stored {}, ledger says {}".format(
+                user_low, user_high, self.format_amount(stored) if stored is not None else "nothing",
+                self.format_amount(expected),
+            ))
+        if not drift:
+            print("All balances match the ledger.")
+        elif opts.rebuild_balances:
+            print("Rebuilt {} drifted balances.".format(len(drift)))
+
+    def import_ledger(self, opts, args):
+        """Import transactions from CSV or JSON lines files."""
+        if not args:
+            raise SystemExit("Usage: debtbot.py import FILE...")
+        config = load_config(opts.config)
+        self.connect(config)
+
+        for path in args:
+            try:
+                format = guess_format(path, opts.format)
+            except ValueError as e:
+                raise SystemExit(str(e))
+            with open(path, newline='' if format == 'csv' else None, encoding='utf-8') as file:
+                try:
+                    count = self.import_transactions(read_records(file, format))
+                except LedgerImportError as e:
+                    print("Nothing was imported from {}:".format(path))
+                    for error in e.errors:
+                        print("  {}".format(error))
+                    raise SystemExit(1)
+            print("Imported {} transactions from {}.".format(count, path))
+
+    def export_ledger(self, opts, args):
+        """Export the transactions of a user, or between two users, as CSV or JSON lines."""
+        if not 1 <= len(args) <= 2:
+            raise SystemExit("Usage: debtbot.py export USER_ID [OTHER_USER_ID]")
+        config = load_config(opts.config)
+        self.connect(config)
+
+        uid = int(args[0])
+        other = int(args[1]) if len(args) > 1 else None
+        to_stdout = not opts.output or opts.output == '-'
+        try:
+            format = guess_format(opts.output, opts.format or ('csv' if to_stdout else None))
+        except ValueError as e:
+            raise SystemExit(str(e))
+        if to_stdout:
+            self.export_transactions(sys.stdout, uid, other, format)
+            return
+        with open(opts.output, 'w', newline='' if format == 'csv' else None, encoding='utf-8') as file:
+            count = self.export_transactions(file, uid, other, format)
+        print("Exported {} transactions to {}.".format(count, opts.output), file=sys.stderr)
+
+    def archive_ledger(self, opts, args):
+        """Move old transactions to the archive, keeping one carry-forward transaction per pair that still owes."""
+        if len(args) > 1:
+            raise SystemExit("Usage: debtbot.py archive [YYYY-MM-DD]")
+        config = load_config(opts.config)
+        self.connect(config)
+
+        if args:
+            try:
+                before = datetime.datetime.fromisoformat(args[0])
+            except ValueError:
+                raise SystemExit("Usage: debtbot.py archive [YYYY-MM-DD]")
+        elif config.get('archive_after_days'):
+            today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+            before = today - datetime.timedelta(days=config['archive_after_days'])
+        else:
+            raise SystemExit("Give the date to archive transactions before, or set archive_after_days in the config")
 
-        self.db = dataset.connect('sqlite:///{}'.format(config['db']))
+        try:
+            result = self.ledger.archive(before, dry_run=opts.dry_run)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        print("{} {} transactions from before {}, leaving {} carry-forward transactions.".format(
+            "Would archive" if opts.dry_run else "Archived", result['archived'], before.date(), result['carried']))
+        if result['size_before'] is not None:
+            saved = result['size_before'] - result['size_after']
+            print("The ledger and its indexes {} {:.1f} MB instead of {:.1f} MB, {:.1f} MB less.".format(
+                "would take" if opts.dry_run else "take", result['size_after'] / 1e6, result['size_before'] / 1e6,
+                saved / 1e6))
 
-        """Start the bot."""
-        # Create the EventHandler and pass it your bot's token.
-        updater = Updater(config['token'], use_context=True)
+    def ordered(self, handler):
+        """
+        Wraps a handler so it runs on the worker pool if there is one. Updates from the same user are still
+        handled one at a time and in order, while different users are handled in parallel.
+        """
+        if not self.executor:
+            return handler
 
-        # Get the dispatcher to register handlers
-        dp = updater.dispatcher
+        def submit(update, context):
+            key = update.effective_user.id if update.effective_user else None
+            self.executor.submit(key, self.run_handler, handler, update, context)
+
+        return submit
+
+    def instrumented(self, handler):
+        """Records how long a handler takes and how much it queries the database, and hands it on to ordered()."""
+        name = handler.__name__[len('handle_'):]
+        return self.ordered(self.metrics.instrument(name, handler, self.slow_update_ms))
+
+    def run_handler(self, handler, update, context):
+        try:
+            handler(update, context)
+        except Exception as e:
+            context.dispatcher.dispatch_error(update, e)
+
+    def record_update(self, update, context):
+        self.recorder.record(update)
 
-        dp.add_handler(CommandHandler("register", self.handle_register))
-        dp.add_handler(CommandHandler("start", self.handle_register))
+    def add_handlers(self, dp):
+        if self.recorder:
+            # Group -1 sees every update before the handlers below do
+            dp.add_handler(TypeHandler(Update, self.record_update), group=-1)
 
-        dp.add_handler(CommandHandler("debts", self.handle_debts))
+        dp.add_handler(CommandHandler("register", self.instrumented(self.handle_register)))
+        dp.add_handler(CommandHandler("start", self.instrumented(self.handle_register)))
 
-        dp.add_handler(CommandHandler("history", self.handle_history))
+        dp.add_handler(CommandHandler("debts", self.instrumented(self.handle_debts)))
 
-        dp.add_handler(CommandHandler("alias", self.handle_alias))
-        dp.add_handler(CommandHandler("unalias", self.handle_unalias))
+        dp.add_handler(CommandHandler("history", self.instrumented(self.handle_history)))
 
-        dp.add_handler(CommandHandler("help", self.handle_help))
+        dp.add_handler(CommandHandler("balance", self.instrumented(self.handle_balance)))
 
-        dp.add_handler(CallbackQueryHandler(self.handle_inline_button))
+        dp.add_handler(CommandHandler("search", self.instrumented(self.handle_search)))
+
+        dp.add_handler(CommandHandler("settle", self.instrumented(self.handle_settle)))
+
+        dp.add_handler(CommandHandler("export", self.instrumented(self.handle_export)))
+
+        dp.add_handler(CommandHandler("digest", self.instrumented(self.handle_digest)))
+
+        dp.add_handler(CommandHandler("alias", self.instrumented(self.handle_alias)))
+        dp.add_handler(CommandHandler("unalias", self.instrumented(self.handle_unalias)))
+
+        dp.add_handler(CommandHandler("help", self.instrumented(self.handle_help)))
+
+        dp.add_handler(CallbackQueryHandler(self.instrumented(self.handle_inline_button)))
 
         dp.add_error_handler(self.handle_error)
 
-        dp.add_handler(MessageHandler(None, self.handle_message))
+        dp.add_handler(MessageHandler(None, self.instrumented(self.handle_message)))
+
+    def watch_sender(self):
+        self.metrics.collect('debtbot_outgoing_messages_total', "Outgoing messages by method and what became of them",
+                             'counter', ['method', 'outcome'], lambda: self.sender.stats().items())
+        self.metrics.collect('debtbot_outgoing_coalesced_total', "Replies merged into a message already queued",
+                             'counter', [], lambda: [((), self.sender.coalesced)])
+        self.metrics.collect('debtbot_outgoing_backlog', "Messages waiting to be sent",
+                             'gauge', [], lambda: [((), self.sender.backlog())])
+        self.metrics.collect('debtbot_pending_actions', "Button actions waiting in memory",
+                             'gauge', [], lambda: [((), len(self.pending))])
+        self.metrics.collect('debtbot_pending_actions_spilled_total', "Button actions moved to the database",
+                             'counter', [], lambda: [((), self.pending.spilled)])
+
+    def watch_writer(self):
+        writer = self.db.writer
+        self.metrics.collect('debtbot_db_commits_total', "Commits of the database writer",
+                             'counter', [], lambda: [((), writer.batches)])
+        self.metrics.collect('debtbot_db_writes_total', "Writes committed by the database writer",
+                             'counter', [], lambda: [((), writer.writes)])
+        self.metrics.collect('debtbot_db_write_backlog', "Writes waiting for the database writer",
+                             'gauge', [], lambda: [((), writer.backlog())])
+
+    def watch_digests(self):
+        self.metrics.collect('debtbot_digests_sent_total', "Digests of open debts sent",
+                             'counter', [], lambda: [((), self.digests_sent)])
+        self.metrics.collect('debtbot_digest_seconds', "How long the last digest run took",
+                             'gauge', [], lambda: [((), self.digest_seconds)])
+
+    def schedule_digests(self, job_queue, config):
+        """Sends the digest every day, or on the given weekdays with 0 for Monday, at a time of day in UTC."""
+        at = datetime.time.fromisoformat(str(config.get('time', DIGEST_TIME)))
+        days = tuple(config.get('days', range(7)))
+        job_queue.run_daily(self.send_digests, at, days, name='digest')
+        weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+        self.digest_schedule = "{} at {} UTC".format(
+            "every day" if len(set(days)) == 7 else "every " + " and ".join(weekdays[day] for day in sorted(days)),
+            at.strftime('%H:%M'))
+        self.watch_digests()
+
+    def watch_caches(self):
+        caches = {
+            'users_by_id': self.users_by_id,
+            'users_by_name': self.users_by_name,
+            'aliases': self.aliases,
+            'debt_summaries': self.debt_summaries,
+        }
+        self.metrics.collect('debtbot_cache_hits_total', "Lookups answered from an in-memory cache",
+                             'counter', ['cache'], lambda: [((name,), c.hits) for name, c in caches.items()])
+        self.metrics.collect('debtbot_cache_misses_total', "Lookups that missed an in-memory cache",
+                             'counter', ['cache'], lambda: [((name,), c.misses) for name, c in caches.items()])
+        self.metrics.collect('debtbot_cache_entries', "Entries in an in-memory cache",
+                             'gauge', ['cache'], lambda: [((name,), len(c)) for name, c in caches.items()])
+
+    def serve_webhook(self, updater, config):
+        webhook = config['webhook']
+        dp = updater.dispatcher
+        server = WebhookServer(
+            (webhook.get('listen', '127.0.0.1'), webhook.get('port', 8443)),
+            webhook.get('path', '/'),
+            webhook.get('secret'),
+            dp,
+        )
+        if webhook.get('url'):
+            updater.bot.set_webhook(url=webhook['url'], secret_token=webhook['secret'])
+
+        dispatcher_thread = threading.Thread(target=dp.start, name='dispatcher')
+        dispatcher_thread.start()
+        updater.job_queue.start()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        logger.info("Listening for updates on %s:%s", *server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            updater.stop()
+            dispatcher_thread.join()
+
+    def run(self, opts):
+        config = load_config(opts.config)
+        self.connect(config)
+
+        workers = config.get('workers', 1)
+        if workers > 1:
+            self.executor = KeyedExecutor(workers)
+        if config.get('writer'):
+            self.db.start_writer(config['writer'].get('batch_size', WRITE_BATCH_SIZE),
+                                 config['writer'].get('max_delay_ms', 0) / 1000)
+            self.watch_writer()
+
+        """Start the bot."""
+        # Create the EventHandler and pass it your bot's token.
+        updater = Updater(config['token'], use_context=True)
 
-        # Start the Bot
-        updater.start_polling()
+        self.sender = SendQueue(updater.bot, **config.get('sender', {}))
+        self.slow_update_ms = config.get('slow_update_ms')
+        if config.get('record'):
+            self.recorder = UpdateRecorder(config['record']['path'], config['record'].get('key'))
+            logger.info("Recording updates to %s", config['record']['path'])
+        self.watch_sender()
+        self.watch_caches()
+        if config.get('metrics'):
+            metrics_server = MetricsServer(
+                (config['metrics'].get('listen', '127.0.0.1'), config['metrics'].get('port', 9464)),
+                self.metrics,
+            )
+            metrics_server.start()
 
-        # Run the bot until you press Ctrl-C or the process receives SIGINT,
-        # SIGTERM or SIGABRT. This should be used most of the time, since
-        # start_polling() is non-blocking and will stop the bot gracefully.
-        updater.idle()
+        if config.get('digest'):
+            self.schedule_digests(updater.job_queue, config['digest'])
 
+        # Get the dispatcher to register handlers
+        self.add_handlers(updater.dispatcher)
 
-def main(opts):
+        if config.get('mode', 'polling') == 'webhook':
+            self.serve_webhook(updater, config)
+        else:
+            # Start the Bot
+            updater.start_polling()
+
+            # Run the bot until you press Ctrl-C or the process receives SIGINT,
+            # SIGTERM or SIGABRT. This should be used most of the time, since
+            # start_polling() is non-blocking and will stop the bot gracefully.
+            updater.idle()
+
+        if self.executor:
+            self.executor.shutdown()
+        self.pending.flush()
+        self.db.stop_writer()
+        self.sender.stop()
+        if self.recorder:
+            self.recorder.close()
+
+
+def load_config(path):
+    with open(path, 'r') as configfile:
+        # config = yaml.load(configfile, Loader=yaml.FullLoader)
+        config = yaml.safe_load(configfile)
+    days = config.get('archive_after_days')
+    if days is not None and (not isinstance(days, (int, float)) or days <= 0):
+        raise SystemExit("archive_after_days in {} must be a positive number of days".format(path))
+    return config
+
+
+def main(opts, args):
+    if args:
+        command, args = args[0], args[1:]
+        if command == 'import':
+            DebtBot().import_ledger(opts, args)
+        elif command == 'export':
+            DebtBot().export_ledger(opts, args)
+        elif command == 'archive':
+            DebtBot().archive_ledger(opts, args)
+        else:
+            raise SystemExit("Unknown command {}, try import, export or archive".format(command))
+        return
+    if opts.migrate_only:
+        DebtBot().migrate_only(opts)
+        return
+    if opts.rebuild_balances or opts.verify_balances:
+        DebtBot().check_balances(opts)
+        return
     DebtBot().run(opts)
 
 
 if __name__ == '__main__':
     from optparse import OptionParser
-    parser = OptionParser()
+    parser = OptionParser(usage="%prog [options] [import FILE... | export USER_ID [OTHER_USER_ID] | archive [DATE]]")
     parser.add_option('-c', '--config', dest='config', default='config.yml', type='string',
                       help="Path of configuration file")
+    parser.add_option('--migrate-only', dest='migrate_only', default=False, action='store_true',
+                      help="Apply database schema migrations and exit")
+    parser.add_option('--verify-balances', dest='verify_balances', default=False, action='store_true',
+                      help="Compare the balances table with the transaction ledger and report any drift")
+    parser.add_option('--rebuild-balances', dest='rebuild_balances', default=False, action='store_true',
+                      help="Recompute the balances table from the transaction ledger")
+    parser.add_option('--format', dest='format', default=None, type='choice', choices=['csv', 'jsonl'],
+                      help="Format of imported or exported transactions, csv or jsonl. "
+                           "By default it's taken from the file name")
+    parser.add_option('-o', '--output', dest='output', default=None, type='string',
+                      help="File to export transactions to, instead of standard output")
+    parser.add_option('--dry-run', dest='dry_run', default=False, action='store_true',
+                      help="Only report what archive would do")
     (opts, args) = parser.parse_args()
-    main(opts)
+    main(opts, args)
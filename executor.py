@@ -0,0 +1,45 @@
+"""Runs update handlers on a pool of worker threads."""
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedExecutor:
+    """
+    A thread pool that runs tasks with the same key one after another, in the order they were submitted,
+    while tasks with different keys run in parallel.
+    """
+
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update')
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def submit(self, key, func, *args):
+        with self.lock:
+            queue = self.pending.get(key)
+            if queue is not None:
+                # A worker is already busy with this key and will pick the task up once it's done
+                queue.append((func, args))
+                return
+            self.pending[key] = deque()
+        self.pool.submit(self._drain, key, func, args)
+
+    def _drain(self, key, func, args):
+        while True:
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Task for %s failed", key)
+            with self.lock:
+                queue = self.pending[key]
+                if not queue:
+                    del self.pending[key]
+                    return
+                func, args = queue.popleft()
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
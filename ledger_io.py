@@ -0,0 +1,109 @@
+"""Reading and writing transactions as CSV or JSON lines, for importing and exporting the ledger."""
+import csv
+import datetime
+import json
+
+from money import to_minor, format_amount
+
+FORMATS = ('csv', 'jsonl')
+
+EXPORT_COLUMNS = ['id', 'timestamp', 'creditor', 'creditor_name', 'debitor', 'debitor_name', 'amount', 'reason']
+
+MAX_IMPORT_ERRORS = 20
+
+
+class LedgerImportError(ValueError):
+    def __init__(self, errors):
+        super().__init__("The imported transactions have problems, the first one is {}".format(errors[0]))
+        self.errors = errors
+
+
+def guess_format(path, format=None):
+    if format:
+        if format not in FORMATS:
+            raise ValueError("Unknown format {}, use one of {}".format(format, ', '.join(FORMATS)))
+        return format
+    for candidate in FORMATS:
+        if path.lower().endswith('.' + candidate):
+            return candidate
+    raise ValueError("Can't tell the format of {}, please give it with --format".format(path))
+
+
+def read_records(file, format):
+    """Yields (line number, dict) for every record of a CSV file with a header row or a JSON lines file."""
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for number, line in enumerate(file, 1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError as e:
+                    yield number, e
+
+
+def parse_record(record, decimals):
+    """
+    Turns an imported record into the values of a transactions row. Records have the same fields as exported ones,
+    and the creditor is the one who gave the debitor money. Raises ValueError if the record doesn't make sense.
+    """
+    if isinstance(record, Exception):
+        raise ValueError("not valid JSON ({})".format(record))
+    if not isinstance(record, dict):
+        raise ValueError("not an object")
+    missing = [column for column in ('creditor', 'debitor', 'amount') if record.get(column) in (None, '')]
+    if missing:
+        raise ValueError("missing {}".format(', '.join(missing)))
+
+    try:
+        creditor = int(record['creditor'])
+        debitor = int(record['debitor'])
+    except (TypeError, ValueError):
+        raise ValueError("user ids must be numbers")
+    if creditor == debitor:
+        raise ValueError("creditor and debitor are the same person")
+
+    amount = to_minor(record['amount'], decimals)
+    if amount <= 0:
+        raise ValueError("amount must be positive")
+
+    timestamp = datetime.datetime.now()
+    if record.get('timestamp'):
+        try:
+            timestamp = datetime.datetime.fromisoformat(str(record['timestamp']))
+        except ValueError:
+            raise ValueError("timestamp {!r} is not in ISO 8601 format".format(record['timestamp']))
+
+    return {
+        'creditor': creditor,
+        'debitor': debitor,
+        'amount': amount,
+        'reason': record.get('reason') or None,
+        # The same format storage.format_timestamp stores datetimes in, so imported rows sort along with the others
+        'timestamp': timestamp.isoformat(' ', 'microseconds'),
+    }
+
+
+def export_record(row, decimals):
+    record = {column: row.get(column) for column in EXPORT_COLUMNS}
+    record['amount'] = format_amount(row['amount'], decimals)
+    return record
+
+
+def write_records(file, rows, format, decimals):
+    """Writes transaction rows, which may come from a query that is still running, and returns how many there were."""
+    count = 0
+    if format == 'csv':
+        writer = csv.DictWriter(file, EXPORT_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(export_record(row, decimals))
+            count += 1
+    else:
+        for row in rows:
+            file.write(json.dumps(export_record(row, decimals), ensure_ascii=False))
+            file.write('\n')
+            count += 1
+    return count
@@ -0,0 +1,209 @@
+"""
+Counters and latency histograms of the bot, exposed in the Prometheus text format on an optional local HTTP endpoint.
+"""
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for label_values, value in sorted(values.items()):
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts, total = self.values.get(label_values, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[label_values] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+        for label_values, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       format_labels(self.labels, label_values, [('le', format_value(bound))]),
+                       cumulative)
+            yield self.name + '_sum', format_labels(self.labels, label_values), total
+            yield self.name + '_count', format_labels(self.labels, label_values), cumulative
+
+
+class Collected:
+    """Values which are read from somewhere else whenever the metrics are rendered."""
+
+    def __init__(self, name, help, type, labels, collect):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        for label_values, value in sorted(self.collect()):
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class UpdateStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = []
+        self.local = threading.local()
+
+        self.handler_seconds = self.add(Histogram(
+            'debtbot_handler_seconds', "Time spent handling an update", LATENCY_BUCKETS, ['handler']))
+        self.handler_errors = self.add(Counter(
+            'debtbot_handler_errors_total', "Updates whose handler raised an exception", ['handler']))
+        self.update_queries = self.add(Histogram(
+            'debtbot_update_db_queries', "Database queries per update", QUERY_COUNT_BUCKETS, ['handler']))
+        self.update_db_seconds = self.add(Histogram(
+            'debtbot_update_db_seconds', "Time spent in database queries per update", LATENCY_BUCKETS, ['handler']))
+        self.slow_updates = self.add(Counter(
+            'debtbot_slow_updates_total', "Updates that took longer than slow_update_ms", ['handler']))
+        self.parse_failures = self.add(Counter(
+            'debtbot_parse_failures_total', "Messages that couldn't be understood as a transaction"))
+        self.errors = self.add(Counter(
+            'debtbot_errors_total', "Errors reported to the dispatcher's error handler"))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, name, help, type, labels, collect):
+        """Registers a function which returns (label values, value) pairs when the metrics are rendered."""
+        return self.add(Collected(name, help, type, labels, collect))
+
+    def watch_database(self, db):
+        """
+        Counts the queries, and the time they take, of the update which is being handled on the current thread,
+        including those the database's writer thread runs for it.
+        """
+        db.listeners.append(self.record_query)
+
+    def record_query(self, seconds, queries=1):
+        stats = getattr(self.local, 'stats', None)
+        if stats is not None:
+            stats.queries += queries
+            stats.db_seconds += seconds
+
+    def instrument(self, name, handler, slow_ms=None):
+        """Wraps a handler so its latency and database use are recorded under `name`."""
+        def instrumented(update, context):
+            stats = self.local.stats = UpdateStats()
+            start = time.perf_counter()
+            try:
+                handler(update, context)
+            except Exception:
+                self.handler_errors.inc(name)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                self.local.stats = None
+                self.handler_seconds.observe(elapsed, name)
+                self.update_queries.observe(stats.queries, name)
+                self.update_db_seconds.observe(stats.db_seconds, name)
+                if slow_ms is not None and elapsed * 1000 >= slow_ms:
+                    self.slow_updates.inc(name)
+                    logger.warning("Slow update %s in %s: %.0f ms, %s queries taking %.0f ms",
+                                   update.update_id, name, elapsed * 1000, stats.queries, stats.db_seconds * 1000)
+
+        return instrumented
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.client_address[0], format % args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves the metrics on /metrics. Meant to listen on localhost only, it doesn't check who asks."""
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        super().__init__(address, MetricsHandler)
+        self.metrics = metrics
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        return thread
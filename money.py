@@ -0,0 +1,64 @@
+"""
+Amounts of money are stored as integers in the currency's minor unit, e.g. cents, so that sums are exact.
+The number of decimals of the minor unit is configurable and recorded in the database.
+"""
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+
+DEFAULT_DECIMALS = 2
+
+# SQLite stores integers in 64 bits
+MAX_MINOR = 2 ** 63 - 1
+
+
+def to_minor(amount, decimals):
+    """Converts an amount in major units, given as a string, Decimal or number, to an integer in minor units.
+    Anything more precise than the minor unit is rounded half away from zero. Raises ValueError if the result
+    would be larger than MAX_MINOR."""
+    try:
+        value = Decimal(str(amount)).scaleb(decimals)
+    except InvalidOperation:
+        raise ValueError("Not an amount: {!r}".format(amount))
+    if not value.is_finite():
+        raise ValueError("Not an amount: {!r}".format(amount))
+    # Checked before rounding, which fails for numbers with more digits than Decimal keeps
+    if abs(value) > MAX_MINOR:
+        raise ValueError("Amount too large: {!r}".format(amount))
+    return int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def format_amount(minor, decimals):
+    """Formats an amount in minor units as a string in major units, e.g. 1250 -> '12.50'."""
+    return str(Decimal(minor).scaleb(-decimals).quantize(Decimal(1).scaleb(-decimals)))
+
+
+def split_amount(total, parts):
+    """
+    Splits an amount in minor units into `parts` shares which differ by at most one minor unit and add up to
+    exactly `total`. The remainder goes to the first shares, so the same split always comes out the same way.
+    """
+    if parts < 1:
+        raise ValueError("Can't split an amount into {} parts".format(parts))
+    share, remainder = divmod(abs(total), parts)
+    sign = -1 if total < 0 else 1
+    return [sign * (share + 1)] * remainder + [sign * share] * (parts - remainder)
+
+
+def split_weighted(total, weights):
+    """
+    Splits an amount in minor units into shares proportional to `weights`, which add up to exactly `total`.
+    Each share is rounded down first, and the minor units left over go to the shares that lost the most by
+    rounding, the earlier ones first on ties. With equal weights, this is the same as split_amount().
+    """
+    weight_sum = sum(weights)
+    if weight_sum <= 0 or any(w < 0 for w in weights):
+        raise ValueError("Can't split an amount by weights {}".format(weights))
+    sign = -1 if total < 0 else 1
+    shares = []
+    remainders = []
+    for i, weight in enumerate(weights):
+        share, remainder = divmod(abs(total) * weight, weight_sum)
+        shares.append(share)
+        remainders.append((-remainder, i))
+    for remainder, i in sorted(remainders)[:abs(total) - sum(shares)]:
+        shares[i] += 1
+    return [sign * share for share in shares]
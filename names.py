@@ -0,0 +1,25 @@
+"""Normalization of user names for the full-name search index."""
+import unicodedata
+
+
+def normalize_name(*parts):
+    """
+    Joins the given name parts into the form stored in users.full_name: case-folded, without diacritics,
+    and with all whitespace collapsed to single spaces. Missing parts are skipped.
+    """
+    name = " ".join(part for part in parts if part)
+    name = unicodedata.normalize('NFKD', name.casefold())
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return " ".join(name.split())
+
+
+def name_search_query(text):
+    """
+    Builds an FTS5 query that matches every name containing a word starting with each word of the text.
+    Every word is quoted, so user input can never be interpreted as FTS5 query syntax.
+    Returns None if the text contains nothing searchable.
+    """
+    words = [word for word in normalize_name(text).split() if any(c.isalnum() for c in word)]
+    if not words:
+        return None
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in words)
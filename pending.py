@@ -0,0 +1,76 @@
+"""
+Actions which wait for the user to press an inline keyboard button.
+
+Buttons only carry a short random token, which is looked up here when they are pressed. Every action can be taken
+only once and expires after a while, so pressing a button twice or pressing an old one does nothing.
+"""
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# How long a button keeps working, in seconds
+DEFAULT_TTL = 24 * 60 * 60
+
+MAX_ENTRIES = 10000
+
+# 12 characters, which leaves plenty of Telegram's 64 bytes of callback data for the button's choice
+TOKEN_BYTES = 9
+
+
+class PendingActions:
+    """
+    A thread-safe map from tokens to pending actions, which are dicts that can be encoded as JSON. It keeps up to
+    max_entries actions in memory. With a PendingActionStore, the ones that don't fit any more are spilled to the
+    database instead of being dropped, as are all of them when the bot stops, so buttons survive restarts.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES, store=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.store = store
+        self.spilled = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, action):
+        """Stores an action and returns the token it can be taken with."""
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        now = time.time()
+        with self._lock:
+            # All entries live equally long, so the oldest ones are always the first to expire
+            while self._entries and next(iter(self._entries.values()))[0] < now:
+                self._entries.popitem(last=False)
+            self._entries[token] = (now + self.ttl, action)
+            overflow = [self._entries.popitem(last=False) for _ in range(len(self._entries) - self.max_entries)]
+        self.spill(overflow)
+        return token
+
+    def take(self, token):
+        """Returns the action stored under a token and forgets it, or None if it expired or was taken before."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(token, None)
+        if entry is None and self.store:
+            entry = self.store.take(token)
+        if entry is None or entry[0] < now:
+            return None
+        return entry[1]
+
+    def spill(self, entries):
+        if entries and self.store:
+            self.store.expire(time.time())
+            self.store.put_many(entries)
+            self.spilled += len(entries)
+
+    def flush(self):
+        """Moves all actions to the database, if there is one."""
+        if not self.store:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+            self._entries.clear()
+        self.spill(entries)
+
+    def __len__(self):
+        return len(self._entries)
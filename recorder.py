@@ -0,0 +1,61 @@
+"""
+Records incoming updates to a JSON lines file, so that real traffic can be replayed with benchmarks/replay.py.
+
+User and chat ids are replaced by a keyed hash before anything is written. The same id always becomes the same
+anonymous id under the same key, so who talks to whom is kept, but the real ids can't be recovered without the key.
+Names and message texts are recorded as they are.
+"""
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+
+# Objects in an update whose "id" is that of a user or a chat
+ID_OBJECTS = {'from', 'chat', 'user', 'forward_from', 'forward_from_chat', 'sender_chat', 'via_bot',
+              'left_chat_member', 'new_chat_members'}
+
+
+def anonymize_id(key, id):
+    """Maps a user or chat id to a 48 bit id with the same sign, which group chats rely on."""
+    digest = hmac.new(key, str(abs(id)).encode(), hashlib.sha256).digest()
+    anonymous = int.from_bytes(digest[:6], 'big') or 1
+    return -anonymous if id < 0 else anonymous
+
+
+class UpdateRecorder:
+    """
+    Appends updates to a file, one {"time": ..., "update": ...} object per line. Without a key, a random one is used,
+    so recordings of different runs of the bot can't be joined up by their ids.
+    """
+
+    def __init__(self, path, key=None):
+        self.key = key.encode() if key else secrets.token_bytes(32)
+        self.recorded = 0
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def anonymize(self, value, ids=False):
+        if isinstance(value, dict):
+            anonymous = {}
+            for k, v in value.items():
+                if ((ids and k == 'id') or k == 'user_id') and isinstance(v, int):
+                    anonymous[k] = anonymize_id(self.key, v)
+                else:
+                    anonymous[k] = self.anonymize(v, k in ID_OBJECTS)
+            return anonymous
+        if isinstance(value, list):
+            return [self.anonymize(v, ids) for v in value]
+        return value
+
+    def record(self, update):
+        line = json.dumps({'time': round(time.time(), 3), 'update': self.anonymize(update.to_dict())},
+                          ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,272 @@
+"""
+Versioned database schema of the debt bot.
+
+The schema version is kept in SQLite's user_version pragma. Every entry of MIGRATIONS upgrades the
+database by one version and is applied in its own transaction. An entry is a list of steps, each of
+which is either an SQL statement or a function that gets the database to work with and the bot's
+settings, such as the number of decimals amounts are stored with.
+"""
+import logging
+
+from money import DEFAULT_DECIMALS
+from names import normalize_name
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = [
+    # 1: Explicit tables with typed columns, the balances table, and indexes for all lookups.
+    [
+        'CREATE TABLE IF NOT EXISTS users ('
+        'id INTEGER PRIMARY KEY, '
+        'user_id INTEGER NOT NULL, '
+        'first_name TEXT, '
+        'last_name TEXT, '
+        'username TEXT, '
+        'username_lower TEXT)',
+        'CREATE TABLE IF NOT EXISTS transactions ('
+        'id INTEGER PRIMARY KEY, '
+        'creditor INTEGER NOT NULL, '
+        'debitor INTEGER NOT NULL, '
+        'amount FLOAT NOT NULL, '
+        'reason TEXT, '
+        'timestamp DATETIME)',
+        'CREATE TABLE IF NOT EXISTS aliases ('
+        'id INTEGER PRIMARY KEY, '
+        'owner_id INTEGER NOT NULL, '
+        'target_id INTEGER NOT NULL, '
+        'alias TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS balances ('
+        'user_low INTEGER NOT NULL, '
+        'user_high INTEGER NOT NULL, '
+        'balance FLOAT NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (user_low, user_high))',
+        # Databases created before this migration have no unique constraints, so drop any duplicates first
+        'DELETE FROM users WHERE id NOT IN (SELECT MAX(id) FROM users GROUP BY user_id)',
+        'DELETE FROM aliases WHERE id NOT IN (SELECT MAX(id) FROM aliases GROUP BY owner_id, alias)',
+        'CREATE INDEX IF NOT EXISTS ix_transactions_pair ON transactions (creditor, debitor, timestamp)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_users_user_id ON users (user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (username_lower)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_aliases_owner_alias ON aliases (owner_id, alias)',
+        'CREATE INDEX IF NOT EXISTS ix_balances_user_high ON balances (user_high)',
+        'INSERT OR REPLACE INTO balances (user_low, user_high, balance) '
+        'SELECT MIN(creditor, debitor), MAX(creditor, debitor), '
+        'SUM(CASE WHEN creditor < debitor THEN amount ELSE -amount END) '
+        'FROM transactions '
+        'GROUP BY MIN(creditor, debitor), MAX(creditor, debitor)',
+    ],
+]
+
+
+def backfill_full_names(db, settings):
+    users = list(db.query('SELECT user_id, first_name, last_name FROM users'))
+    for user in users:
+        db.query('UPDATE users SET full_name = :full_name WHERE user_id = :user_id',
+                 full_name=normalize_name(user['first_name'], user['last_name']),
+                 user_id=user['user_id'])
+
+
+MIGRATIONS.append(
+    # 2: Normalized full names with an FTS5 index for resolving people by name.
+    [
+        'ALTER TABLE users ADD COLUMN full_name TEXT',
+        backfill_full_names,
+        "CREATE VIRTUAL TABLE users_fts USING fts5(full_name, tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')",
+        'INSERT INTO users_fts (rowid, full_name) SELECT user_id, full_name FROM users',
+        'CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN '
+        'INSERT INTO users_fts (rowid, full_name) VALUES (new.user_id, new.full_name); '
+        'END',
+        'CREATE TRIGGER users_fts_update AFTER UPDATE OF user_id, full_name ON users BEGIN '
+        'DELETE FROM users_fts WHERE rowid = old.user_id; '
+        'INSERT INTO users_fts (rowid, full_name) VALUES (new.user_id, new.full_name); '
+        'END',
+        'CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN '
+        'DELETE FROM users_fts WHERE rowid = old.user_id; '
+        'END',
+    ]
+)
+
+
+def store_decimals(db, settings):
+    db.query("INSERT INTO settings (key, value) VALUES ('decimals', :decimals)",
+             decimals=str(settings.get('decimals', DEFAULT_DECIMALS)))
+
+
+def convert_amounts(db, settings):
+    scale = 10 ** int(settings.get('decimals', DEFAULT_DECIMALS))
+    db.query('INSERT INTO transactions_new (id, creditor, debitor, amount, reason, timestamp) '
+             'SELECT id, creditor, debitor, CAST(ROUND(amount * {}) AS INTEGER), reason, timestamp '
+             'FROM transactions'.format(scale))
+
+
+MIGRATIONS.append(
+    # 3: Amounts as integers in the currency's minor unit. SQLite can't change a column's type, so the
+    # ledger and the balances are copied into new tables.
+    [
+        'CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+        store_decimals,
+        'CREATE TABLE transactions_new ('
+        'id INTEGER PRIMARY KEY, '
+        'creditor INTEGER NOT NULL, '
+        'debitor INTEGER NOT NULL, '
+        'amount INTEGER NOT NULL, '
+        'reason TEXT, '
+        'timestamp DATETIME)',
+        convert_amounts,
+        'DROP TABLE transactions',
+        'ALTER TABLE transactions_new RENAME TO transactions',
+        'CREATE INDEX ix_transactions_pair ON transactions (creditor, debitor, timestamp)',
+        'DROP TABLE balances',
+        'CREATE TABLE balances ('
+        'user_low INTEGER NOT NULL, '
+        'user_high INTEGER NOT NULL, '
+        'balance INTEGER NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (user_low, user_high))',
+        'CREATE INDEX ix_balances_user_high ON balances (user_high)',
+        'INSERT INTO balances (user_low, user_high, balance) '
+        'SELECT MIN(creditor, debitor), MAX(creditor, debitor), '
+        'SUM(CASE WHEN creditor < debitor THEN amount ELSE -amount END) '
+        'FROM transactions '
+        'GROUP BY MIN(creditor, debitor), MAX(creditor, debitor)',
+    ]
+)
+
+MIGRATIONS.append(
+    # 4: Index for reading all transactions of one user, which so far could only be found by creditor.
+    [
+        'CREATE INDEX ix_transactions_debitor ON transactions (debitor, timestamp)',
+    ]
+)
+
+# Every CHECKPOINT_INTERVAL-th transaction of a pair gets a checkpoint with the balance after it
+CHECKPOINT_INTERVAL = 100
+
+# Computes the checkpoints of the pairs matching {where}, which is a condition on user_low and user_high
+CHECKPOINTS_QUERY = (
+    'SELECT user_low, user_high, position, id AS txn_id, timestamp, balance FROM ('
+    '  SELECT MIN(creditor, debitor) AS user_low, MAX(creditor, debitor) AS user_high, id, timestamp, '
+    '  ROW_NUMBER() OVER pair AS position, '
+    '  SUM(CASE WHEN creditor < debitor THEN amount ELSE -amount END) OVER pair AS balance '
+    '  FROM transactions '
+    '  WINDOW pair AS (PARTITION BY MIN(creditor, debitor), MAX(creditor, debitor) ORDER BY timestamp, id)'
+    ') '
+    'WHERE position % {interval} = 0 AND {where}'
+)
+
+
+def build_checkpoints(db, settings=None, where='true'):
+    db.query('INSERT INTO checkpoints (user_low, user_high, position, txn_id, timestamp, balance) ' +
+             CHECKPOINTS_QUERY.format(interval=CHECKPOINT_INTERVAL, where=where))
+
+
+MIGRATIONS.append(
+    # 5: Periodic balance checkpoints per pair, so balances at any point in time can be found quickly.
+    [
+        'CREATE TABLE checkpoints ('
+        'user_low INTEGER NOT NULL, '
+        'user_high INTEGER NOT NULL, '
+        'position INTEGER NOT NULL, '
+        'txn_id INTEGER NOT NULL, '
+        'timestamp DATETIME, '
+        'balance INTEGER NOT NULL, '
+        'PRIMARY KEY (user_low, user_high, position))',
+        'CREATE INDEX ix_checkpoints_time ON checkpoints (user_low, user_high, timestamp, txn_id)',
+        build_checkpoints,
+    ]
+)
+
+MIGRATIONS.append(
+    # 6: Pending inline keyboard actions which didn't fit in memory or outlived a restart.
+    [
+        'CREATE TABLE pending_actions ('
+        'token TEXT PRIMARY KEY, '
+        'expires REAL NOT NULL, '
+        'action TEXT NOT NULL)',
+        'CREATE INDEX ix_pending_actions_expires ON pending_actions (expires)',
+    ]
+)
+
+MIGRATIONS.append(
+    # 7: Archive of old transactions. What an archived pair still owes is kept in the ledger as one carry-forward
+    # transaction, which records how many archived transactions it stands for in `carried`.
+    [
+        'CREATE TABLE transactions_archive ('
+        'id INTEGER PRIMARY KEY, '
+        'creditor INTEGER NOT NULL, '
+        'debitor INTEGER NOT NULL, '
+        'amount INTEGER NOT NULL, '
+        'reason TEXT, '
+        'timestamp DATETIME)',
+        'CREATE INDEX ix_archive_pair ON transactions_archive (creditor, debitor, timestamp)',
+        'CREATE INDEX ix_archive_debitor ON transactions_archive (debitor, timestamp)',
+        'ALTER TABLE transactions ADD COLUMN carried INTEGER',
+    ]
+)
+
+MIGRATIONS.append(
+    # 8: Whether a user gets the periodic digest of their open debts.
+    [
+        'ALTER TABLE users ADD COLUMN digest INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX ix_users_digest ON users (user_id) WHERE digest',
+    ]
+)
+
+# The parties of a transaction as FTS5 tokens, so searches can be narrowed down to a user within the index
+TRANSACTION_PARTIES = "'u' || {0}.creditor || ' u' || {0}.debitor"
+
+MIGRATIONS.append(
+    # 9: FTS5 index over the reasons of transactions. It is contentless, since the text is in the ledger already, so
+    # removing a row needs the values it was indexed with.
+    [
+        "CREATE VIRTUAL TABLE transactions_fts USING fts5(reason, parties, content='', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        'INSERT INTO transactions_fts (rowid, reason, parties) '
+        'SELECT id, reason, ' + TRANSACTION_PARTIES.format('transactions') + ' FROM transactions '
+        'WHERE reason IS NOT NULL',
+        'CREATE TRIGGER transactions_fts_insert AFTER INSERT ON transactions WHEN new.reason IS NOT NULL BEGIN '
+        'INSERT INTO transactions_fts (rowid, reason, parties) '
+        'VALUES (new.id, new.reason, ' + TRANSACTION_PARTIES.format('new') + '); '
+        'END',
+        'CREATE TRIGGER transactions_fts_delete AFTER DELETE ON transactions WHEN old.reason IS NOT NULL BEGIN '
+        "INSERT INTO transactions_fts (transactions_fts, rowid, reason, parties) "
+        "VALUES ('delete', old.id, old.reason, " + TRANSACTION_PARTIES.format('old') + '); '
+        'END',
+        'CREATE TRIGGER transactions_fts_update AFTER UPDATE OF id, creditor, debitor, reason ON transactions BEGIN '
+        "INSERT INTO transactions_fts (transactions_fts, rowid, reason, parties) "
+        "SELECT 'delete', old.id, old.reason, " + TRANSACTION_PARTIES.format('old') + ' WHERE old.reason IS NOT NULL; '
+        'INSERT INTO transactions_fts (rowid, reason, parties) '
+        'SELECT new.id, new.reason, ' + TRANSACTION_PARTIES.format('new') + ' WHERE new.reason IS NOT NULL; '
+        'END',
+    ]
+)
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def schema_version(db):
+    return db.query('PRAGMA user_version').fetchone()[0]
+
+
+def get_setting(db, key, default=None):
+    if schema_version(db) < 3:
+        return default
+    row = db.query('SELECT value FROM settings WHERE key = :key', key=key).fetchone()
+    return row['value'] if row else default
+
+
+def migrate(db, settings=None):
+    """Brings the database up to LATEST_VERSION. Returns the version the database was at before."""
+    settings = settings or {}
+    version = schema_version(db)
+    if version > LATEST_VERSION:
+        raise RuntimeError("Database schema version {} is newer than this bot ({})".format(version, LATEST_VERSION))
+
+    for number in range(version + 1, LATEST_VERSION + 1):
+        with db as tx:
+            for step in MIGRATIONS[number - 1]:
+                if callable(step):
+                    step(tx, settings)
+                else:
+                    tx.query(step)
+            tx.query('PRAGMA user_version = {}'.format(number))
+        logger.info("Migrated database schema to version %s", number)
+    return version
@@ -0,0 +1,248 @@
+"""Sends outgoing messages from a queue, staying within Telegram's flood limits."""
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall, and about one per second in a single chat
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+SENDER_THREADS = 4
+MAX_ATTEMPTS = 3
+MAX_MESSAGE_LENGTH = 4096
+COALESCE_SEPARATOR = "\n\n"
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+def options(kwargs):
+    return {key: value for key, value in kwargs.items() if key != 'text'}
+
+
+class Outgoing:
+    def __init__(self, method, chat_id, kwargs):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.attempts = 0
+
+    def can_absorb(self, other):
+        """Whether `other` can be sent as part of this message instead of as a message of its own."""
+        if self.method != 'send_message' or other.method != 'send_message':
+            return False
+        # Everything but the text has to match, or e.g. replies to different messages in a group would become one
+        if self.kwargs.get('reply_markup') or options(self.kwargs) != options(other.kwargs):
+            return False
+        length = len(self.kwargs['text']) + len(COALESCE_SEPARATOR) + len(other.kwargs['text'])
+        return length <= MAX_MESSAGE_LENGTH
+
+    def absorb(self, other):
+        self.kwargs = dict(other.kwargs, text=self.kwargs['text'] + COALESCE_SEPARATOR + other.kwargs['text'])
+
+
+class SendQueue:
+    """
+    Queues outgoing messages and sends them from a few background threads, so handlers don't have to wait for
+    Telegram. Messages to the same chat go out in order, one at a time. A global and a per-chat token bucket keep
+    the bot within Telegram's flood limits, and if Telegram asks us to back off anyway, the chat is paused for as
+    long as it says. Consecutive plain messages to a chat which are still waiting are merged into one.
+
+    `bot` is anything with `send_message`, `edit_message_text` and `send_document` methods like telegram.Bot.
+    """
+
+    def __init__(self, bot, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST, chat_rate=CHAT_RATE,
+                 chat_burst=CHAT_BURST, threads=SENDER_THREADS):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.lock = threading.Condition()
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        self.chat_buckets = {}
+        self.pending = OrderedDict()
+        self.in_flight = set()
+        self.paused = {}
+        self.last_prune = time.monotonic()
+        self.stopping = False
+        self.sent = 0
+        self.coalesced = 0
+        self.outcomes = Counter()
+        self.threads = [threading.Thread(target=self._work, name='sender-{}'.format(i), daemon=True)
+                        for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._enqueue(Outgoing('send_message', chat_id, dict(kwargs, text=text)))
+
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self._enqueue(Outgoing('edit_message_text', chat_id, dict(kwargs, message_id=message_id, text=text)))
+
+    def send_document(self, chat_id, document, **kwargs):
+        """Sends a file. The queue closes it once it has been sent."""
+        self._enqueue(Outgoing('send_document', chat_id, dict(kwargs, document=document)))
+
+    def _enqueue(self, message):
+        with self.lock:
+            queue = self.pending.get(message.chat_id)
+            if queue is None:
+                queue = self.pending[message.chat_id] = deque()
+            if queue and queue[-1].can_absorb(message):
+                queue[-1].absorb(message)
+                self.coalesced += 1
+            else:
+                queue.append(message)
+            self.lock.notify()
+
+    def _next(self, now):
+        """
+        Picks the next message which may be sent right now. Returns it, or the number of seconds until one might be,
+        or None if there is nothing to send. Must be called with the lock held.
+        """
+        if not self.pending:
+            return None
+        wait = self.global_bucket.wait_time(now)
+        if wait:
+            return wait
+
+        for chat_id, queue in self.pending.items():
+            if chat_id in self.in_flight:
+                continue
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+            chat_wait = max(bucket.wait_time(now), self.paused.get(chat_id, now) - now)
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+
+            bucket.take()
+            self.global_bucket.take()
+            self.paused.pop(chat_id, None)
+            message = queue.popleft()
+            # Let the other chats go first next time
+            del self.pending[chat_id]
+            if queue:
+                self.pending[chat_id] = queue
+            self.in_flight.add(chat_id)
+            return message
+        return wait
+
+    def _prune(self, now):
+        # Buckets which have filled up again behave like new ones, no need to keep them around
+        for chat_id in [c for c, b in self.chat_buckets.items() if c not in self.pending and b.full(now)]:
+            del self.chat_buckets[chat_id]
+        self.last_prune = now
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while True:
+                    now = time.monotonic()
+                    if now - self.last_prune > 60:
+                        self._prune(now)
+                    message = self._next(now)
+                    if isinstance(message, Outgoing):
+                        break
+                    if self.stopping and not self.pending and not self.in_flight:
+                        self.lock.notify_all()
+                        return
+                    self.lock.wait(message)
+            self._deliver(message)
+
+    def _deliver(self, message):
+        retry_after = None
+        sent = False
+        outcome = 'sent'
+        document = message.kwargs.get('document')
+        if document is not None:
+            document.seek(0)
+        try:
+            getattr(self.bot, message.method)(chat_id=message.chat_id, **message.kwargs)
+            sent = True
+        except BadRequest as e:
+            # BadRequest is a NetworkError in python-telegram-bot 13, but there's no point in trying again
+            logger.error("Telegram refused message to chat %s: %s", message.chat_id, e)
+            outcome = 'refused'
+        except RetryAfter as e:
+            logger.warning("Flood limit hit in chat %s, retrying in %s seconds", message.chat_id, e.retry_after)
+            retry_after = e.retry_after
+            outcome = 'flood_wait'
+        except (TimedOut, NetworkError) as e:
+            message.attempts += 1
+            if message.attempts < MAX_ATTEMPTS:
+                logger.warning("Sending to chat %s failed (%s), retrying", message.chat_id, e)
+                retry_after = message.attempts
+                outcome = 'retried'
+            else:
+                logger.error("Giving up on message to chat %s: %s", message.chat_id, e)
+                outcome = 'failed'
+        except TelegramError as e:
+            logger.error("Could not send message to chat %s: %s", message.chat_id, e)
+            outcome = 'failed'
+
+        if document is not None and retry_after is None:
+            document.close()
+
+        with self.lock:
+            self.in_flight.discard(message.chat_id)
+            if sent:
+                self.sent += 1
+            self.outcomes[message.method, outcome] += 1
+            if retry_after is not None:
+                self.paused[message.chat_id] = time.monotonic() + retry_after
+                queue = self.pending.get(message.chat_id)
+                if queue is None:
+                    queue = self.pending[message.chat_id] = deque()
+                queue.appendleft(message)
+            self.lock.notify_all()
+
+    def stats(self):
+        """Returns how many times each kind of message was sent, retried or given up on, by (method, outcome)."""
+        with self.lock:
+            return dict(self.outcomes)
+
+    def backlog(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.pending.values())
+
+    def stop(self, timeout=10):
+        """Sends whatever is still queued, waiting for at most `timeout` seconds, and stops the sender threads."""
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        if self.backlog():
+            logger.warning("Dropped %s unsent messages", self.backlog())
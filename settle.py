@@ -0,0 +1,44 @@
+"""Works out how a group of people can settle all their debts with few payments."""
+import heapq
+from collections import defaultdict
+
+
+def plan_settlement(nets):
+    """
+    Takes a dict of user id -> net balance in cents, positive if the user is owed money and negative if they owe
+    money, and returns a list of (payer, payee, cents) payments that bring everyone to zero.
+
+    Finding the smallest possible number of payments is NP-hard, so this first pairs up people whose balances cancel
+    out exactly and then repeatedly lets the biggest debtor pay the biggest creditor. That needs at most one payment
+    less than there are people, and usually far fewer, in O(n log n).
+    """
+    creditors = defaultdict(list)
+    debtors = defaultdict(list)
+    for user, net in sorted(nets.items()):
+        if net > 0:
+            creditors[net].append(user)
+        elif net < 0:
+            debtors[-net].append(user)
+
+    payments = []
+    for amount in sorted(set(creditors) & set(debtors)):
+        while creditors[amount] and debtors[amount]:
+            payments.append((debtors[amount].pop(), creditors[amount].pop(), amount))
+
+    creditor_heap = [(-amount, user) for amount, users in creditors.items() for user in users]
+    debtor_heap = [(-amount, user) for amount, users in debtors.items() for user in users]
+    heapq.heapify(creditor_heap)
+    heapq.heapify(debtor_heap)
+
+    # If the balances don't add up to zero exactly, whatever is left over once one side runs out is ignored
+    while creditor_heap and debtor_heap:
+        credit, creditor = heapq.heappop(creditor_heap)
+        debt, debtor = heapq.heappop(debtor_heap)
+        amount = min(-credit, -debt)
+        payments.append((debtor, creditor, amount))
+        if -credit > amount:
+            heapq.heappush(creditor_heap, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtor_heap, (debt + amount, debtor))
+
+    return payments
@@ -0,0 +1,959 @@
+"""
+Storage of the debt bot: users, aliases and the transaction ledger in SQLite.
+
+The bot only talks to UserStore, AliasStore and LedgerStore. They share a Database, which uses the standard
+library's sqlite3 module directly: every thread gets its own connection with a cache of prepared statements, and rows
+are sqlite3 rows, i.e. tuples whose columns can also be looked up by name.
+"""
+import datetime
+import itertools
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import schema
+from names import normalize_name, name_search_query
+
+logger = logging.getLogger(__name__)
+
+# How long a writer waits for another one to finish, in seconds
+BUSY_TIMEOUT = 30
+
+# Prepared statements kept per connection. The bot runs a few dozen distinct statements.
+STATEMENT_CACHE_SIZE = 256
+
+IMPORT_BATCH_SIZE = 10000
+
+# Page cache for bulk imports, in KiB. Inserting into the ledger's indexes is about twice as fast when they fit.
+IMPORT_CACHE_SIZE = 64 * 1024
+
+# How long before the archive horizon carry-forward transactions are dated, so nothing left in the ledger precedes them
+CARRY_OFFSET = datetime.timedelta(microseconds=1)
+
+MAX_NAME_SCAN = 1000
+MAX_SEARCH_SCAN = 1000
+
+# Writes the group-commit writer commits together at most
+WRITE_BATCH_SIZE = 256
+
+_memory_databases = itertools.count(1)
+
+
+def pair_key(uid1, uid2):
+    """
+    Returns the (user_low, user_high) key of the balances row for two users, along with the sign
+    that converts the stored balance into the amount uid2 owes uid1.
+    The stored balance is always the amount user_high owes user_low.
+    """
+    uid1 = int(uid1)
+    uid2 = int(uid2)
+    if uid1 <= uid2:
+        return uid1, uid2, 1
+    return uid2, uid1, -1
+
+
+def format_timestamp(timestamp):
+    """Timestamps are stored as text which sorts chronologically, always with microseconds."""
+    return timestamp.isoformat(' ', 'microseconds')
+
+
+class DryRun(Exception):
+    """Rolls back a write that was only made to see what it would do, and carries what it found."""
+
+    def __init__(self, result):
+        super().__init__()
+        self.result = result
+
+
+class Row(sqlite3.Row):
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except IndexError:
+            return default
+
+
+class Database:
+    """
+    A SQLite database shared by all threads. Every thread gets its own connection, and `with db:` runs a block in a
+    transaction on it, which is committed at the end or rolled back if the block raises. Nested blocks become
+    savepoints. Outside of a block every statement commits by itself.
+
+    The path ':memory:' gives a database that only lives in memory, as long as this object does. It is meant for
+    tests: its connections share one cache, so readers see changes that aren't committed yet.
+
+    The stores make their changes through write(). Once start_writer() has been called, those are committed in
+    batches by a single writer thread instead of by the threads that make them.
+    """
+
+    def __init__(self, path, timeout=BUSY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.uri = False
+        self.local = threading.local()
+        self.listeners = []
+        self.writer = None
+        if path == ':memory:':
+            # Separate connections to ':memory:' would each get their own empty database, unless they share a cache
+            self.path = 'file:debtbot-{}?mode=memory&cache=shared'.format(next(_memory_databases))
+            self.uri = True
+            self.keepalive = self.connection
+        else:
+            # Readers never wait for writers in WAL mode
+            self.query('PRAGMA journal_mode=WAL')
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE,
+                                         uri=self.uri)
+            connection.row_factory = Row
+            if self.uri:
+                # Otherwise readers would lock the tables they read against writers of other connections
+                connection.execute('PRAGMA read_uncommitted = 1')
+            self.local.connection = connection
+            self.local.depth = 0
+        return connection
+
+    def query(self, sql, **params):
+        """Runs a statement and returns a cursor, which fetches the resulting rows while it is iterated over."""
+        if not self.listeners:
+            return self.connection.execute(sql, params)
+        start = time.perf_counter()
+        try:
+            return self.connection.execute(sql, params)
+        finally:
+            self.notify(time.perf_counter() - start)
+
+    def executemany(self, sql, rows):
+        """Runs a statement once for every row of parameters, which may be tuples for ? placeholders or dicts."""
+        if not self.listeners:
+            return self.connection.executemany(sql, rows)
+        start = time.perf_counter()
+        try:
+            return self.connection.executemany(sql, rows)
+        finally:
+            self.notify(time.perf_counter() - start)
+
+    def notify(self, seconds, queries=1):
+        tally = getattr(self.local, 'tally', None)
+        if tally is not None:
+            # The writer runs this for another thread, which reports it as its own once the write is done
+            tally.queries += queries
+            tally.db_seconds += seconds
+            return
+        for listener in self.listeners:
+            listener(seconds, queries)
+
+    def __enter__(self):
+        connection = self.connection
+        depth = self.local.depth
+        # IMMEDIATE takes the write lock right away. A transaction that starts out reading and then tries to write
+        # would fail instead of waiting if another connection wrote in the meantime.
+        if depth == 0:
+            self.begin(connection)
+        else:
+            connection.execute('SAVEPOINT nested_{}'.format(depth))
+        self.local.depth = depth + 1
+        return self
+
+    def begin(self, connection):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                # Connections to an in-memory database fail right away instead of waiting for each other
+                if not self.uri or 'locked' not in str(e) or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.001)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = self.connection
+        depth = self.local.depth = self.local.depth - 1
+        if depth == 0:
+            connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        else:
+            if exc_type is not None:
+                connection.execute('ROLLBACK TO nested_{}'.format(depth))
+            connection.execute('RELEASE nested_{}'.format(depth))
+
+    def write(self, func, *args):
+        """
+        Runs func(*args) in a transaction and returns its result once that is committed. With a writer, the
+        transaction is shared with other writes, but if func raises, only its own changes are rolled back. The
+        listeners hear of the queries the writer ran for func on this thread, as if it had run them itself.
+        """
+        writer = self.writer
+        # Writes that are part of a bigger transaction have to run in it, on this thread
+        if writer is None or self.connection.in_transaction:
+            with self:
+                return func(*args)
+        future = writer.submit(func, *args)
+        try:
+            return future.result()
+        finally:
+            if future.queries:
+                self.notify(future.db_seconds, future.queries)
+
+    def start_writer(self, batch_size=WRITE_BATCH_SIZE, max_delay=0):
+        self.writer = GroupCommitWriter(self, batch_size, max_delay)
+        self.writer.start()
+
+    def stop_writer(self):
+        """Commits the writes that are still queued and stops the writer."""
+        writer, self.writer = self.writer, None
+        if writer:
+            writer.stop()
+
+    def close(self):
+        """Closes the connection of the current thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+class WriteFuture(Future):
+    """The result of a write submitted to the writer, along with the queries it took and the time they took."""
+
+    def __init__(self):
+        super().__init__()
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+class GroupCommitWriter:
+    """
+    Commits the writes of all threads from a single thread. Every commit waits for the disk, so the writes that queue
+    up while one commit is under way are committed together in the next one. Each write runs in its own savepoint,
+    so one that fails doesn't take the others with it, and callers only get their result after it has been committed.
+
+    With max_delay, the writer waits up to that many seconds for more writes before it commits a batch, which makes
+    batches bigger when writes trickle in, at the cost of that much latency.
+    """
+    STOP = object()
+
+    def __init__(self, db, batch_size=WRITE_BATCH_SIZE, max_delay=0):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+        self.stopped = False
+        self.batches = 0
+        self.writes = 0
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, func, *args):
+        if self.stopped:
+            raise RuntimeError("The database writer has been stopped")
+        future = WriteFuture()
+        self.queue.put((func, args, future))
+        return future
+
+    def stop(self):
+        self.stopped = True
+        self.queue.put(self.STOP)
+        self.thread.join()
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size and batch[-1] is not self.STOP:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is self.STOP:
+                stopping = True
+                batch.pop()
+            if batch:
+                self.commit(batch)
+        self.db.close()
+
+    def commit(self, batch):
+        results = []
+        try:
+            with self.db:
+                for func, args, future in batch:
+                    self.db.local.tally = future
+                    try:
+                        with self.db:
+                            results.append((future, func(*args), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+                    finally:
+                        self.db.local.tally = None
+        except Exception as e:
+            logger.error("Could not commit %s writes: %s", len(batch), e)
+            for func, args, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.writes += len(batch)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+class UserStore:
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, user_id):
+        return self.db.query('SELECT * FROM users WHERE user_id = :user_id', user_id=user_id).fetchone()
+
+    def get_by_username(self, username_lower):
+        return self.db.query('SELECT * FROM users WHERE username_lower = :username LIMIT 1',
+                             username=username_lower).fetchone()
+
+    def put(self, user):
+        """Adds a user, or updates them if their user_id is known already."""
+        self.db.write(self._put, user)
+
+    def _put(self, user):
+        self.db.query('INSERT INTO users (user_id, first_name, last_name, username, username_lower, full_name) '
+                      'VALUES (:user_id, :first_name, :last_name, :username, :username_lower, :full_name) '
+                      'ON CONFLICT (user_id) DO UPDATE SET '
+                      'first_name = excluded.first_name, '
+                      'last_name = excluded.last_name, '
+                      'username = excluded.username, '
+                      'username_lower = excluded.username_lower, '
+                      'full_name = excluded.full_name',
+                      **user)
+
+    def set_digest(self, user_id, enabled):
+        self.db.write(self._set_digest, user_id, enabled)
+
+    def _set_digest(self, user_id, enabled):
+        self.db.query('UPDATE users SET digest = :enabled WHERE user_id = :user_id',
+                      user_id=user_id, enabled=int(bool(enabled)))
+
+    def resolve(self, owner_id, names):
+        """
+        Looks up several people at once by an alias of owner_id or, failing that, by username. Returns the user
+        rows of those found, with the name they were found by as `mention`.
+        """
+        return self.db.query('SELECT names.value AS mention, users.* FROM json_each(:names) AS names '
+                             'JOIN users ON users.user_id = COALESCE('
+                             '  (SELECT target_id FROM aliases WHERE owner_id = :owner_id AND alias = names.value), '
+                             '  (SELECT user_id FROM users AS named WHERE named.username_lower = names.value LIMIT 1))',
+                             owner_id=owner_id,
+                             names=json.dumps(list(names))).fetchall()
+
+    def find_by_name(self, name, limit):
+        """
+        Returns up to `limit` users whose first and last names contain words starting with every word of `name`,
+        best matches first.
+        """
+        match = name_search_query(name)
+        if not match:
+            return []
+        # Ranking every match of a short, common prefix gets expensive, so only the first MAX_NAME_SCAN matches
+        # are ranked: exact names first, then names starting with the search text, then shorter names.
+        return self.db.query('SELECT users.* FROM ('
+                             '  SELECT rowid FROM users_fts WHERE users_fts MATCH :match LIMIT :scan'
+                             ') AS matches '
+                             'JOIN users ON users.user_id = matches.rowid '
+                             'ORDER BY users.full_name = :name DESC, '
+                             'substr(users.full_name, 1, length(:name)) = :name DESC, '
+                             'length(users.full_name), users.full_name '
+                             'LIMIT :limit',
+                             match=match,
+                             name=normalize_name(name),
+                             scan=MAX_NAME_SCAN,
+                             limit=limit).fetchall()
+
+
+class AliasStore:
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, owner_id, alias):
+        return self.db.query('SELECT * FROM aliases WHERE owner_id = :owner_id AND alias = :alias',
+                             owner_id=owner_id, alias=alias).fetchone()
+
+    def put(self, owner_id, target_id, alias):
+        self.db.write(self._put, owner_id, target_id, alias)
+
+    def _put(self, owner_id, target_id, alias):
+        self.db.query('INSERT INTO aliases (owner_id, target_id, alias) '
+                      'VALUES (:owner_id, :target_id, :alias) '
+                      'ON CONFLICT (owner_id, alias) DO UPDATE SET target_id = excluded.target_id',
+                      owner_id=owner_id, target_id=target_id, alias=alias)
+
+    def delete(self, owner_id, alias):
+        self.db.write(self._delete, owner_id, alias)
+
+    def _delete(self, owner_id, alias):
+        self.db.query('DELETE FROM aliases WHERE owner_id = :owner_id AND alias = :alias',
+                      owner_id=owner_id, alias=alias)
+
+    def list(self, owner_id):
+        """Returns the aliases of a user with the names of the people they point to."""
+        return self.db.query('SELECT aliases.alias, users.first_name, users.last_name FROM aliases '
+                             'LEFT JOIN users ON users.user_id = aliases.target_id '
+                             'WHERE aliases.owner_id = :owner_id '
+                             'ORDER BY aliases.alias',
+                             owner_id=owner_id).fetchall()
+
+
+class PendingActionStore:
+    """Pending actions, see pending.PendingActions, that are kept in the database."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def put_many(self, entries):
+        """Stores (token, (expires, action)) pairs."""
+        self.db.write(self._put_many, entries)
+
+    def _put_many(self, entries):
+        self.db.executemany('INSERT OR REPLACE INTO pending_actions (token, expires, action) VALUES (?, ?, ?)',
+                            [(token, expires, json.dumps(action)) for token, (expires, action) in entries])
+
+    def take(self, token):
+        """Returns the (expires, action) pair stored under a token and deletes it, or None if there is none."""
+        return self.db.write(self._take, token)
+
+    def _take(self, token):
+        rows = self.db.query('DELETE FROM pending_actions WHERE token = :token RETURNING expires, action',
+                             token=token).fetchall()
+        return (rows[0]['expires'], json.loads(rows[0]['action'])) if rows else None
+
+    def expire(self, now):
+        self.db.write(self._expire, now)
+
+    def _expire(self, now):
+        self.db.query('DELETE FROM pending_actions WHERE expires < :now', now=now)
+
+
+class LedgerStore:
+    """
+    The transactions, and derived from them the current balance of every pair of users and periodic checkpoints of
+    those balances. Everything that adds transactions keeps the other two up to date in the same DB transaction.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_balance(self, uid1, uid2):
+        """Returns how much uid2 owes uid1."""
+        user_low, user_high, sign = pair_key(uid1, uid2)
+        row = self.db.query('SELECT balance FROM balances WHERE user_low = :user_low AND user_high = :user_high',
+                            user_low=user_low, user_high=user_high).fetchone()
+        return sign * row['balance'] if row else 0
+
+    def add_transaction(self, creditor, debitor, amount, reason, timestamp=None):
+        """
+        Records that the creditor gave the debitor a positive amount. Returns the id of the transaction. Without a
+        timestamp, it gets the time at which it is written, so that new transactions always come after the
+        checkpoints that are already there.
+        """
+        return self.db.write(self._add_transaction, creditor, debitor, amount, reason, timestamp)
+
+    def _add_transaction(self, creditor, debitor, amount, reason, timestamp):
+        cursor = self.db.query('INSERT INTO transactions (creditor, debitor, amount, reason, timestamp) '
+                               'VALUES (:creditor, :debitor, :amount, :reason, :timestamp)',
+                               creditor=creditor,
+                               debitor=debitor,
+                               amount=amount,
+                               reason=reason,
+                               timestamp=format_timestamp(timestamp or datetime.datetime.now()))
+        self.apply_to_balance(creditor, debitor, amount)
+        return cursor.lastrowid
+
+    def add_split(self, creditor, shares, reason, timestamp=None):
+        """
+        Records that the creditor paid for several debitors at once, given as (debitor, amount) pairs, in one DB
+        transaction. Returns how much each debitor owes the creditor afterwards.
+        """
+        return self.db.write(self._add_split, creditor, shares, reason, timestamp)
+
+    def _add_split(self, creditor, shares, reason, timestamp):
+        timestamp = format_timestamp(timestamp or datetime.datetime.now())
+        self.db.executemany('INSERT INTO transactions (creditor, debitor, amount, reason, timestamp) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            [(creditor, debitor, amount, reason, timestamp) for debitor, amount in shares])
+        return {debitor: self.apply_to_balance(creditor, debitor, amount) for debitor, amount in shares}
+
+    def apply_to_balance(self, creditor, debitor, amount):
+        """
+        Adds a transaction to the balances table and returns how much the debitor owes the creditor now. Must run in
+        the same DB transaction as the insert.
+        """
+        user_low, user_high, sign = pair_key(creditor, debitor)
+        balance = self.db.query('INSERT INTO balances (user_low, user_high, balance) '
+                                'VALUES (:user_low, :user_high, :amount) '
+                                'ON CONFLICT (user_low, user_high) DO UPDATE SET balance = balance + excluded.balance '
+                                'RETURNING balance',
+                                user_low=user_low,
+                                user_high=user_high,
+                                amount=sign * amount).fetchall()[0][0]
+        self.update_checkpoints(user_low, user_high)
+        return sign * balance
+
+    def update_checkpoints(self, user_low, user_high):
+        """
+        Adds the checkpoints that are due for a pair after new transactions were appended to its history. Must run in
+        the same DB transaction as the inserts.
+        """
+        last = self.db.query('SELECT position, txn_id, timestamp, balance FROM checkpoints '
+                             'WHERE user_low = :user_low AND user_high = :user_high '
+                             'ORDER BY position DESC LIMIT 1',
+                             user_low=user_low,
+                             user_high=user_high).fetchone()
+        after = {'timestamp': last['timestamp'], 'txn_id': last['txn_id']} if last else {'timestamp': '', 'txn_id': 0}
+        since = self.db.query('SELECT COUNT(*) FROM transactions '
+                              'WHERE ((creditor = :user_low AND debitor = :user_high) '
+                              'OR (creditor = :user_high AND debitor = :user_low)) '
+                              'AND (timestamp, id) > (:timestamp, :txn_id)',
+                              user_low=user_low,
+                              user_high=user_high,
+                              **after).fetchone()[0]
+        if since < schema.CHECKPOINT_INTERVAL:
+            return
+
+        position = last['position'] if last else 0
+        balance = last['balance'] if last else 0
+        rows = self.db.query('SELECT id, timestamp, creditor, amount FROM transactions '
+                             'WHERE ((creditor = :user_low AND debitor = :user_high) '
+                             'OR (creditor = :user_high AND debitor = :user_low)) '
+                             'AND (timestamp, id) > (:timestamp, :txn_id) '
+                             'ORDER BY timestamp, id',
+                             user_low=user_low,
+                             user_high=user_high,
+                             **after)
+        checkpoints = []
+        for row in rows:
+            position += 1
+            balance += row['amount'] if row['creditor'] == user_low else -row['amount']
+            if position % schema.CHECKPOINT_INTERVAL == 0:
+                checkpoints.append((user_low, user_high, position, row['id'], row['timestamp'], balance))
+        self.db.executemany('INSERT INTO checkpoints (user_low, user_high, position, txn_id, timestamp, balance) '
+                            'VALUES (?, ?, ?, ?, ?, ?)', checkpoints)
+
+    def settle_group(self, members, reason, timestamp=None):
+        """
+        Brings the balance of every pair among `members` to zero with one transaction per pair that owes money.
+        Returns the (user_low, user_high, balance) rows of the pairs that were settled.
+        """
+        return self.db.write(self._settle_group, members, reason, timestamp)
+
+    def _settle_group(self, members, reason, timestamp):
+        timestamp = format_timestamp(timestamp or datetime.datetime.now())
+        pairs = self.db.query('SELECT user_low, user_high, balance FROM balances '
+                              'WHERE user_low IN ({0}) AND user_high IN ({0}) AND balance != 0'
+                              .format(','.join(str(int(m)) for m in members))).fetchall()
+        rows = []
+        for pair in pairs:
+            # A positive balance means user_high owes user_low, so user_high pays it back
+            payer, payee = (pair['user_high'], pair['user_low']) if pair['balance'] > 0 \
+                else (pair['user_low'], pair['user_high'])
+            rows.append((payer, payee, abs(pair['balance']), reason, timestamp))
+        self.db.executemany('INSERT INTO transactions (creditor, debitor, amount, reason, timestamp) '
+                            'VALUES (?, ?, ?, ?, ?)', rows)
+        self.db.executemany('UPDATE balances SET balance = 0 WHERE user_low = ? AND user_high = ?',
+                            [(p['user_low'], p['user_high']) for p in pairs])
+        for pair in pairs:
+            self.update_checkpoints(pair['user_low'], pair['user_high'])
+        return pairs
+
+    def get_balance_before(self, uid1, uid2, timestamp, txn_id=0):
+        """
+        Returns how much uid2 owed uid1 just before the transaction with the given timestamp and id, or just before
+        the given timestamp if there is no id. Starts from the closest checkpoint, so at most CHECKPOINT_INTERVAL
+        transactions have to be added up. Balances from before the archive horizon are added up in the archive, except
+        before a carry-forward transaction, which the ledger starts with.
+        """
+        user_low, user_high, sign = pair_key(uid1, uid2)
+        checkpoint = self.db.query('SELECT timestamp, txn_id, balance FROM checkpoints '
+                                   'WHERE user_low = :user_low AND user_high = :user_high '
+                                   'AND (timestamp, txn_id) < (:timestamp, :txn_id) '
+                                   'ORDER BY timestamp DESC, txn_id DESC LIMIT 1',
+                                   user_low=user_low,
+                                   user_high=user_high,
+                                   timestamp=timestamp,
+                                   txn_id=txn_id).fetchone()
+        if not checkpoint:
+            checkpoint = {'timestamp': '', 'txn_id': 0, 'balance': 0}
+
+        # Both ends of the range are plain parameters so that SQLite reads it from the pair index. Which of the two
+        # tables to add up is decided in the same query, since the archive horizon may move while the bot runs.
+        pair = '((creditor = :user_low AND debitor = :user_high) OR (creditor = :user_high AND debitor = :user_low)) '
+        result = self.db.query('SELECT CASE WHEN :timestamp < '
+                               "  (SELECT value FROM settings WHERE key = 'archived_before') "
+                               'AND NOT EXISTS (SELECT 1 FROM transactions '
+                               '  WHERE id = :txn_id AND timestamp = :timestamp AND carried IS NOT NULL) '
+                               'THEN ('
+                               '  SELECT COALESCE(SUM(CASE WHEN creditor = :user_low THEN amount ELSE -amount END), 0) '
+                               '  FROM transactions_archive WHERE ' + pair +
+                               '  AND (timestamp, id) < (:timestamp, :txn_id)'
+                               ') ELSE :balance + ('
+                               '  SELECT COALESCE(SUM(CASE WHEN creditor = :user_low THEN amount ELSE -amount END), 0) '
+                               '  FROM transactions WHERE ' + pair +
+                               '  AND (timestamp, id) > (:from_timestamp, :from_id) '
+                               '  AND (timestamp, id) < (:timestamp, :txn_id)'
+                               ') END',
+                               user_low=user_low,
+                               user_high=user_high,
+                               balance=checkpoint['balance'],
+                               from_timestamp=checkpoint['timestamp'],
+                               from_id=checkpoint['txn_id'],
+                               timestamp=timestamp,
+                               txn_id=txn_id).fetchone()
+        return sign * result[0]
+
+    def get_version(self):
+        """
+        Returns a counter of bulk changes to the ledger, i.e. imports, archive runs and rebuilt balances. They may
+        come from another process, whose changes the bot's caches don't see otherwise.
+        """
+        row = self.db.query("SELECT value FROM settings WHERE key = 'ledger_version'").fetchone()
+        return row[0] if row else None
+
+    def _bump_version(self):
+        self.db.query("INSERT INTO settings (key, value) VALUES ('ledger_version', 1) "
+                      'ON CONFLICT (key) DO UPDATE SET value = value + 1')
+
+    def compute_balances(self):
+        results = self.db.query('SELECT MIN(creditor, debitor) AS user_low, '
+                                'MAX(creditor, debitor) AS user_high, '
+                                'SUM(CASE WHEN creditor < debitor THEN amount ELSE -amount END) AS balance '
+                                'FROM transactions '
+                                'GROUP BY MIN(creditor, debitor), MAX(creditor, debitor)')
+        return {(r['user_low'], r['user_high']): r['balance'] for r in results}
+
+    def rebuild_balances(self, fix=True):
+        """
+        Recomputes all balances from the transactions ledger and compares them with the balances table.
+        Returns a list of (user_low, user_high, stored, expected) tuples for every pair that has drifted.
+        If fix is set, the balances table is replaced with the recomputed values, and the balance checkpoints
+        are recomputed as well.
+        """
+        with self.db as tx:
+            expected = self.compute_balances()
+            stored = {(r['user_low'], r['user_high']): r['balance']
+                      for r in tx.query('SELECT user_low, user_high, balance FROM balances')}
+
+            drift = []
+            for key in sorted(set(expected) | set(stored)):
+                if expected.get(key, 0) != stored.get(key, 0):
+                    drift.append((key[0], key[1], stored.get(key), expected.get(key, 0)))
+
+            if fix:
+                self._bump_version()
+                tx.query('DELETE FROM balances')
+                tx.executemany('INSERT INTO balances (user_low, user_high, balance) VALUES (?, ?, ?)',
+                               [(user_low, user_high, balance) for (user_low, user_high), balance in expected.items()])
+                tx.query('DELETE FROM checkpoints')
+                schema.build_checkpoints(tx)
+        return drift
+
+    def get_history(self, uid1, uid2, before=None, after=None, limit=20, archive=False):
+        """
+        Returns up to `limit` + 1 transactions between two users, the most recent ones, the ones before the
+        transaction with id `before`, or the ones after the transaction with id `after`, nearest to the cursor first.
+        With `archive`, they come from the archive, and so do the cursors.
+        """
+        table = 'transactions_archive' if archive else 'transactions'
+        if after is not None:
+            cursor = 'AND (timestamp, id) > (SELECT timestamp, id FROM ' + table + ' WHERE id = :cursor) '
+            order = 'ASC'
+        else:
+            cursor = 'AND (timestamp, id) < (SELECT timestamp, id FROM ' + table + ' WHERE id = :cursor) ' \
+                if before is not None else ''
+            order = 'DESC'
+
+        # Each direction of the pair is read from the (creditor, debitor, timestamp) index in order,
+        # so only the rows of the requested page are ever touched.
+        direction = ('SELECT * FROM (SELECT * FROM ' + table + ' '
+                     'WHERE creditor = {} AND debitor = {} ' + cursor +
+                     'ORDER BY timestamp {order}, id {order} LIMIT :limit)').format
+        return self.db.query(direction(':uid1', ':uid2', order=order) + ' UNION ALL ' +
+                             direction(':uid2', ':uid1', order=order) + ' '
+                             'ORDER BY timestamp {order}, id {order} LIMIT :limit'.format(order=order),
+                             uid1=uid1,
+                             uid2=uid2,
+                             cursor=after if after is not None else before,
+                             limit=limit + 1).fetchall()
+
+    def iter_transactions(self, uid, other=None):
+        """
+        Yields all transactions of a user, or between two users, in chronological order, together with the names
+        of both sides. Archived transactions are included instead of the carry-forward transactions that stand for
+        them. Rows are fetched from the database while they are consumed, so this works for any number of
+        transactions in constant memory.
+        """
+        if other is None:
+            where = '(creditor = :uid OR debitor = :uid)'
+        else:
+            where = '((creditor = :uid AND debitor = :other) OR (creditor = :other AND debitor = :uid))'
+        columns = 'id, creditor, debitor, amount, reason, timestamp'
+        return self.db.query('SELECT ledger.*, '
+                             "TRIM(COALESCE(c.first_name, '') || ' ' || COALESCE(c.last_name, '')) AS creditor_name, "
+                             "TRIM(COALESCE(d.first_name, '') || ' ' || COALESCE(d.last_name, '')) AS debitor_name "
+                             'FROM ('
+                             '  SELECT ' + columns + ' FROM transactions_archive WHERE ' + where +
+                             '  UNION ALL '
+                             '  SELECT ' + columns + ' FROM transactions WHERE carried IS NULL AND ' + where +
+                             ') AS ledger '
+                             'LEFT JOIN users AS c ON c.user_id = ledger.creditor '
+                             'LEFT JOIN users AS d ON d.user_id = ledger.debitor '
+                             'ORDER BY ledger.timestamp, ledger.id',
+                             uid=uid,
+                             other=other)
+
+    def has_archive(self, uid1, uid2):
+        return self.db.query('SELECT EXISTS (SELECT 1 FROM transactions_archive '
+                             'WHERE (creditor = :uid1 AND debitor = :uid2) OR (creditor = :uid2 AND debitor = :uid1))',
+                             uid1=uid1,
+                             uid2=uid2).fetchone()[0] == 1
+
+    def archive(self, before, dry_run=False):
+        """
+        Moves the transactions from before a timestamp to the archive. Every pair that still owes something from
+        then gets one carry-forward transaction just before that timestamp, so balances don't change and it comes
+        before every transaction left in the ledger, and the checkpoints of the pairs are recomputed. Carry-forward
+        transactions of earlier runs are replaced rather than archived.
+
+        Returns a dict with the number of transactions that were archived, of the carry-forward transactions that
+        are left, and the space the ledger and its indexes take before and after, if SQLite can tell. With dry_run,
+        nothing is changed and the same numbers are returned. Raises ValueError if the timestamp is in the future,
+        since transactions recorded later would end up before the carry-forward ones.
+        """
+        if before > datetime.datetime.now():
+            raise ValueError("{} is in the future, only past transactions can be archived".format(before))
+        try:
+            return self.db.write(self._archive, format_timestamp(before),
+                                 format_timestamp(before - CARRY_OFFSET), dry_run)
+        except DryRun as e:
+            return e.result
+
+    def _archive(self, before, carry_timestamp, dry_run):
+        size_before = self.ledger_size()
+        self.db.query('DROP TABLE IF EXISTS temp.archived_pairs')
+        self.db.query('CREATE TEMP TABLE archived_pairs AS '
+                      'SELECT MIN(creditor, debitor) AS user_low, MAX(creditor, debitor) AS user_high, '
+                      'SUM(CASE WHEN creditor < debitor THEN amount ELSE -amount END) AS balance, '
+                      'SUM(COALESCE(carried, 1)) AS count '
+                      'FROM transactions WHERE timestamp < :before '
+                      'GROUP BY MIN(creditor, debitor), MAX(creditor, debitor)',
+                      before=before)
+        archived = self.db.query('INSERT INTO transactions_archive (id, creditor, debitor, amount, reason, timestamp) '
+                                 'SELECT id, creditor, debitor, amount, reason, timestamp FROM transactions '
+                                 'WHERE timestamp < :before AND carried IS NULL',
+                                 before=before).rowcount
+        self.db.query('DELETE FROM transactions WHERE timestamp < :before', before=before)
+        carried = self.db.query('INSERT INTO transactions (creditor, debitor, amount, timestamp, carried) '
+                                'SELECT CASE WHEN balance > 0 THEN user_low ELSE user_high END, '
+                                'CASE WHEN balance > 0 THEN user_high ELSE user_low END, '
+                                'ABS(balance), :timestamp, count '
+                                'FROM temp.archived_pairs WHERE balance != 0',
+                                timestamp=carry_timestamp).rowcount
+
+        pairs = '(user_low, user_high) IN (SELECT user_low, user_high FROM temp.archived_pairs)'
+        self.db.query('DELETE FROM checkpoints WHERE ' + pairs)
+        schema.build_checkpoints(self.db, where=pairs)
+        self.db.query("INSERT INTO settings (key, value) VALUES ('archived_before', :before) "
+                      'ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)',
+                      before=before)
+        self.db.query('DROP TABLE temp.archived_pairs')
+        self._bump_version()
+
+        result = {
+            'archived': archived,
+            'carried': carried,
+            'size_before': size_before,
+            'size_after': self.ledger_size(),
+        }
+        if dry_run:
+            raise DryRun(result)
+        return result
+
+    def ledger_size(self):
+        """Returns the bytes the transactions table and its indexes take up, or None if SQLite can't tell."""
+        try:
+            return self.db.query("SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                                 "(SELECT name FROM sqlite_schema WHERE tbl_name = 'transactions')").fetchone()[0]
+        except sqlite3.OperationalError:
+            # SQLite was built without the dbstat table
+            return None
+
+    def import_transactions(self, rows, errors, max_errors):
+        """
+        Adds (line, creditor, debitor, amount, reason, timestamp) rows to the ledger in a single DB transaction, and
+        updates the balances to match. `errors` is a list of (line, problem) pairs for records that were rejected
+        while `rows` was read. Rows whose users aren't registered, or which are older than the archive horizon, are
+        added to it, and if it isn't empty in the end, nothing is imported. Returns the number of rows.
+        """
+        rows = iter(rows)
+        cache_size = self.db.query('PRAGMA cache_size').fetchone()[0]
+        self.db.query('PRAGMA cache_size = {}'.format(-IMPORT_CACHE_SIZE))
+        try:
+            return self._import_transactions(rows, errors, max_errors)
+        finally:
+            self.db.query('PRAGMA cache_size = {}'.format(cache_size))
+
+    def _import_transactions(self, rows, errors, max_errors):
+        with self.db as tx:
+            tx.query('DROP TABLE IF EXISTS temp.imported')
+            tx.query('CREATE TEMP TABLE imported ('
+                     'line INTEGER, creditor INTEGER, debitor INTEGER, amount INTEGER, reason TEXT, timestamp DATETIME)')
+            insert = 'INSERT INTO temp.imported (line, creditor, debitor, amount, reason, timestamp) ' \
+                     'VALUES (?, ?, ?, ?, ?, ?)'
+            count = 0
+            while True:
+                batch = list(itertools.islice(rows, IMPORT_BATCH_SIZE))
+                if not batch:
+                    break
+                tx.executemany(insert, batch)
+                count += len(batch)
+
+            unknown = tx.query('SELECT line, CASE WHEN creditor NOT IN (SELECT user_id FROM users) '
+                               '  THEN creditor ELSE debitor END AS user_id '
+                               'FROM temp.imported '
+                               'WHERE creditor NOT IN (SELECT user_id FROM users) '
+                               'OR debitor NOT IN (SELECT user_id FROM users) '
+                               'ORDER BY line LIMIT :limit',
+                               limit=max_errors)
+            errors.extend((row['line'], "user {} is not registered".format(row['user_id'])) for row in unknown)
+
+            # Older rows belong in the archive. In the ledger, they'd be counted again on top of the carried balances
+            archived = tx.query('SELECT line, imported.timestamp, settings.value AS horizon '
+                                "FROM temp.imported JOIN settings ON settings.key = 'archived_before' "
+                                'WHERE imported.timestamp < settings.value '
+                                'ORDER BY line LIMIT :limit',
+                                limit=max_errors)
+            errors.extend((row['line'], "timestamp {} is before {}, up to which the ledger is archived".format(
+                row['timestamp'], row['horizon'])) for row in archived)
+
+            if not errors:
+                tx.query('INSERT INTO transactions (creditor, debitor, amount, reason, timestamp) '
+                         'SELECT creditor, debitor, amount, reason, timestamp FROM temp.imported ORDER BY line')
+                tx.query('INSERT INTO balances (user_low, user_high, balance) '
+                         'SELECT MIN(creditor, debitor), MAX(creditor, debitor), '
+                         'SUM(CASE WHEN creditor < debitor THEN amount ELSE -amount END) '
+                         'FROM temp.imported WHERE true '
+                         'GROUP BY MIN(creditor, debitor), MAX(creditor, debitor) '
+                         'ON CONFLICT (user_low, user_high) DO UPDATE SET balance = balance + excluded.balance')
+
+                # Imported transactions may be older than existing ones, so the checkpoints of these pairs start over
+                pairs = '(user_low, user_high) IN ' \
+                        '(SELECT MIN(creditor, debitor), MAX(creditor, debitor) FROM temp.imported)'
+                tx.query('DELETE FROM checkpoints WHERE ' + pairs)
+                schema.build_checkpoints(tx, where=pairs)
+                self._bump_version()
+            tx.query('DROP TABLE temp.imported')
+        return count
+
+    def get_all_debts(self, uid):
+        """Returns the user rows of everyone uid has an uneven balance with, with what they owe uid as `debt`."""
+        return self.db.query('SELECT users.*, summary.debt FROM ('
+                             '  SELECT CASE WHEN user_low = :uid THEN user_high ELSE user_low END AS other, '
+                             '  SUM(CASE WHEN user_low = :uid THEN balance ELSE -balance END) AS debt '
+                             '  FROM balances '
+                             '  WHERE user_low = :uid OR user_high = :uid '
+                             '  GROUP BY other '
+                             '  HAVING debt != 0'
+                             ') AS summary '
+                             'JOIN users ON users.user_id = summary.other '
+                             'ORDER BY summary.debt DESC, users.user_id',
+                             uid=uid).fetchall()
+
+    def search(self, uid, text, other=None, since=None, limit=10, offset=0):
+        """
+        Returns up to `limit` transactions of uid, or between uid and other, whose reason contains words starting
+        with every word of `text`, best matches first and newest first among equally good ones. The rows also have
+        the first and last name of the other person. Transactions before `since` are left out.
+        """
+        words = name_search_query(text)
+        if not words:
+            return []
+        parties = " ".join('"u{}"'.format(int(party)) for party in (uid, other) if party is not None)
+        # Ranking every transaction of a heavy user that mentions a common word gets expensive, so only the newest
+        # MAX_SEARCH_SCAN matches are ranked. The index returns them newest first without looking at the others.
+        return self.db.query('SELECT transactions.*, users.first_name, users.last_name FROM ('
+                             '  SELECT rowid, bm25(transactions_fts, 1.0, 0.0) AS score FROM transactions_fts '
+                             '  WHERE transactions_fts MATCH :match ORDER BY rowid DESC LIMIT :scan'
+                             ') AS matches '
+                             'JOIN transactions ON transactions.id = matches.rowid '
+                             'LEFT JOIN users ON users.user_id = '
+                             'CASE WHEN creditor = :uid THEN debitor ELSE creditor END '
+                             'WHERE :since IS NULL OR timestamp >= :since '
+                             'ORDER BY matches.score, transactions.id DESC '
+                             'LIMIT :limit OFFSET :offset',
+                             match='reason : ({}) AND parties : ({})'.format(words, parties),
+                             scan=MAX_SEARCH_SCAN,
+                             since=format_timestamp(since) if since else None,
+                             uid=uid,
+                             limit=limit,
+                             offset=offset).fetchall()
+
+    def get_digests(self):
+        """
+        Returns the open debts of everyone who gets the digest, in one pass over the subscribers and their balances:
+        rows with the subscriber as `uid`, the user_id and names of the other person, and what they owe uid as
+        `debt`, ordered like get_all_debts within each uid.
+        """
+        # Both sides of the OR are looked up by index for each subscriber in turn, so SQLite only has to sort the
+        # debts of one subscriber at a time
+        return self.db.query('SELECT subscriber.user_id AS uid, users.user_id, users.first_name, users.last_name, '
+                             'CASE WHEN user_low = subscriber.user_id THEN balance ELSE -balance END AS debt '
+                             'FROM users AS subscriber '
+                             'CROSS JOIN balances '
+                             'ON user_low = subscriber.user_id OR user_high = subscriber.user_id '
+                             'JOIN users ON users.user_id = '
+                             'CASE WHEN user_low = subscriber.user_id THEN user_high ELSE user_low END '
+                             'WHERE subscriber.digest AND balance != 0 '
+                             'ORDER BY subscriber.user_id, debt DESC, users.user_id')
+
+    def get_counterparties(self, uid):
+        """Returns the ids of everyone uid has an uneven balance with."""
+        return [row[0] for row in self.db.query('SELECT user_high FROM balances WHERE user_low = :uid AND balance != 0 '
+                                                'UNION ALL '
+                                                'SELECT user_low FROM balances WHERE user_high = :uid AND balance != 0',
+                                                uid=uid)]
+
+    def get_settlement_group(self, uid):
+        """
+        Finds everyone who is connected to uid through outstanding debts, directly or via others, and returns
+        their user rows along with their net balance, which is positive if they are owed money.
+        """
+        return self.db.query('WITH RECURSIVE component(user_id) AS ('
+                             '  SELECT :uid '
+                             '  UNION '
+                             '  SELECT CASE WHEN balances.user_low = component.user_id '
+                             '    THEN balances.user_high ELSE balances.user_low END '
+                             '  FROM component JOIN balances '
+                             '  ON balances.user_low = component.user_id OR balances.user_high = component.user_id '
+                             '  WHERE balances.balance != 0'
+                             ') '
+                             'SELECT users.*, nets.net FROM ('
+                             '  SELECT component.user_id, '
+                             '  SUM(CASE WHEN balances.user_low = component.user_id '
+                             '    THEN balances.balance ELSE -balances.balance END) AS net '
+                             '  FROM component JOIN balances '
+                             '  ON balances.user_low = component.user_id OR balances.user_high = component.user_id '
+                             '  GROUP BY component.user_id'
+                             ') AS nets '
+                             'JOIN users ON users.user_id = nets.user_id '
+                             'ORDER BY users.user_id',
+                             uid=uid).fetchall()
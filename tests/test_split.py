@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from debtbot import DebtBot  # noqa: E402
+from transaction_parser import parse_split  # noqa: E402
+
+
+def user(id, first_name, username):
+    return SimpleNamespace(id=id, first_name=first_name, last_name=None, username=username)
+
+
+class SplitCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bot = DebtBot()
+        self.bot.connect({'db': os.path.join(self.tmp.name, 'debts.db')})
+        self.bot.register_user(user(1, "Anna", "anna"))
+        self.bot.register_user(user(2, "Bob", "bob"))
+
+    def tearDown(self):
+        self.bot.db.close()
+        self.tmp.cleanup()
+
+    def test_only_the_sender_is_mentioned(self):
+        for mentions in ([('me', 1)], [('anna', 1)], [('me', 2), ('anna', 1)]):
+            reply = self.bot.split_command(1, 9000, "for dinner", mentions)
+            self.assertEqual(reply, "Mention at least one other person to split with.")
+        self.assertEqual(self.bot.ledger.get_balance(1, 2), 0)
+
+    def test_split_with_one_other_person(self):
+        reply = self.bot.split_command(1, 9000, "for dinner", [('bob', 1)])
+        self.assertIn("split with 1 person.", reply['message'])
+        self.assertIn("split with 1 person.", reply['other_messages'][0]['message'])
+        self.assertEqual(self.bot.get_debt(1, 2), 4500)
+
+
+class ParseSplitTest(unittest.TestCase):
+    def test_payment_to_or_for_someone_is_not_a_split(self):
+        self.assertIsNone(parse_split('I paid 15 to @bob'))
+        self.assertIsNone(parse_split('I paid 20 for @bob'))
+
+    def test_split_with_someone(self):
+        self.assertEqual(parse_split('I split 30 with @bob'), (30, None, [('bob', 1)]))
+        self.assertEqual(parse_split('I paid 90 for dinner @bob @anna*2'),
+                         (90, 'for dinner', [('bob', 1), ('anna', 2)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
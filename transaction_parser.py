@@ -0,0 +1,459 @@
+"""
+Parser for transaction messages such as "I gave 15 to bob14 for pizza" or "bob14 owes me 40".
+
+The message is split into whitespace and word tokens once. The sentence form is then recognised from
+the tokens, in the same order of precedence the bot has always used:
+
+    I gave 15 to bob for pizza      (verb, amount, recipient, reason)
+    bob gave me 15 for pizza        (recipient, verb, amount, reason)
+    I gave bob 15 for pizza         (verb, recipient, amount, reason)
+    bob 15 pizza                    (shorthand: recipient, amount, reason)
+
+A separate form splits an amount between the sender and a list of people, see parse_split():
+
+    I paid 90 for dinner @anna @bob*2
+
+Every form is checked in time linear in the length of the message. The results are identical to the
+regular expressions this parser replaced, including how they treat leading "@"s, line breaks and
+trailing whitespace. benchmarks/bench_parser.py checks that against a golden corpus.
+"""
+import re
+from bisect import bisect_right
+from decimal import Decimal
+
+TOKEN_PATTERN = re.compile(r'\s+|\S+')
+AMOUNT_START_PATTERN = re.compile(r'-?\d+')
+
+I_WORD = re.compile('i', re.I)
+VERB_WORD = re.compile('g[ia]ve|g[eo]t|owe[sd]?', re.I)
+GIVE_VERB_WORD = re.compile('g[ia]ve|owe[sd]?', re.I)
+AMOUNT = re.compile(r'(-?\d+\.?\d*)(/\d+)?')
+TO_OR_FROM = re.compile('to|from', re.I)
+ME = re.compile('me', re.I)
+OF_WORD = re.compile('of', re.I)
+BECAUSE_WORD = re.compile('because', re.I)
+BECAUSE_OF = re.compile(r'because\s+of', re.I)
+REASON_WORD = re.compile('because|for|in|by|with|via|through|to|from|and', re.I)
+WITH_WORD = re.compile('with', re.I)
+
+RECEIVE_PATTERN = re.compile('g[eo]t|owe[sd]?', re.I)
+
+WORD_PATTERN = re.compile(r'\S+')
+SPLIT_VERB_WORD = re.compile('paid|spent|split', re.I)
+SPLIT_AMOUNT = re.compile(r'\d+\.?\d*')
+# "@name" or "me", optionally with a weight such as "@bob*2"
+MENTION = re.compile(r'(@\w+|me)(?:\*(\d+))?', re.I)
+
+
+class Message:
+    """A message split into tokens, with the lookups the sentence forms need."""
+
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+        self.tokens = [m.span() for m in TOKEN_PATTERN.finditer(text)]
+        self.token_starts = [start for start, end in self.tokens]
+        # The first token decides whether whitespace tokens have even or odd indices
+        self.first_space = 0 if text[:1].isspace() else 1
+        # A line break can only be skipped by whitespace, or end the message. Free text after this
+        # position never contains one except as the very last character.
+        self.last_inner_newline = text.rfind('\n', 0, self.length - 1)
+
+    def is_space_token(self, index):
+        return index % 2 == self.first_space % 2
+
+    def token_index(self, position):
+        return bisect_right(self.token_starts, position) - 1
+
+    def token_end(self, position):
+        return self.tokens[self.token_index(position)][1]
+
+    def skip_space(self, position):
+        if position < self.length and self.text[position].isspace():
+            return self.token_end(position)
+        return position
+
+    def line_end(self, position):
+        newline = self.text.find('\n', position)
+        return self.length if newline < 0 else newline
+
+    def rest_is_one_line(self, position):
+        """Whether free text starting at position can run to the end of the message."""
+        return position > self.last_inner_newline
+
+    def free_text_end(self, position):
+        """Where free text that starts at position ends, given that rest_is_one_line(position)."""
+        if position < self.length and self.text.endswith('\n'):
+            return self.length - 1
+        return self.length
+
+    def space_tokens_after(self, position, limit):
+        """
+        Yields (index, split) for every whitespace token that a name starting at position could end at.
+        The name must be at least one character long, and may not contain any line break before limit.
+        """
+        if position + 1 >= self.length:
+            return
+        index = self.token_index(position + 1)
+        while index < len(self.tokens):
+            start, end = self.tokens[index]
+            split = max(start, position + 1)
+            if split > limit:
+                return
+            if self.is_space_token(index) and split < end:
+                yield index, split
+            index += 1
+
+    def word_after(self, index):
+        """The word token after the whitespace token at index, and the whitespace token after that, if any."""
+        if index + 1 >= len(self.tokens):
+            return None, None
+        word = self.tokens[index + 1]
+        space = self.tokens[index + 2] if index + 2 < len(self.tokens) else None
+        return word, space
+
+    def match_word(self, pattern, token):
+        return token is not None and pattern.fullmatch(self.text, token[0], token[1]) is not None
+
+
+def name_starts(first, fallbacks):
+    """
+    The positions a name may start at, in the order they are tried. `first` is where the name starts if
+    every optional prefix is taken; each fallback (start, stop) range is walked backwards from start.
+    """
+    yield first
+    for start, stop in fallbacks:
+        yield from range(start, stop, -1)
+
+
+class FormParser:
+    """Base class of the sentence forms. Subclasses implement match_from()."""
+
+    def __init__(self, message):
+        self.message = message
+        self.cache = {}
+
+    def cached(self, index, check):
+        if index not in self.cache:
+            self.cache[index] = check(index)
+        return self.cache[index]
+
+    def match_name(self, first, fallbacks):
+        """
+        Tries match_from() for each possible start of the name. Inside a run of whitespace, once a start that
+        could end the name in the same run has failed, every earlier start in that run fails as well.
+        """
+        text = self.message.text
+        failed_run = None
+        tried = set()
+        for start in name_starts(first, fallbacks):
+            if start in tried or start >= self.message.length or text[start] == '\n':
+                continue
+            tried.add(start)
+            run = self.message.token_index(start) if text[start].isspace() else None
+            if run is not None and run == failed_run:
+                continue
+            result = self.match_from(start)
+            if result:
+                return result
+            if run is not None and start + 1 < self.message.tokens[run][1]:
+                failed_run = run
+        return None
+
+    def reason_after_keyword(self, position, keyword_ends):
+        """Free text starting with a keyword at position, given the possible ends of the keyword."""
+        message = self.message
+        for keyword_end in keyword_ends:
+            rest = message.skip_space(keyword_end)
+            if message.rest_is_one_line(rest):
+                return message.text[position:message.free_text_end(rest)]
+        return None
+
+    def leading_verb(self, verbs):
+        """Matches '^i?\\s*(verb)\\s+' and returns the verb and the position after it."""
+        message = self.message
+        position = 1 if I_WORD.match(message.text) else 0
+        position = message.skip_space(position)
+        if position >= message.length:
+            return None, None
+        end = message.token_end(position)
+        if end >= message.length or not verbs.fullmatch(message.text, position, end):
+            return None, None
+        return message.text[position:end], end
+
+
+class VerbAmountName(FormParser):
+    """I gave 15 to bob for pizza"""
+
+    def parse(self):
+        message = self.message
+        text = message.text
+        verb, verb_end = self.leading_verb(VERB_WORD)
+        if not verb:
+            return None
+        amount_start = message.skip_space(verb_end)
+        amount_end = message.token_end(amount_start)
+        amount = AMOUNT.fullmatch(text, amount_start, amount_end)
+        if not amount or amount_end >= message.length:
+            return None
+
+        after_amount = message.skip_space(amount_end)
+        to_or_from = TO_OR_FROM.match(text, after_amount)
+        after_to = to_or_from.end() if to_or_from else after_amount
+        name = message.skip_space(after_to)
+        first = name + 1 if text.startswith('@', name) else name
+
+        fallbacks = [(name, name - 1), (name - 1, after_to - 1)]
+        if to_or_from:
+            fallbacks.append((after_amount, after_amount - 1))
+        fallbacks.append((after_amount - 1, amount_end))
+        result = self.match_name(first, fallbacks)
+        if not result:
+            return None
+        recipient, reason = result
+        return verb, amount.group(1), amount.group(2), recipient, reason, 1
+
+    def match_from(self, start):
+        message = self.message
+        limit = message.line_end(start)
+        for index, split in message.space_tokens_after(start, limit):
+            reason = self.cached(index, self.reason_after)
+            if reason is not None:
+                return message.text[start:split], reason
+
+        end = message.length - 1 if message.text.endswith('\n') else message.length
+        if start < end <= limit:
+            return message.text[start:end], None
+        return None
+
+    def reason_after(self, index):
+        message = self.message
+        word, space = message.word_after(index)
+        if not message.match_word(REASON_WORD, word) or space is None:
+            return None
+        keyword_ends = []
+        if message.match_word(BECAUSE_WORD, word):
+            of, of_space = message.word_after(index + 2)
+            if message.match_word(OF_WORD, of) and of_space is not None:
+                keyword_ends.append(of_space[1])
+        keyword_ends.append(space[1])
+        return self.reason_after_keyword(word[0], keyword_ends)
+
+
+class NameVerbAmount(FormParser):
+    """bob gave me 15 for pizza"""
+
+    def parse(self):
+        message = self.message
+        name = message.skip_space(0)
+        first = name + 1 if message.text.startswith('@', name) else name
+        result = self.match_name(first, [(name, name - 1), (name - 1, -1)])
+        if not result:
+            return None
+        recipient, (verb, amount, divisor, reason) = result
+        return verb, amount, divisor, recipient, reason, -1
+
+    def match_from(self, start):
+        message = self.message
+        limit = message.line_end(start)
+        for index, split in message.space_tokens_after(start, limit):
+            rest = self.cached(index, self.verb_amount_after)
+            if rest is not None:
+                return message.text[start:split], rest
+        return None
+
+    def verb_amount_after(self, index):
+        message = self.message
+        text = message.text
+        verb, space = message.word_after(index)
+        if not message.match_word(VERB_WORD, verb) or space is None:
+            return None
+        position = space[1]
+        me = ME.match(text, position)
+        if me:
+            position = me.end()
+        amount = AMOUNT.match(text, message.skip_space(position))
+        if not amount:
+            return None
+        reason = self.reason_after_amount(amount.end())
+        if reason is None:
+            return None
+        return text[verb[0]:verb[1]], amount.group(1), amount.group(2), reason
+
+    def reason_after_amount(self, position):
+        message = self.message
+        text = message.text
+        # An optional "(to|from) me" may follow the amount
+        if position < message.length and text[position].isspace():
+            after_space = message.skip_space(position)
+            to_or_from = TO_OR_FROM.match(text, after_space)
+            me = message.skip_space(to_or_from.end() if to_or_from else after_space)
+            if ME.match(text, me):
+                reason = self.reason(message.skip_space(me + 2))
+                if reason is not None:
+                    return reason
+        return self.reason(message.skip_space(position))
+
+    def reason(self, position):
+        text = self.message.text
+        keyword_ends = []
+        because_of = BECAUSE_OF.match(text, position)
+        if because_of:
+            keyword_ends.append(because_of.end())
+        keyword = REASON_WORD.match(text, position)
+        if keyword:
+            keyword_ends.append(keyword.end())
+        keyword_ends.append(position)
+        return self.reason_after_keyword(position, keyword_ends)
+
+
+class VerbNameAmount(FormParser):
+    """I gave bob 15 for pizza"""
+
+    def parse(self):
+        message = self.message
+        verb, verb_end = self.leading_verb(GIVE_VERB_WORD)
+        if not verb:
+            return None
+        name = message.skip_space(verb_end)
+        first = name + 1 if message.text.startswith('@', name) else name
+        result = self.match_name(first, [(name, name - 1), (name - 1, verb_end)])
+        if not result:
+            return None
+        recipient, (amount, divisor, reason) = result
+        return verb, amount, divisor, recipient, reason, 1
+
+    def match_from(self, start):
+        message = self.message
+        limit = message.line_end(start)
+        for index, split in message.space_tokens_after(start, limit):
+            rest = self.cached(index, self.amount_after)
+            if rest is not None:
+                return message.text[start:split], rest
+        return None
+
+    def amount_after(self, index):
+        message = self.message
+        text = message.text
+        position = message.tokens[index][1]
+        amount = AMOUNT.match(text, position)
+        if not amount:
+            return None
+        position = message.skip_space(amount.end())
+        if position == message.length:
+            return amount.group(1), amount.group(2), None
+
+        keyword_ends = []
+        because_of = BECAUSE_OF.match(text, position)
+        if because_of:
+            keyword_ends.append(because_of.end())
+        keyword = REASON_WORD.match(text, position)
+        if keyword:
+            keyword_ends.append(keyword.end())
+        reason = self.reason_after_keyword(position, keyword_ends)
+        if reason is None:
+            return None
+        return amount.group(1), amount.group(2), reason
+
+
+class NameAmount(FormParser):
+    """bob 15 pizza"""
+
+    def parse(self):
+        first = 1 if self.message.text.startswith('@') else 0
+        result = self.match_name(first, [(first - 1, -1)])
+        if not result:
+            return None
+        recipient, amount, divisor, reason = result
+        return 'give', amount, divisor, recipient, 'for ' + reason if reason else None, 1
+
+    def match_from(self, start):
+        message = self.message
+        text = message.text
+        limit = message.line_end(start)
+        # Only the first position of every number can start the amount: a later one ends at the same place
+        for number in AMOUNT_START_PATTERN.finditer(text, start + 1):
+            position = number.start()
+            split = position
+            if text[position - 1].isspace():
+                split = max(message.tokens[message.token_index(position - 1)][0], start + 1)
+            if split > limit:
+                return None
+            amount = AMOUNT.match(text, position)
+            rest = message.skip_space(amount.end())
+            if message.rest_is_one_line(rest):
+                reason = text[rest:message.free_text_end(rest)] if rest < message.length else None
+                return text[start:split], amount.group(1), amount.group(2), reason
+        return None
+
+
+FORMS = [VerbAmountName, NameVerbAmount, VerbNameAmount, NameAmount]
+
+
+def match_transaction(text):
+    """Recognises the sentence form of a message. Returns the parsed parts of the first form that matches."""
+    message = Message(text)
+    for form in FORMS:
+        parsed = form(message).parse()
+        if parsed:
+            return parsed
+    return None
+
+
+def parse_transaction_exact(text):
+    """
+    Parses a transaction message into (amount, divisor, recipient, reason), with the amount as an exact Decimal,
+    negative if the recipient gave money to the sender, and the divisor of an "amount/N" split as an int, or None
+    if there is none. Returns None if the message isn't understood.
+    """
+    parsed = match_transaction(text)
+    if not parsed:
+        return None
+
+    direction, amount_str, divisor_str, recipient, reason, sign = parsed
+    amount = Decimal(amount_str) * sign
+    if RECEIVE_PATTERN.match(direction):
+        amount = -amount
+    divisor = int(divisor_str.strip('/')) if divisor_str else None
+
+    return amount, divisor, recipient, reason or ""
+
+
+def parse_split(text):
+    """
+    Parses a message that splits an amount between the sender and everyone mentioned at its end, such as
+    "I paid 90 for dinner @anna @bob*2". Returns (amount, reason, mentions) with the amount as an exact Decimal
+    and mentions as a list of (name, weight) pairs, where the name is lowercase without the "@", and "me" is
+    the sender. The sender takes part with a weight of 1 unless they mention themselves. Returns None if the
+    message isn't such a split, which includes a reason that is just a keyword like "to" or "for".
+    """
+    words = list(WORD_PATTERN.finditer(text))
+    mentions = []
+    while words:
+        mention = MENTION.fullmatch(words[-1].group())
+        if not mention:
+            break
+        words.pop()
+        name = mention.group(1).lower()
+        mentions.append((name.lstrip('@'), int(mention.group(2)) if mention.group(2) else 1))
+    mentions.reverse()
+    if not any(name != 'me' for name, weight in mentions):
+        return None
+
+    if words and I_WORD.fullmatch(words[0].group()):
+        words.pop(0)
+    if len(words) < 2 or not SPLIT_VERB_WORD.fullmatch(words[0].group()) \
+            or not SPLIT_AMOUNT.fullmatch(words[1].group()):
+        return None
+
+    reason = None
+    rest = words[2:]
+    if all(REASON_WORD.fullmatch(word.group()) or OF_WORD.fullmatch(word.group()) for word in rest):
+        # "I paid 15 to @bob" or "for @bob" pays for them rather than splitting, but "with @bob" shares it
+        if rest and not (len(rest) == 1 and WITH_WORD.fullmatch(rest[0].group())):
+            return None
+    else:
+        reason = text[rest[0].start():rest[-1].end()]
+        if not REASON_WORD.fullmatch(rest[0].group()):
+            reason = 'for ' + reason
+    return Decimal(words[1].group()), reason, mentions
@@ -0,0 +1,73 @@
+"""Receives updates from Telegram through a webhook instead of long polling."""
+import hmac
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Telegram's updates are tiny, anything bigger than this isn't from Telegram
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            self.reply(404)
+            return
+
+        secret = self.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret.encode(), server.secret.encode()):
+            logger.warning("Rejected webhook request from %s with a wrong secret token", self.client_address[0])
+            self.reply(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.reply(400)
+            return
+        if length <= 0 or length > MAX_BODY_SIZE:
+            self.reply(413 if length > 0 else 400)
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length))
+            update = Update.de_json(data, server.dispatcher.bot)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Received malformed update from %s", self.client_address[0])
+            self.reply(400)
+            return
+
+        # The dispatcher picks the update up from its queue, so Telegram gets its answer right away.
+        server.dispatcher.update_queue.put(update)
+        self.reply(200)
+
+    def reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.client_address[0], format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Accepts updates POSTed to `path` and hands them to the dispatcher. Requests which don't carry the secret token
+    that was given to Telegram in `set_webhook` are rejected.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, path, secret, dispatcher):
+        if not secret:
+            raise ValueError("A webhook needs a secret token")
+        super().__init__(address, WebhookHandler)
+        self.path = path
+        self.secret = secret
+        self.dispatcher = dispatcher